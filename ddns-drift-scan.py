@@ -0,0 +1,296 @@
+################################################################################
+### Drift detection for the DDNS lambda
+###
+### This script reads every zone the DDNS lambda manages exactly once
+### and joins the A, PTR and CNAME records it finds against the live
+### instance inventory.  Anything pointing at an instance or ip address
+### that no longer exists gets reported, and optionally deleted.
+###
+### Route53 doesn't hand back the "Updated by Lambda DDNS" change comment
+### with a record set, so we decide what the lambda owns this way
+###   - zones created by the lambda carry that comment in their config,
+###     every record in them is ours
+###   - a TXT record carrying our heritage marker claims every record
+###     at the same name, and a per-instance ownership record
+###     (_ddns.<instance-id>.<zone>) claims every record it lists
+### anything else is left alone, however much it looks like ours.
+### A CNAME is only an orphan if its target is in a zone we scanned(or is an
+### EC2 name) and nothing at all, ours or not, lives at that name.
+###
+### Instances are read from every --region(default: our own), and a private
+### zone is only judged if all of its VPCs are in those regions, the lambdas
+### of other regions make zones of their own.  Public zones can hold records
+### of any region, so they're only judged when --zone names them.
+###
+### Everything is hashed by ip and by name, so a scan is linear in the
+### number of records + instances, even on zones with 100k records.
+###
+### Usage
+###   python ddns-drift-scan.py                     report only
+###   python ddns-drift-scan.py --repair            delete the orphans
+###   python ddns-drift-scan.py --zone example.com  scan an extra zone
+###   python ddns-drift-scan.py --region us-east-1 --region us-west-2
+###                                                 instances of both regions
+###
+################################################################################
+
+import argparse
+import os
+import ddns_clients
+import ddns_pipeline
+from datetime import datetime
+
+print('Loading function ' + datetime.now().time().isoformat())
+route53 = ddns_clients.client('route53')
+
+
+#################################################################
+### Defining some defaults                                   ####
+#################################################################
+
+# the comment the lambda puts on its changes and on the zones it creates
+ddns_comment = ddns_pipeline.ddns_comment
+
+# TXT value that marks every record at the same name as ours
+heritage_marker = "heritage=lambda-ddns"
+
+# record types the lambda creates
+managed_types = ['A', 'PTR', 'CNAME']
+
+# instance states we consider alive
+live_states = ['pending', 'running']
+
+
+#################################################################
+### Defining our functions                                   ####
+#################################################################
+
+def normalize_name(name):
+    """Lower case a dns name and make sure it ends with a dot."""
+    name = name.lower()
+    if name[-1] != '.':
+        name = name + '.'
+    return name
+
+
+def get_managed_zones(extra_zones, regions):
+    """Returns a dict of zone_id -> zone name for every zone the lambda manages
+    that can be judged from the instances of regions, and the set of zone ids
+    the lambda created itself."""
+    # the default zone for an instance comes from its VPC's dhcp option set
+    dhcp_domains = set()
+    for region in regions:
+        compute = ddns_clients.client('ec2', region)
+        for page in compute.get_paginator('describe_dhcp_options').paginate():
+            for opts in page['DhcpOptions']:
+                for conf in opts['DhcpConfigurations']:
+                    if conf['Key'] == 'domain-name':
+                        for value in conf['Values']:
+                            dhcp_domains.add(normalize_name(value['Value']))
+
+    extra_zones = set(normalize_name(zone) for zone in extra_zones)
+    wanted = extra_zones | dhcp_domains
+
+    # reverse zones are only ours if the lambda made them(or --zone names them)
+    zones = {}
+    created = set()
+    for page in route53.get_paginator('list_hosted_zones').paginate():
+        for zone in page['HostedZones']:
+            zone_id = zone['Id'].split('/')[-1]
+            zone_name = normalize_name(zone['Name'])
+            comment = zone.get('Config', {}).get('Comment', '')
+            if zone_name not in wanted and comment != ddns_comment:
+                continue
+            if not zone.get('Config', {}).get('PrivateZone'):
+                if zone_name not in extra_zones:
+                    print('Skipping public zone %s (%s), name it with --zone to scan it' % (zone_name, zone_id))
+                    continue
+            else:
+                vpc_regions = set(vpc['VPCRegion'] for vpc in route53.get_hosted_zone(Id=zone_id).get('VPCs', []))
+                if not vpc_regions.issubset(regions):
+                    print('Skipping zone %s (%s), it has VPCs in %s' % (
+                        zone_name, zone_id, ', '.join(sorted(vpc_regions - set(regions)))))
+                    continue
+            if comment == ddns_comment:
+                created.add(zone_id)
+            zones[zone_id] = zone_name
+    return zones, created
+
+
+def get_live_inventory(regions):
+    """Returns hash indexes of the live instances of regions keyed by ip address and by dns name."""
+    by_ip = {}
+    by_name = {}
+    for region in regions:
+        paginator = ddns_clients.client('ec2', region).get_paginator('describe_instances')
+        pages = paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': live_states}])
+        for page in pages:
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instance_id = instance['InstanceId']
+                    for interface in instance.get('NetworkInterfaces', []):
+                        for address in interface.get('PrivateIpAddresses', []):
+                            by_ip[address['PrivateIpAddress']] = instance_id
+                            if address.get('Association', {}).get('PublicIp'):
+                                by_ip[address['Association']['PublicIp']] = instance_id
+                    if instance.get('PrivateIpAddress'):
+                        by_ip[instance['PrivateIpAddress']] = instance_id
+                    if instance.get('PublicIpAddress'):
+                        by_ip[instance['PublicIpAddress']] = instance_id
+                    for dns_name in (instance.get('PrivateDnsName'), instance.get('PublicDnsName')):
+                        if dns_name:
+                            by_name[normalize_name(dns_name)] = instance_id
+    return by_ip, by_name
+
+
+def read_zone(zone_id):
+    """Reads every record set in a zone, once, in the order Route53 returns them."""
+    paginator = route53.get_paginator('list_resource_record_sets')
+    for page in paginator.paginate(HostedZoneId=zone_id):
+        for record_set in page['ResourceRecordSets']:
+            yield record_set
+
+
+def ptr_to_ip(ptr_name):
+    """Turns 4.3.2.1.in-addr.arpa. into 1.2.3.4"""
+    octets = ptr_name[:-len('.in-addr.arpa.')].split('.')
+    octets.reverse()
+    return '.'.join(octets)
+
+
+def record_values(record_set):
+    return [normalize_name(r['Value']) if record_set['Type'] != 'A' else r['Value']
+            for r in record_set.get('ResourceRecords', [])]
+
+
+def find_orphans(zones, created, by_ip, by_name):
+    """Walks each managed zone once and returns a dict of zone_id -> list of orphaned record sets."""
+    # first pass state: records we might own, the names the heritage marker
+    # claims and how many record sets(anyone's) each name holds
+    owned = []
+    claimed_names = set()
+    dead_owner_records = []
+    name_counts = {}
+    live_instances = set(by_ip.values())
+    for zone_id, zone_name in zones.items():
+        print('Scanning zone %s (%s)' % (zone_name, zone_id))
+        for record_set in read_zone(zone_id):
+            rtype = record_set['Type']
+            name = normalize_name(record_set['Name'])
+            if rtype == 'TXT':
+                values = [r['Value'].strip('"') for r in record_set.get('ResourceRecords', [])]
+                markers = [v for v in values if v.startswith(heritage_marker)]
+                if markers:
+                    claimed_names.add(name)
+                    # per-instance ownership records list "zone_id type name value"
+                    # next to the marker, and die along with their instance
+                    owner = markers[0].split('instance=')[-1] if 'instance=' in markers[0] else None
+                    for value in values:
+                        if value not in markers:
+                            claimed_names.add(normalize_name(value.split(' ')[2]))
+                    if owner and owner not in live_instances:
+                        dead_owner_records.append((zone_id, record_set, owner))
+                    # our own bookkeeping doesn't keep a name alive
+                    continue
+            name_counts[name] = name_counts.get(name, 0) + 1
+            if rtype not in managed_types or 'AliasTarget' in record_set:
+                continue
+            owned.append((zone_id, record_set))
+
+    owned = [(zone_id, record_set) for zone_id, record_set in owned
+             if zone_id in created or normalize_name(record_set['Name']) in claimed_names]
+
+    orphans = {}
+
+    def add_orphan(zone_id, record_set, reason):
+        print('Orphaned %s record %s -> %s (%s)' % (record_set['Type'], record_set['Name'],
+              ', '.join(record_values(record_set)), reason))
+        orphans.setdefault(zone_id, []).append(record_set)
+
+    for zone_id, record_set, owner in dead_owner_records:
+        add_orphan(zone_id, record_set, 'owner %s is gone' % owner)
+
+    # A and PTR records are judged purely on their ip address, an orphaned
+    # A record leaves its name empty(unless something else lives there)
+    cnames = []
+    for zone_id, record_set in owned:
+        rtype = record_set['Type']
+        if rtype == 'A':
+            dead = [v for v in record_values(record_set) if v not in by_ip]
+            if dead:
+                add_orphan(zone_id, record_set, 'no live instance has %s' % ', '.join(dead))
+                name_counts[normalize_name(record_set['Name'])] -= 1
+        elif rtype == 'PTR':
+            ip = ptr_to_ip(normalize_name(record_set['Name']))
+            if ip not in by_ip:
+                add_orphan(zone_id, record_set, 'no live instance has %s' % ip)
+        else:
+            cnames.append((zone_id, record_set))
+
+    # any name with a record left in the scanned zones is a valid CNAME target,
+    # whoever owns it, and so is any live instance's EC2 name.  Only judge
+    # CNAMEs pointing into zones we scanned or at EC2 names, anything else
+    # is somebody else's business
+    live_names = set(by_name)
+    live_names.update(name for name, count in name_counts.items() if count > 0)
+    zone_suffixes = set(zones.values())
+    for zone_id, record_set in cnames:
+        for target in record_values(record_set):
+            if target in live_names:
+                continue
+            ours = target.endswith('.amazonaws.com.') or target.endswith('.internal.')
+            if not ours:
+                labels = target.split('.')
+                ours = any('.'.join(labels[i:]) in zone_suffixes for i in range(1, len(labels)))
+            if ours:
+                add_orphan(zone_id, record_set, 'target %s is gone' % target)
+                break
+    return orphans
+
+
+def delete_orphans(orphans):
+    """Deletes orphaned record sets, up to max_batch_changes per ChangeBatch, one
+    at a time when a record that changed since the scan sinks the batch."""
+    def send(zone_id, changes):
+        return route53.change_resource_record_sets(
+            HostedZoneId=zone_id,
+            ChangeBatch={"Comment": ddns_comment, "Changes": changes})
+
+    for zone_id, record_sets in orphans.items():
+        for start in range(0, len(record_sets), ddns_pipeline.max_batch_changes):
+            chunk = [{"Action": "DELETE", "ResourceRecordSet": r}
+                     for r in record_sets[start:start + ddns_pipeline.max_batch_changes]]
+            print('Deleting %d records from zone %s' % (len(chunk), zone_id))
+            ddns_pipeline.send_batch(send, zone_id, chunk)
+
+
+################################################################
+### Running Code                                            ####
+################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find (and fix) DNS records pointing at dead instances.')
+    parser.add_argument('--zone', action='append', default=[],
+                        help='extra zone to scan, may be given more than once')
+    parser.add_argument('--region', action='append', default=[],
+                        help='region to read instances from, may be given more than once(default: our own)')
+    parser.add_argument('--repair', action='store_true',
+                        help='delete the orphaned records instead of only reporting them')
+    args = parser.parse_args()
+
+    regions = args.region or [ddns_clients.get_session().region_name]
+    zones, created = get_managed_zones(args.zone, regions)
+    by_ip, by_name = get_live_inventory(regions)
+    print('Found %d live addresses and %d live names' % (len(by_ip), len(by_name)))
+
+    orphans = find_orphans(zones, created, by_ip, by_name)
+    print('')
+    print('Found %d orphaned records in %d zones' % (sum(len(r) for r in orphans.values()), len(orphans)))
+
+    if args.repair:
+        delete_orphans(orphans)
+
+    print('')
+    print('Completed function ' + datetime.now().time().isoformat())
+    print('##################################################################################')
+    print('')
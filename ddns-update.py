@@ -1,139 +1,398 @@
-import json
-import boto3
-import re
-import uuid
+import argparse
+import os
+import ddns_clients
+import ddns_pipeline
+import ddns_records
+import ddns_templates
 import time
-import random
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
 
 print('Loading function ' + datetime.now().time().isoformat())
-route53 = boto3.client('route53')
-ec2 = boto3.resource('ec2')
-compute = boto3.client('ec2')
-dynamodb_client = boto3.client('dynamodb')
-dynamodb_resource = boto3.resource('dynamodb')
+route53 = ddns_clients.client('route53')
+compute = ddns_clients.client('ec2')
 
 #################################################################
-### Defining our functions                                   ####
-### Most these copied from
-### https://github.com/awslabs/aws-lambda-ddns-function/blob/master/union.py
+### Defining some defaults                                   ####
+#################################################################
+
+# where A records go when an instance's VPC doesn't say, and the root domain
+# for imednet-env CNAMEs, the same ones the update-dns-entries scripts use
+default_zone = ddns_pipeline.default_zone
+root_domain = ddns_pipeline.root_domain
+
+
+
+#################################################################
+### Concurrent engine                                        ####
+#################################################################
+
+## The old serial sweep made a handful of Route53/EC2 calls per instance,
+## one after another, so its run time was latency x instances.
+## The concurrent engine instead
+##   - pulls instances, subnets & hosted zones in one paginated pass each,
+##     with all three running at the same time
+##   - works out every instance's records locally
+##   - sends one ChangeBatch per zone(per 1000 changes), zones in parallel
+## which makes the run time latency x zones.
+## asyncio/aiobotocore don't exist on the python 2.7 these scripts run on,
+## so the overlap comes from a thread pool sharing thread-safe boto3 clients.
+
+# concurrent calls allowed per service
+ec2_concurrency = 4
+route53_concurrency = 4
+
+# Route53 only lets one change per zone be in flight(PriorRequestNotComplete)
+zone_concurrency = 1
+
+# (change id, zone id, submitted at, clients) for every batch we send, see wait_for_insync
+submitted_changes = []
+
+ec2_slots = threading.BoundedSemaphore(ec2_concurrency)
+route53_slots = threading.BoundedSemaphore(route53_concurrency)
+zone_slots = {}
+zone_slots_lock = threading.Lock()
+
+# the clients, and the slots that go with them, for our own account & region
+local_clients = {'compute': compute, 'route53': route53, 'ec2_slots': ec2_slots, 'route53_slots': route53_slots}
+
+
+def get_zone_slots(zone_id):
+    with zone_slots_lock:
+        if zone_id not in zone_slots:
+            zone_slots[zone_id] = threading.BoundedSemaphore(zone_concurrency)
+        return zone_slots[zone_id]
+
+
+def call_aws(slots, fn, **kwargs):
+    """Makes one AWS call while holding one of slots, botocore's adaptive
+    retries(see ddns_clients.py) do the backing off on throttles."""
+    with slots:
+        return fn(**kwargs)
+
+
+def paginate(slots, client, operation, key, **kwargs):
+    """Walks a paginated AWS call, holding a slot for each page."""
+    results = []
+    fn = getattr(client, operation)
+    while True:
+        page = call_aws(slots, fn, **kwargs)
+        results.extend(page[key])
+        if not page.get('NextToken'):
+            return results
+        kwargs['NextToken'] = page['NextToken']
+
+
+def fetch_inventory(pool, clients=local_clients, zone_ids=None):
+    """Pulls instances, subnets & hosted zones(unless we already have them) at the same time."""
+    instances = pool.apply_async(paginate, (clients['ec2_slots'], clients['compute'], 'describe_instances', 'Reservations'),
+        {'Filters': [{'Name': 'instance-state-name', 'Values': ['stopped', 'running']}]})
+    subnets = pool.apply_async(ddns_pipeline.list_subnet_masks, (clients['compute'],))
+    if zone_ids is None:
+        zones = pool.apply_async(ddns_pipeline.list_zone_ids, (clients['route53'],))
+
+    instance_list = []
+    for reservation in instances.get():
+        instance_list.extend(reservation['Instances'])
+    subnet_masks = subnets.get()
+    if zone_ids is None:
+        zone_ids = zones.get()
+    return instance_list, subnet_masks, zone_ids
+
+
+def instance_changes(instance, subnet_masks, zone_ids, templates=None, name_slots=None):
+    """Works out (zone_id, change) pairs for one instance, see ddns_pipeline.spec_changes,
+    from compiled templates(see ddns_templates.py) if given."""
+    spec = ddns_pipeline.instance_spec(instance, default_zone, root_domain, name_slots)
+    if spec is None:
+        return []
+    return ddns_pipeline.spec_changes(spec, subnet_masks, zone_ids, templates)
+
+
+def submit_zone_changes(zone_id, changes, clients=local_clients):
+    """Sends all of one zone's changes, one batch at a time, with the clients of the account that owns the zone."""
+    slots = get_zone_slots(zone_id)
+
+    def send(zone_id, changes):
+        response = call_aws(clients['route53_slots'], clients['route53'].change_resource_record_sets,
+            HostedZoneId=zone_id, ChangeBatch={"Comment": ddns_pipeline.ddns_comment, "Changes": changes})
+        submitted_changes.append((response['ChangeInfo']['Id'], zone_id, time.time(), clients))
+
+    for batch_zone_id, batch in ddns_pipeline.batch_changes((zone_id, change) for change in changes):
+        print('Submitting %d changes to zone %s' % (len(batch), zone_id))
+        with slots:
+            ddns_pipeline.send_batch(send, zone_id, batch)
+
+
+def wait_for_insync(changes, timeout):
+    """Polls get_change with backoff until every change is INSYNC, logging how long each took."""
+    pending = list(changes)
+    deadline = time.time() + timeout
+    delay = 1.0
+    while pending and time.time() < deadline:
+        still_pending = []
+        for change_id, zone_id, submitted, clients in pending:
+            status = call_aws(clients['route53_slots'], clients['route53'].get_change, Id=change_id)['ChangeInfo']['Status']
+            if status == 'INSYNC':
+                print('Change %s to zone %s INSYNC after %.1fs' % (change_id, zone_id, time.time() - submitted))
+            else:
+                still_pending.append((change_id, zone_id, submitted, clients))
+        pending = still_pending
+        if pending:
+            time.sleep(delay)
+            delay = min(delay * 2, 10.0)
+    if pending:
+        print('Gave up waiting on %d changes to go INSYNC' % len(pending))
+
+
+#################################################################
+### Multi-region, multi-account sweep                        ####
 #################################################################
 
-def get_zone_id(zone_name):
-    """This function returns the zone id for the zone name that's passed into the function."""
-    if zone_name[-1] != '.':
-        zone_name = zone_name + '.'
-    hosted_zones = route53.list_hosted_zones()
-    x = filter(lambda record: record['Name'] == zone_name, hosted_zones['HostedZones'])
+## --region and --role-arn point the concurrent engine at every region of
+## every account instead of just our own.  Each (region, role) target gets
+## its own clients(ddns_clients keeps one per role, service & region) and its
+## own EC2 slots, kept in target_clients, since EC2 throttles per region &
+## account.  Route53 is global and throttles per account, so every region of
+## an account shares one Route53 client, its slots and one zone listing.
+## Changes are merged by zone id before anything is sent, so a private zone
+## shared by VPCs in several regions(or accounts) gets one set of batches,
+## written by the account that owns it.
+
+target_clients = {(None, None): local_clients}
+target_clients_lock = threading.Lock()
+
+
+def account_key(role_arn):
+    """The account id in a role ARN, None for our own credentials."""
+    if role_arn:
+        return role_arn.split(':')[4]
+    return None
+
+
+def target_name(target):
+    region, role_arn = target
+    return '%s/%s' % (account_key(role_arn) or 'local', region or 'default')
+
+
+def get_target_clients(region, role_arn):
+    """Returns the clients & slots for one region of one account, making them the first time."""
+    with target_clients_lock:
+        key = (region, role_arn)
+        if key in target_clients:
+            return target_clients[key]
+        session = ddns_clients.role_session(role_arn, 'ddns-update') if role_arn else None
+        account = [c for (r, a), c in target_clients.items() if account_key(a) == account_key(role_arn)]
+        if account:
+            route53_account_slots = account[0]['route53_slots']
+        else:
+            route53_account_slots = threading.BoundedSemaphore(route53_concurrency)
+        target_clients[key] = {
+            'compute': ddns_clients.client('ec2', region, session),
+            'route53': ddns_clients.client('route53', None, session),
+            'ec2_slots': threading.BoundedSemaphore(ec2_concurrency),
+            'route53_slots': route53_account_slots,
+        }
+        return target_clients[key]
+
+
+def concurrent_sweep(workers, regions=None, role_arns=None, templates=None):
+    """Reconciles every stopped & running instance with the concurrent engine.
+
+    regions and role_arns widen the sweep to every region of every account,
+    without them it's just our own region & account.  templates, compiled
+    once, replace the built in naming rules.
+    """
+    targets = [(region, role_arn) for role_arn in (role_arns or [None]) for region in (regions or [None])]
+    accounts = sorted(set(account_key(role_arn) for region, role_arn in targets))
+
+    pool = ThreadPool(workers)
+    # inventory fetches wait on the worker pool, so they get a pool of their own
+    target_pool = ThreadPool(len(targets))
     try:
-        zone_id_long = x[0]['Id']
-        zone_id = str.split(str(zone_id_long),'/')[2]
-        return zone_id
-    except:
-        return None
-
-
-## One function to delete or create
-## just tell the function what action(create or delete) we want
-def modify_resource_record(zone_id, host_name, hosted_zone_name, type, value, action):
-    """This function creates or deletes resource records in the hosted zone passed by the calling function."""
-    if action == 'create':
-        print 'Updating %s record %s in zone %s ' % (type, host_name, hosted_zone_name)
-        action = 'UPSERT'
-    elif action == 'delete':
-        print 'Deleting %s record %s in zone %s' % (type, host_name, hosted_zone_name)
-        action = 'DELETE'
-    else:
-        print 'Uknown action %s ' % (action)
-        return
-    if host_name[-1] != '.':
-        host_name = host_name + '.'
-    route53.change_resource_record_sets(
-                HostedZoneId=zone_id,
-                ChangeBatch={
-                    "Comment": "Updated by Lambda DDNS",
-                    "Changes": [
-                        {
-                            "Action": action,
-                            "ResourceRecordSet": {
-                                "Name": host_name + hosted_zone_name,
-                                "Type": type,
-                                "TTL": 60,
-                                "ResourceRecords": [
-                                    {   
-                                        "Value": value
-                                    },
-                                ]
-                            }
-                        },
-                    ]
-                }
-            )
-
-
-# reverse lookup functions
-def reverse_list(list):
-    """Reverses the order of the instance's IP address and helps construct the reverse lookup zone name."""
-    if (re.search('\d{1,3}.\d{1,3}.\d{1,3}.\d{1,3}',list)) or (re.search('\d{1,3}.\d{1,3}.\d{1,3}\.',list)) or (re.search('\d{1,3}.\d{1,3}\.',list)) or (re.search('\d{1,3}\.',list)):
-        list = str.split(str(list),'.')
-        list = filter(None, list)
-        list.reverse()
-        reversed_list = ''
-        for item in list:
-            reversed_list = reversed_list + item + '.'
-        return reversed_list
-    else:
-        print 'Not a valid ip'
-        exit()
-
-def get_reversed_domain_prefix(subnet_mask, private_ip):
-    """Uses the mask to get the zone prefix for the reverse lookup zone"""
-    if 32 >= subnet_mask >= 24:
-        third_octet = re.search('\d{1,3}.\d{1,3}.\d{1,3}.',private_ip)
-        return third_octet.group(0)
-    elif 24 > subnet_mask >= 16:
-        second_octet = re.search('\d{1,3}.\d{1,3}.', private_ip)
-        return second_octet.group(0)
-    else:
-        first_octet = re.search('\d{1,3}.', private_ip)
-        return first_octet.group(0)
-
-def create_reverse_lookup_zone(instance, reversed_domain_prefix, region):
-    """Creates the reverse lookup zone."""
-    print 'Creating reverse lookup zone %s' % reversed_domain_prefix + 'in.addr.arpa.'
-    route53.create_hosted_zone(
-        Name = reversed_domain_prefix + 'in-addr.arpa.',
-        VPC = {
-            'VPCRegion':region,
-            'VPCId': instance['Reservations'][0]['Instances'][0]['VpcId']
-        },
-        CallerReference=str(uuid.uuid1()),
-        HostedZoneConfig={
-            'Comment': 'Updated by Lambda DDNS',
-        },
-    )
-
-def get_hosted_zone_properties(zone_id):
-    hosted_zone_properties = route53.get_hosted_zone(Id=zone_id)
-    hosted_zone_properties.pop('ResponseMetadata')
-    return hosted_zone_properties
+        clients = dict((target, get_target_clients(*target)) for target in targets)
+        account_clients = dict((account_key(role_arn), clients[(region, role_arn)]) for region, role_arn in targets)
+        name_slots = ddns_pipeline.load_name_slots()
+
+        # one zone listing per account, every account can also see the zones
+        # of the others(shared private zones), its own win on a name clash
+        zone_lists = dict((account, pool.apply_async(ddns_pipeline.list_zone_ids, (account_clients[account]['route53'],))) for account in accounts)
+        zone_lists = dict((account, result.get()) for account, result in zone_lists.items())
+        zone_owners = {}
+        for account in accounts:
+            for zone_id in zone_lists[account].values():
+                zone_owners[zone_id] = account
+        account_zones = {}
+        for account in accounts:
+            account_zones[account] = {}
+            for other in accounts:
+                if other != account:
+                    account_zones[account].update(zone_lists[other])
+            account_zones[account].update(zone_lists[account])
+
+        inventories = [(target, target_pool.apply_async(fetch_inventory,
+                        (pool, clients[target], account_zones[account_key(target[1])])))
+                       for target in targets]
+
+        # zone id -> (name, type, set identifier) -> change, a ChangeBatch can't
+        # touch the same record set twice, so the last change to each one wins.
+        # Multivalue/weighted members differ by set identifier, each is kept
+        changes = {}
+        for target, result in inventories:
+            instances, subnet_masks, zone_ids = result.get()
+            print('Found %d instances, %d subnets, %d zones in %s' % (len(instances), len(subnet_masks),
+                  len(zone_ids), target_name(target)))
+            for instance in instances:
+                for zone_id, change in instance_changes(instance, subnet_masks, zone_ids, templates, name_slots):
+                    changes.setdefault(zone_id, OrderedDict())[ddns_pipeline.record_key(change['ResourceRecordSet'])] = change
+
+        results = [pool.apply_async(submit_zone_changes,
+                   (zone_id, list(zone_changes.values()), account_clients[zone_owners[zone_id]]))
+                   for zone_id, zone_changes in changes.items()]
+        for result in results:
+            result.get()
+    finally:
+        target_pool.close()
+        target_pool.join()
+        pool.close()
+        pool.join()
 
 
 #################################################################
-### Defining some defaults                                   ####
+### Zone file export                                         ####
 #################################################################
 
-# default subdomain
-# This the domain where A records will get registered
-default_subdomain = "aws"
+## --export writes the records the sweep works out to local files instead of
+## Route53, so a caching resolver(unbound, dnsmasq, nsd...) next to the
+## services can answer for them
+##   zonefile  one RFC 1035 zone file per zone in the --output directory
+##   hosts     a single hosts file(A records, plus function CNAMEs flattened
+##             to the instance's own ip), for dnsmasq's addn-hosts
+## Instances are read a page at a time and each one's records written out as
+## soon as they're worked out, so memory stays flat however big the estate.
+## Files are written next to their final name and renamed into place at the
+## end, so a resolver never loads half a file.
+## Only running instances are exported, and since a name can only hold one
+## CNAME the first instance to claim a function name keeps it.
+
+# SOA & NS for the exported zones, the resolver is authoritative for them locally
+export_soa = 'localhost. hostmaster.localhost.'
+export_ns = 'localhost.'
+
+
+def iter_instances(clients=local_clients, states=('stopped', 'running')):
+    """Yields instances one describe_instances page at a time."""
+    def describe_instances(**kwargs):
+        return call_aws(clients['ec2_slots'], clients['compute'].describe_instances, **kwargs)
+    return ddns_pipeline.iter_instances(describe_instances, states)
+
+
+def zone_file_line(record_name, ttl, type, value):
+    if type in ('CNAME', 'PTR') and value[-1] != '.':
+        value = value + '.'
+    return '%s %d IN %s %s\n' % (record_name, ttl, type, value)
+
+
+def open_export_file(path):
+    """Opens path's temporary twin for writing, see close_export_files."""
+    return open(path + '.tmp', 'w')
+
+
+def close_export_files(files):
+    for path, f in files.items():
+        f.close()
+        os.rename(path + '.tmp', path)
+
+
+def export_records(export_format, output, templates=None):
+    """Streams every running instance's records to zone files or a hosts file."""
+    subnet_masks = ddns_pipeline.list_subnet_masks(compute)
+    zone_ids = ddns_pipeline.list_zone_ids(route53)
+    zone_names = dict((zone_id, zone_name) for zone_name, zone_id in zone_ids.items())
+    name_slots = ddns_pipeline.load_name_slots()
+
+    files = {}
+    cnames = set()
+    instances = 0
+    records = 0
+    if export_format == 'hosts':
+        hosts = files[output] = open_export_file(output)
+    else:
+        if not os.path.isdir(output):
+            os.makedirs(output)
+        serial = int(time.time())
+    try:
+        for instance in iter_instances(states=['running']):
+            instances = instances + 1
+            # the instance's own A records, to flatten its CNAMEs for the hosts file
+            addresses = {}
+            for zone_id, change in instance_changes(instance, subnet_masks, zone_ids, templates, name_slots):
+                record_set = change['ResourceRecordSet']
+                record_name, type = record_set['Name'], record_set['Type']
+                value = record_set['ResourceRecords'][0]['Value']
+                if type == 'CNAME':
+                    if record_name in cnames:
+                        continue
+                    cnames.add(record_name)
+
+                if export_format == 'hosts':
+                    if type == 'A':
+                        addresses[record_name] = value
+                    elif type == 'CNAME' and addresses.get(value.rstrip('.') + '.'):
+                        value = addresses[value.rstrip('.') + '.']
+                    else:
+                        continue
+                    hosts.write('%s\t%s\n' % (value, record_name.rstrip('.')))
+                else:
+                    zone_name = zone_names[zone_id]
+                    path = os.path.join(output, zone_name + 'zone')
+                    if path not in files:
+                        files[path] = open_export_file(path)
+                        files[path].write('$ORIGIN %s\n$TTL 60\n' % zone_name)
+                        files[path].write('@ IN SOA %s %d 3600 600 86400 60\n' % (export_soa, serial))
+                        files[path].write('@ IN NS %s\n' % export_ns)
+                    files[path].write(zone_file_line(record_name, record_set['TTL'], type, value))
+                records = records + 1
+    finally:
+        close_export_files(files)
+    print('Exported %d records for %d instances to %s' % (records, instances, output))
 
-# default root domain
-root_domain = "imednet.com"
 
-# default_subdomain + root_domain
-# is the default location to register A records in
-default_zone = "%s.%s" % (default_subdomain, root_domain)
+#################################################################
+### Pipeline engine                                          ####
+#################################################################
 
+## --engine pipeline streams the sweep through ddns_pipeline.py instead of
+## pulling the whole inventory first: instances are read a page at a time,
+## turned into records, optionally diffed against what the zones already
+## hold(--diff, one read of each zone) and sent a full ChangeBatch at a time,
+## at most --workers batches in flight.  Memory stays flat however many
+## instances there are, and a slow Route53 slows down the EC2 reads with it.
+## --engine serial(the default) is the same pipeline with one batch at a time.
+
+
+def pipeline_sweep(workers, templates=None, diff=False):
+    # with one worker the batches are written right here, one after another
+    pool = ThreadPool(workers) if workers > 1 else None
+    subnet_masks = ddns_pipeline.list_subnet_masks(compute)
+    zone_ids = ddns_pipeline.list_zone_ids(route53)
+
+    specs = ddns_pipeline.parse_specs(iter_instances(), default_zone, root_domain, ddns_pipeline.load_name_slots())
+    changes = ddns_pipeline.desired_records(specs, subnet_masks, zone_ids, templates)
+    if diff:
+        # whole zones, kept for the length of the sweep
+        record_cache = ddns_records.RecordCache(route53, max_names=None, ttl=86400)
+        changes = ddns_pipeline.diff_changes(changes, record_cache)
+    batches = ddns_pipeline.batch_changes(changes)
+    try:
+        count = ddns_pipeline.write_batches(batches, submit_zone_changes, pool, workers)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    print('Wrote %d batches' % count)
 
 
 #################################################################
@@ -156,194 +415,47 @@ default_zone = "%s.%s" % (default_subdomain, root_domain)
 ### Running Code                                            ####
 ################################################################
 
-# Our list of Route53 hosted domains
-hosted_zones = route53.list_hosted_zones()
-
-instances = ec2.instances.filter(
-    Filters=[{'Name': 'instance-state-name', 'Values': ['stopped', 'running']}])
-
-
-for instance in instances:
-    print ''
-    print '##################################################################################'
-    print '###################     instance id %s                 ###################' % instance.id
-    print '##################################################################################'
-    for tag in instance.tags:
-        if 'override_zone' in tag.get('Key',{}):
-            # set this to force where A & CNAME records will be registered
-            override_zone = tag.get('Value').lstrip().lower()
-            print 'zone is %s ' % zone
-        if 'Name' in tag.get('Key',{}):
-            # this is used in the creation of the A record
-            name = tag.get('Value').lstrip().lower()
-            print 'name is %s ' % name
-        if 'imednet-env' in tag.get('Key',{}):
-            # target env is where the CNAME records will get registered
-            # e.g. memcache.automation-rc-aws.imednet.com
-            target_env = tag.get('Value').lstrip().lower()
-            print 'target_env environment is %s ' % target_env
-        if 'function' in tag.get('Key',{}):
-            # function is used to build a useful CNAME
-            # e.g. shard-0.automation-rc-aws.imednet.com
-            function = tag.get('Value').lstrip().lower()
-            print 'VM function is %s ' % function
-        if 'cname' in tag.get('Key',{}):
-            # you force the CNAME by simply specifying it in the cname tag
-            cname = tag.get('Value').lstrip().lower()
-            print 'CName is %s ' % cname
-        if 'root_domain' in tag.get('Key',{}):
-            root_domain = tag.get('Value').lstrip().lower()
-
-    # we have finished looping thru the tags
-
-    # Here's how we will build records
-    # A record is name.default_zone
-    # CNAME is function.target_env.root_domain and points to name.default_zone
-
-    # now we check if a specific zone was given
-    # it'll error out if zone isn't defined
-    try:
-        # a zone was specified, so we'll registered everything in that zone
-        print 'Setting default_zone to match override_zone tag of %s' % override_zone
-        default_zone = override_zone
-    except:
-        print 'Custom zone not defined'
-        try:
-            print 'Setting vmzone to %s.%s' % (target_env, root_domain)
-            vmzone = "%s.%s" % (target_env, root_domain)
-        except:
-            print 'target_env not defined, using default_zone'
-            vmzone = default_zone
-
-
-    # we need zone ids so we can update them
-    # if can't get zone ids, then we just bail out here
-    try:
-        default_zone_id = get_zone_id(default_zone)
-        zone_id = get_zone_id(vmzone)
-    except BaseException as e:
-        print('Failed to retrieve zone ids.\n')
-        print(e)
-        exit()
-
-    # if no function, then default to name
-    try:
-        # and in case something has multiple fuctions
-        # define the tag function with a space seperate list of functions
-        funlist = function.split(' ')
-    except:
-        function = name
-        funlist = function.split(' ')
-
-    # make sure we have a name
-    try:
-        # now some really quick santizing of the Name
-        name = name.split('.')[0]
-        name = name.split(' ')[0]
-    except:
-        name = instance.id
-
-    print ''
-    fullname = "%s.%s" % (name, default_zone)
-    print('Fullname is %s ' % (fullname))
-    print '' 
-    
-
-    # grab the state of the instance
-    # NOTE: later we'll get info from the cloudwatch event
-    state = instance.state.get('Name', {})
-
-    if state == 'running':
-        mod_action = 'create'
-    else:
-        mod_action = 'delete'
-
-    # reverse lookup bits
-    # Get the subnet mask of the instance
-    #subnet_id = instance['Reservations'][0]['Instances'][0]['SubnetId']
-    # this might break if the instance has multiple subnets
-    subnet = ec2.Subnet(instance.subnet_id)
-    cidr_block = subnet.cidr_block
-    subnet_mask = int(cidr_block.split('/')[-1])
-
-    reversed_ip_address = reverse_list(instance.private_ip_address)
-    reversed_domain_prefix = get_reversed_domain_prefix(subnet_mask, instance.private_ip_address)
-    reversed_domain_prefix = reverse_list(reversed_domain_prefix)
-
-    # Set the reverse lookup zone
-    reversed_lookup_zone = reversed_domain_prefix + 'in-addr.arpa.'
-    print 'The reverse lookup zone for this instance is:', reversed_lookup_zone
-
-
-    vpc_id = instance.vpc_id
-
-    # Now we make sure the reverse lookup zone exists and is associated
-    if filter(lambda record: record['Name'] == reversed_lookup_zone, hosted_zones['HostedZones']):
-        print 'Reverse lookup zone found:', reversed_lookup_zone
-        reverse_lookup_zone_id = get_zone_id(reversed_lookup_zone)
-        reverse_hosted_zone_properties = get_hosted_zone_properties(reverse_lookup_zone_id)
-        if vpc_id in map(lambda x: x['VPCId'], reverse_hosted_zone_properties['VPCs']):
-            print 'Reverse lookup zone %s is associated with VPC %s' % (reverse_lookup_zone_id, vpc_id)
-        else:
-            print 'Associating zone %s with VPC %s' % (reverse_lookup_zone_id, vpc_id)
-            try:
-                associate_zone(reverse_lookup_zone_id, region, vpc_id)
-            except BaseException as e:
-                print e
-    else:
-        print 'No matching reverse lookup zone'
-        # create private hosted zone for reverse lookups
-        if state == 'running':
-            create_reverse_lookup_zone(instance, reversed_domain_prefix, region)
-            reverse_lookup_zone_id = get_zone_id(reversed_lookup_zone)
-
-
-    print ''
-    a_name = "%s.%s" % (name, default_zone)
-    if not instance.public_ip_address:
-        # host is not externally accessible aka no public name or ip address
-        print 'No public ip address found'
-        #print("Attempting to remove A record for  {}.{} A {}".format(name, default_zone, instance.private_ip_address))
-        try:
-            modify_resource_record(default_zone_id, name, default_zone, 'A', instance.private_ip_address, mod_action)
-            modify_resource_record(reverse_lookup_zone_id, reversed_ip_address, 'in-addr.arpa', 'PTR', fullname, mod_action)
-        except BaseException as e:
-            print e
-       
-        for fun in funlist:
-            #print("Attempting to remove CNAME record for  {}.{} CNAME {}.{}".format(fun, vmzone, name, default_zone))
-            try:
-                modify_resource_record(zone_id, fun, vmzone, 'CNAME', a_name, mod_action)
-            except BaseException as e:
-                print e
-    else:
-        # host is externally accessible aka has public name and ip address
-        print 'Found public ip address of %s' % instance.public_ip_address
-        #print("Attempting to remove A record for {}.{} A {}".format(name, default_zone, instance.public_ip_address))
-        try:
-            modify_resource_record(default_zone_id, name, default_zone, 'A', instance.public_ip_address, mod_action)
-            modify_resource_record(reverse_lookup_zone_id, reversed_ip_address, 'in-addr.arpa', 'PTR', fullname, mod_action)
-        except BaseException as e:
-            print e
-
-        for fun in funlist:
-            #print("Attempting to remove CNAME record for {}.{} CNAME {}".format(fun, vmzone, instance.public_dns_name))
-            try:
-                modify_resource_record(zone_id, fun, vmzone, 'CNAME', instance.public_dns_name, mod_action)
-            except BaseException as e:
-                print e
-
-
-    ### Now we deal with reverse lookup stuff
-   
-    print '' 
-    print(instance.id, instance.instance_type, instance.state, instance.private_ip_address, instance.private_dns_name, instance.public_dns_name, instance.public_ip_address )
-    for goo in instance.tags:
-        print(goo)
-
-    print '##################################################################################'
-    print ''
-
+parser = argparse.ArgumentParser(description='Update DNS entries for every stopped & running instance.')
+parser.add_argument('--engine', choices=['serial', 'concurrent', 'pipeline'], default='pipeline',
+                    help='pipeline(default) streams batches, serial streams them one at a time, concurrent batches per zone')
+parser.add_argument('--workers', type=int, default=8,
+                    help='threads for the concurrent & pipeline engines')
+parser.add_argument('--diff', action='store_true',
+                    help="with the pipeline or serial engine, only send the changes the zones don't already have")
+parser.add_argument('--wait-insync', type=float, default=0, metavar='SECONDS',
+                    help='wait up to SECONDS for the changes to go INSYNC')
+parser.add_argument('--region', action='append', metavar='REGION',
+                    help='with the concurrent engine, sweep this region, may be given more than once')
+parser.add_argument('--role-arn', action='append', metavar='ARN',
+                    help='with the concurrent engine, sweep the account behind this role too, may be given more than once')
+parser.add_argument('--templates', metavar='SOURCE',
+                    help='build records from templates(json, s3://bucket/key or ssm:/name)')
+parser.add_argument('--export', choices=['zonefile', 'hosts'],
+                    help="don't touch Route53, write the running instances' records to zone files or a hosts file")
+parser.add_argument('--output', metavar='PATH',
+                    help='with --export, the directory for the zone files or the hosts file')
+args = parser.parse_args()
+if (args.region or args.role_arn) and args.engine != 'concurrent':
+    parser.error('--region and --role-arn need --engine concurrent')
+if args.diff and args.engine == 'concurrent':
+    parser.error('--diff needs --engine pipeline or serial')
+if args.export and not args.output:
+    parser.error('--export needs --output')
+
+templates = None
+if args.templates:
+    templates = ddns_templates.get_templates(args.templates)
+
+if args.export:
+    export_records(args.export, args.output, templates)
+elif args.engine == 'concurrent':
+    concurrent_sweep(args.workers, args.region, args.role_arn, templates)
+    if args.wait_insync:
+        wait_for_insync(submitted_changes, args.wait_insync)
+else:
+    pipeline_sweep(1 if args.engine == 'serial' else args.workers, templates, args.diff)
+    if args.wait_insync:
+        wait_for_insync(submitted_changes, args.wait_insync)
 
 print ''
 print('Completed function ' + datetime.now().time().isoformat())
@@ -0,0 +1,96 @@
+################################################################################
+### Shared boto3 clients for the DDNS scripts
+###
+### Every script used to build its own clients with the default botocore
+### config, each with its own connection pool of 10.  This module hands out
+### clients made from one shared session and one tuned config
+###   - max_pool_connections sized for the concurrent engines' thread pools
+###     (DDNS_MAX_POOL_CONNECTIONS, default 50)
+###   - adaptive retries, which back off client side when AWS throttles us
+###     (DDNS_MAX_ATTEMPTS, default 10).  These are the only retries, the
+###     scripts don't loop over throttles(or PriorRequestNotComplete) again
+###   - TCP keepalive, so idle pooled connections survive between calls
+### Clients are made once per session, service & region and kept at module
+### level, so they live across warm lambda invocations and are shared by every
+### worker thread(boto3 clients are thread safe, sessions aren't, hence the
+### lock).  Sessions for assumed roles are kept the same way, one per role.
+###
+### Older botocores(the last ones that ran on python 2.7) don't know about
+### tcp_keepalive or the adaptive retry mode, there we quietly do without.
+###
+################################################################################
+
+import os
+import threading
+
+import boto3
+import botocore.config
+import botocore.exceptions
+
+max_pool_connections = int(os.environ.get('DDNS_MAX_POOL_CONNECTIONS', '50'))
+max_attempts = int(os.environ.get('DDNS_MAX_ATTEMPTS', '10'))
+
+session = None
+role_sessions = {}
+clients = {}
+clients_lock = threading.Lock()
+
+
+def make_config():
+    """The tuned botocore config, trimmed down to what this botocore understands."""
+    options = [
+        {'tcp_keepalive': True, 'retries': {'mode': 'adaptive', 'max_attempts': max_attempts}},
+        {'retries': {'mode': 'adaptive', 'max_attempts': max_attempts}},
+        {'retries': {'max_attempts': max_attempts}},
+    ]
+    for option in options:
+        try:
+            return botocore.config.Config(max_pool_connections=max_pool_connections, **option)
+        except (TypeError, botocore.exceptions.BotoCoreError):
+            continue
+    return botocore.config.Config(max_pool_connections=max_pool_connections)
+
+config = make_config()
+
+
+def get_session():
+    global session
+    if session is None:
+        session = boto3.session.Session()
+    return session
+
+
+def role_session(role_arn, session_name='ddns'):
+    """A session with role_arn's credentials, assuming the role the first time."""
+    if role_arn not in role_sessions:
+        credentials = client('sts').assume_role(RoleArn=role_arn, RoleSessionName=session_name)['Credentials']
+        with clients_lock:
+            role_sessions.setdefault(role_arn, boto3.session.Session(
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken']))
+    return role_sessions[role_arn]
+
+
+def client(service, region_name=None, from_session=None):
+    """Returns the shared client for service(in region_name), making it the first time.
+
+    Pass from_session for a session of your own, e.g. with assumed role
+    credentials, its clients are made with the shared config and kept per
+    session, service & region the same way.
+    """
+    return get_or_make('client', service, region_name, from_session)
+
+
+def resource(service, region_name=None, from_session=None):
+    """Same as client(), for boto3 resources."""
+    return get_or_make('resource', service, region_name, from_session)
+
+
+def get_or_make(kind, service, region_name, from_session):
+    with clients_lock:
+        key = (kind, service, region_name, from_session)
+        if key not in clients:
+            make = getattr(from_session or get_session(), kind)
+            clients[key] = make(service, region_name=region_name, config=config)
+        return clients[key]
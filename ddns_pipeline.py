@@ -0,0 +1,415 @@
+################################################################################
+### Streaming sweep pipeline
+###
+### The batch sweeps as a chain of generators
+###   instances -> specs -> desired records -> diffs -> batches -> writes
+### each pulling from the one before it.  At any moment a sweep holds one
+### describe_instances page, one unfinished batch per zone and the batches
+### being written, never the whole estate.  When Route53 is slow the write
+### stage stops pulling, the stages before it stop with it and no more
+### pages get read: that's the back-pressure.
+### Everything an instance's records depend on travels in its spec, there's
+### no leftover name/function/zone from the instance before.
+###
+################################################################################
+
+import os
+import threading
+from collections import OrderedDict
+
+import ddns_clients
+import ddns_templates
+
+# where A records go for instances whose VPC doesn't say, and the root domain
+# for imednet-env CNAMEs, unless an instance's tags say otherwise
+default_zone = "aws.imednet.com"
+root_domain = "imednet.com"
+
+# Route53 limits on a single ChangeBatch
+max_batch_changes = 1000
+max_batch_chars = 32000
+
+ddns_comment = "Updated by Lambda DDNS"
+
+# the lambda's record settings, so a sweep writes what the lambda would:
+# DDNS_TTL & the ddns_ttl tag, DDNS_FUNCTION_ROUTING(cname, multivalue or
+# weighted, see union.py) and DDNS_FUNCTION_WEIGHT & the ddns_weight tag
+record_ttl = int(os.environ.get('DDNS_TTL', '60'))
+function_routing = os.environ.get('DDNS_FUNCTION_ROUTING', 'cname').lower()
+function_weight = int(os.environ.get('DDNS_FUNCTION_WEIGHT', '1'))
+
+# the lambda's numbered names(DDNS_NAME_TABLE, see union.claim_name_slot),
+# an instance in an auto scaling group or tagged override_name=use_slot gets
+# the name it was given there, and no records at all until it has one, so a
+# sweep never brings back the shared name its siblings fought over
+name_table = os.environ.get('DDNS_NAME_TABLE')
+name_instance_prefix = '~instance '
+
+
+def reverse_ip(ip_address):
+    """1.2.3.4 -> 4.3.2.1."""
+    octets = [octet for octet in ip_address.split('.') if octet]
+    octets.reverse()
+    return '.'.join(octets) + '.'
+
+
+def reverse_zone_name(subnet_mask, private_ip):
+    """The reverse lookup zone for an ip, from its subnet's mask."""
+    octets = private_ip.split('.')
+    if subnet_mask >= 24:
+        octets = octets[:3]
+    elif subnet_mask >= 16:
+        octets = octets[:2]
+    else:
+        octets = octets[:1]
+    return reverse_ip('.'.join(octets)) + 'in-addr.arpa.'
+
+
+def build_change(action, record_name, type, value, ttl=60):
+    if record_name[-1] != '.':
+        record_name = record_name + '.'
+    return {
+        "Action": action,
+        "ResourceRecordSet": {
+            "Name": record_name,
+            "Type": type,
+            "TTL": ttl,
+            "ResourceRecords": [{"Value": value}]
+        }
+    }
+
+
+def function_change(spec, action, record_name, target, ip_address):
+    """A function record, a CNAME to target or the instance's member(on
+    ip_address) of a multivalue/weighted A record set, see function_routing."""
+    if function_routing == 'cname':
+        return build_change(action, record_name, 'CNAME', target, spec['ttl'])
+    change = build_change(action, record_name, 'A', ip_address, spec['ttl'])
+    change['ResourceRecordSet']['SetIdentifier'] = spec['instance_id']
+    if function_routing == 'weighted':
+        change['ResourceRecordSet']['Weight'] = spec['weight']
+    else:
+        change['ResourceRecordSet']['MultiValueAnswer'] = True
+    return change
+
+
+def tag_number(tags, key, default):
+    """An integer tag, default if it's missing or isn't a number."""
+    if key not in tags:
+        return default
+    try:
+        return int(tags[key].strip())
+    except ValueError:
+        print('Ignoring %s tag %r, not a number, using %d' % (key, tags[key], default))
+        return default
+
+
+def load_name_slots(dynamodb=None):
+    """Instance id -> numbered name, from DDNS_NAME_TABLE's '~instance <id>'
+    items, None without a name table."""
+    if not name_table:
+        return None
+    dynamodb = dynamodb or ddns_clients.client('dynamodb')
+    name_slots = {}
+    kwargs = {'TableName': name_table}
+    while True:
+        page = dynamodb.scan(**kwargs)
+        for item in page['Items']:
+            if item['name_key']['S'].startswith(name_instance_prefix):
+                name_slots[item['name_key']['S'][len(name_instance_prefix):]] = item['slot_name']['S']
+        if not page.get('LastEvaluatedKey'):
+            return name_slots
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+#################################################################
+### Stages                                                   ####
+#################################################################
+
+def iter_instances(describe_instances, states=('stopped', 'running')):
+    """Yields instances one page at a time, describe_instances is called with the filters & NextToken."""
+    kwargs = {'Filters': [{'Name': 'instance-state-name', 'Values': list(states)}]}
+    while True:
+        page = describe_instances(**kwargs)
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                yield instance
+        if not page.get('NextToken'):
+            return
+        kwargs['NextToken'] = page['NextToken']
+
+
+def instance_spec(instance, default_zone, root_domain, name_slots=None):
+    """Everything the records of one instance(a describe_instances dict) depend on,
+    None for a numbered one that has no number(see load_name_slots)."""
+    tags = dict((t['Key'], t['Value'].lstrip().lower()) for t in instance.get('Tags', []))
+    name = tags.get('Name')
+    if tags.get('override_name') == 'use_instance_id':
+        name = instance['InstanceId']
+    elif name_slots is not None and ('aws:autoscaling:groupName' in tags or tags.get('override_name') == 'use_slot'):
+        if instance['InstanceId'] not in name_slots:
+            print('Skipping %s, it has no numbered name yet' % instance['InstanceId'])
+            return None
+        name = name_slots[instance['InstanceId']]
+    override_zone = tags.get('override_zone')
+    target_env = tags.get('imednet-env')
+    function = tags.get('function')
+    instance_root_domain = tags.get('root_domain', root_domain)
+
+    if override_zone:
+        instance_zone = override_zone
+        vmzone = override_zone
+    elif target_env:
+        instance_zone = default_zone
+        vmzone = "%s.%s" % (target_env, instance_root_domain)
+    else:
+        instance_zone = default_zone
+        vmzone = default_zone
+
+    if name:
+        name = name.split('.')[0].split(' ')[0]
+    if not name:
+        name = instance['InstanceId']
+
+    return {
+        'instance_id': instance['InstanceId'],
+        'tags': tags,
+        'name': name,
+        'default_zone': instance_zone,
+        'vmzone': vmzone,
+        'root_domain': instance_root_domain,
+        'target_env': target_env,
+        'functions': (function or name).split(' '),
+        'action': 'UPSERT' if instance['State']['Name'] == 'running' else 'DELETE',
+        'private_ip': instance.get('PrivateIpAddress'),
+        'public_ip': instance.get('PublicIpAddress'),
+        'private_dns_name': instance.get('PrivateDnsName'),
+        'public_dns_name': instance.get('PublicDnsName'),
+        'subnet_id': instance.get('SubnetId'),
+        'ttl': tag_number(tags, 'ddns_ttl', record_ttl),
+        'weight': tag_number(tags, 'ddns_weight', function_weight),
+    }
+
+
+def parse_specs(instances, default_zone, root_domain, name_slots=None):
+    for instance in instances:
+        spec = instance_spec(instance, default_zone, root_domain, name_slots)
+        if spec is not None:
+            yield spec
+
+
+def spec_changes(spec, subnet_masks, zone_ids, templates=None):
+    """Works out the (zone_id, change) pairs for one spec, from compiled templates if given."""
+    action = spec['action']
+    private_ip = spec['private_ip']
+    public_ip = spec['public_ip']
+    changes = []
+    if not private_ip:
+        return changes
+
+    subnet_mask = subnet_masks.get(spec['subnet_id'])
+    reverse_zone = reverse_zone_name(subnet_mask, private_ip) if subnet_mask else None
+    a_name = "%s.%s" % (spec['name'], spec['default_zone'])
+
+    if templates:
+        values = ddns_templates.instance_variables(spec['tags'],
+            name=spec['name'], instance_id=spec['instance_id'], default_zone=spec['default_zone'],
+            vmzone=spec['vmzone'], root_domain=spec['root_domain'], target_env=spec['target_env'],
+            reverse_zone=reverse_zone, reversed_ip=reverse_ip(private_ip), private_ip=private_ip,
+            public_ip=public_ip, private_dns_name=spec['private_dns_name'],
+            public_dns_name=spec['public_dns_name'], function=' '.join(spec['functions']))
+        for zone_name, type, record_name, value, ip_address in ddns_templates.render(templates, values):
+            zone_id = zone_ids.get(zone_name.rstrip('.') + '.')
+            if not zone_id or value is None or not record_name.strip('.'):
+                continue
+            if type == 'function':
+                changes.append((zone_id, function_change(spec, action, record_name, value, ip_address)))
+            else:
+                changes.append((zone_id, build_change(action, record_name, type, value, spec['ttl'])))
+        return changes
+
+    default_zone_id = zone_ids.get(spec['default_zone'] + '.')
+    zone_id = zone_ids.get(spec['vmzone'] + '.')
+    if default_zone_id:
+        changes.append((default_zone_id, build_change(action, a_name, 'A', public_ip or private_ip, spec['ttl'])))
+    if zone_id:
+        for fun in spec['functions']:
+            target = spec['public_dns_name'] if public_ip else a_name
+            changes.append((zone_id, function_change(spec, action, "%s.%s" % (fun, spec['vmzone']), target, public_ip or private_ip)))
+
+    if reverse_zone:
+        reverse_zone_id = zone_ids.get(reverse_zone)
+        if reverse_zone_id:
+            ptr_name = reverse_ip(private_ip) + 'in-addr.arpa'
+            changes.append((reverse_zone_id, build_change(action, ptr_name, 'PTR', a_name, spec['ttl'])))
+        else:
+            print('No reverse lookup zone for %s, skipping PTR' % spec['instance_id'])
+    return changes
+
+
+def desired_records(specs, subnet_masks, zone_ids, templates=None):
+    for spec in specs:
+        for zone_id, change in spec_changes(spec, subnet_masks, zone_ids, templates):
+            yield zone_id, change
+
+
+def record_key(record_set):
+    return (record_set['Name'], record_set['Type'], record_set.get('SetIdentifier'))
+
+
+def record_value(record_set):
+    return (record_set.get('TTL'), record_set.get('Weight'),
+            tuple(sorted(r['Value'] for r in record_set.get('ResourceRecords', []))))
+
+
+def diff_changes(changes, record_cache):
+    """Drops UPSERTs of what a zone already has and DELETEs of what it doesn't.
+
+    record_cache is a ddns_records.RecordCache, each zone is warmed(read in
+    one pass) the first time it comes up.
+    """
+    warmed = set()
+    for zone_id, change in changes:
+        if zone_id not in warmed:
+            record_cache.warm_zone(zone_id)
+            warmed.add(zone_id)
+        record_set = change['ResourceRecordSet']
+        current = record_cache.get(zone_id, record_set['Name'], record_set['Type'], record_set.get('SetIdentifier'))
+        if current is not None:
+            current = record_value(current)
+        wanted = record_value(record_set)
+        if change['Action'] == 'DELETE' and current != wanted:
+            continue
+        if change['Action'] != 'DELETE' and current == wanted:
+            continue
+        yield zone_id, change
+
+
+def batch_changes(changes, max_pending=10000):
+    """Collects changes into ChangeBatch sized lists per zone, yielding (zone_id, changes)
+    as soon as a zone's batch is full, and the partly full ones at the end.
+    A batch can't touch the same record set twice, the later change wins.
+    With more than max_pending changes held across all zones(lots of small
+    reverse zones) the biggest batch goes out early, to keep memory flat."""
+    pending = OrderedDict()
+    sizes = {}
+    held = 0
+    for zone_id, change in changes:
+        batch = pending.setdefault(zone_id, OrderedDict())
+        size = sum(len(r['Value']) for r in change['ResourceRecordSet']['ResourceRecords'])
+        key = record_key(change['ResourceRecordSet'])
+        if key not in batch and (len(batch) == max_batch_changes or sizes.get(zone_id, 0) + size > max_batch_chars):
+            held = held - len(batch)
+            yield zone_id, list(batch.values())
+            batch = pending[zone_id] = OrderedDict()
+            sizes[zone_id] = 0
+        if key not in batch:
+            held = held + 1
+        batch[key] = change
+        sizes[zone_id] = sizes.get(zone_id, 0) + size
+        if held > max_pending:
+            biggest = max(pending, key=lambda z: len(pending[z]))
+            held = held - len(pending[biggest])
+            yield biggest, list(pending.pop(biggest).values())
+            sizes[biggest] = 0
+    for zone_id, batch in pending.items():
+        if batch:
+            yield zone_id, list(batch.values())
+
+
+def send_batch(send, zone_id, changes):
+    """Calls send(zone_id, changes) with the whole batch, then once per change
+    if Route53 turns it down.  Returns what the sends that went through returned."""
+    try:
+        return [send(zone_id, changes)]
+    except BaseException as e:
+        # one bad change(e.g. deleting a record that's already gone) sinks the whole batch
+        print(e)
+    results = []
+    for change in changes:
+        try:
+            results.append(send(zone_id, [change]))
+        except BaseException as e:
+            print(e)
+    return results
+
+
+def write_batch(route53, zone_id, changes):
+    """Sends one batch, falling back to one change at a time if Route53 turns it down."""
+    print('Submitting %d changes to zone %s' % (len(changes), zone_id))
+    return send_batch(lambda zone_id, changes: route53.change_resource_record_sets(HostedZoneId=zone_id,
+        ChangeBatch={"Comment": ddns_comment, "Changes": changes}), zone_id, changes)
+
+
+def write_batches(batches, submit, pool=None, max_in_flight=4):
+    """Hands every batch to submit(zone_id, changes).  With a thread pool up to
+    max_in_flight batches are written at once, and pulling the next batch waits
+    for a free slot.  A zone's batches are written one after another, in order,
+    so where two batches touch the same record the later one wins.
+    Returns the number of batches written."""
+    count = 0
+    if pool is None:
+        for zone_id, changes in batches:
+            submit(zone_id, changes)
+            count = count + 1
+        return count
+
+    slots = threading.BoundedSemaphore(max_in_flight)
+    in_flight = {}
+
+    def write(zone_id, changes):
+        try:
+            submit(zone_id, changes)
+        finally:
+            slots.release()
+
+    for zone_id, changes in batches:
+        if zone_id in in_flight:
+            in_flight.pop(zone_id).get()
+        slots.acquire()
+        in_flight[zone_id] = pool.apply_async(write, (zone_id, changes))
+        count = count + 1
+        # let go of the writes that are done(raising if one failed), so the dict stays small
+        for done in [z for z, result in in_flight.items() if result.ready()]:
+            in_flight.pop(done).get()
+    for result in in_flight.values():
+        result.get()
+    return count
+
+
+#################################################################
+### Sweeps                                                   ####
+#################################################################
+
+def list_zone_ids(route53):
+    """Zone name -> zone id, private zones win over public ones with the same name."""
+    zone_ids = {}
+    zones = []
+    for page in route53.get_paginator('list_hosted_zones').paginate():
+        zones.extend(page['HostedZones'])
+    for zone in sorted(zones, key=lambda z: z.get('Config', {}).get('PrivateZone', False)):
+        zone_ids[zone['Name']] = zone['Id'].split('/')[-1]
+    return zone_ids
+
+
+def list_subnet_masks(compute):
+    """Subnet id -> mask, e.g. 24 for a /24."""
+    subnet_masks = {}
+    for page in compute.get_paginator('describe_subnets').paginate():
+        for subnet in page['Subnets']:
+            subnet_masks[subnet['SubnetId']] = int(subnet['CidrBlock'].split('/')[-1])
+    return subnet_masks
+
+
+def sweep(states, route53=None, compute=None):
+    """Reconciles the records of every instance in one of states, one batch at
+    a time, the update-dns-entries-for-*-instances.py scripts are this.
+    Returns the number of batches sent."""
+    route53 = route53 or ddns_clients.client('route53')
+    compute = compute or ddns_clients.client('ec2')
+    zone_ids = list_zone_ids(route53)
+    subnet_masks = list_subnet_masks(compute)
+    specs = parse_specs(iter_instances(compute.describe_instances, states), default_zone, root_domain,
+                        load_name_slots())
+    batches = batch_changes(desired_records(specs, subnet_masks, zone_ids))
+    return write_batches(batches, lambda zone_id, changes: write_batch(route53, zone_id, changes))
@@ -0,0 +1,124 @@
+################################################################################
+### Record set cache for the DDNS scripts
+###
+### Finding out what a zone holds for a name(the -public records on stop,
+### the current value of a record we're about to UPSERT) used to mean a dns
+### lookup or a walk through the whole zone.  RecordCache reads just the name
+### it's asked about, with a list_resource_record_sets range read starting
+### at that name(StartRecordName/StartRecordType), and keeps every record set
+### at that name, whatever the type, so the next question about it is free.
+###   - entries are kept per (zone, name), least recently used ones go first
+###     once there are more than max_names
+###   - entries are trusted for ttl seconds, someone else may change the zone
+###   - invalidate() drops the names a ChangeBatch of ours touched
+###   - warm_zone() reads a whole zone in one paginated pass, for the bulk
+###     tools, after which names the zone doesn't have cost nothing either
+###
+################################################################################
+
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_name(name):
+    """Lower case a dns name and make sure it ends with a dot."""
+    name = name.lower()
+    if name[-1] != '.':
+        name = name + '.'
+    return name
+
+
+class RecordCache(object):
+    """LRU cache of record sets, keyed by (zone_id, name)."""
+
+    def __init__(self, route53, max_names=1024, ttl=60, page_size=20):
+        self.route53 = route53
+        # None for no limit, e.g. a sweep that warms whole zones
+        self.max_names = max_names
+        self.ttl = ttl
+        self.page_size = page_size
+        self.entries = OrderedDict()
+        # zone_id -> when warm_zone read it, for as long as every name is still here
+        self.complete_zones = {}
+        self.lock = threading.Lock()
+        self.reads = 0
+
+    def get(self, zone_id, name, type, set_identifier=None):
+        """Returns the record set for name & type(& set identifier), None if there isn't one."""
+        for record_set in self.record_sets(zone_id, name):
+            if record_set['Type'] == type and record_set.get('SetIdentifier') == set_identifier:
+                return record_set
+        return None
+
+    def record_sets(self, zone_id, name):
+        """Every record set the zone has at name, read from Route53 unless we have it."""
+        key = (zone_id, normalize_name(name))
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and now - entry[1] < self.ttl:
+                self.entries.pop(key)
+                self.entries[key] = entry
+                return entry[0]
+            if not entry and now - self.complete_zones.get(zone_id, 0) < self.ttl:
+                return []
+        record_sets = self.read_name(zone_id, key[1])
+        self.store(zone_id, key[1], record_sets, now)
+        return record_sets
+
+    def read_name(self, zone_id, name):
+        """Range read of the record sets at name, Route53 lists a name's types together."""
+        record_sets = []
+        kwargs = {'HostedZoneId': zone_id, 'StartRecordName': name, 'MaxItems': str(self.page_size)}
+        while True:
+            self.reads += 1
+            page = self.route53.list_resource_record_sets(**kwargs)
+            for record_set in page['ResourceRecordSets']:
+                if normalize_name(record_set['Name']) != name:
+                    return record_sets
+                record_sets.append(record_set)
+            # a name with lots of weighted/multivalue members goes on to another page
+            if not page.get('IsTruncated') or normalize_name(page.get('NextRecordName', '.')) != name:
+                return record_sets
+            kwargs['StartRecordName'] = page['NextRecordName']
+            kwargs['StartRecordType'] = page['NextRecordType']
+            if page.get('NextRecordIdentifier'):
+                kwargs['StartRecordIdentifier'] = page['NextRecordIdentifier']
+
+    def store(self, zone_id, name, record_sets, loaded):
+        with self.lock:
+            self.entries.pop((zone_id, name), None)
+            self.entries[(zone_id, name)] = (record_sets, loaded)
+            while self.max_names is not None and len(self.entries) > self.max_names:
+                (evicted_zone, evicted_name), entry = self.entries.popitem(last=False)
+                self.complete_zones.pop(evicted_zone, None)
+
+    def warm_zone(self, zone_id):
+        """Reads every record set in a zone in one pass."""
+        now = time.time()
+        names = OrderedDict()
+        for page in self.route53.get_paginator('list_resource_record_sets').paginate(HostedZoneId=zone_id):
+            self.reads += 1
+            for record_set in page['ResourceRecordSets']:
+                names.setdefault(normalize_name(record_set['Name']), []).append(record_set)
+        for name, record_sets in names.items():
+            self.store(zone_id, name, record_sets, now)
+        with self.lock:
+            if self.max_names is None or len(names) <= self.max_names:
+                self.complete_zones[zone_id] = now
+        return len(names)
+
+    def invalidate(self, zone_id, changes):
+        """Forgets the names a ChangeBatch touched, whether or not it went through."""
+        with self.lock:
+            for change in changes:
+                name = normalize_name(change['ResourceRecordSet']['Name'])
+                self.entries.pop((zone_id, name), None)
+            # a name we no longer have doesn't mean the zone doesn't have it
+            self.complete_zones.pop(zone_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.complete_zones.clear()
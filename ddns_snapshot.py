@@ -0,0 +1,283 @@
+################################################################################
+### Snapshot format for the DDNS caches
+###
+### union.py keeps a few caches(zone name -> id, VPC -> domain, subnet -> mask,
+### zone/VPC associations) and the records it wrote for each instance.
+### This module packs all of that into one compact blob that loads in
+### milliseconds on a 128 MB lambda, even for a 50k instance estate.
+###
+### Layout(all integers little endian)
+###   magic     4 bytes  'DDNS'
+###   version   1 byte
+###   sections  2 bytes  number of sections
+###   then per section: name(8 bytes, space padded), offset(4), length(4),
+###                     flags(1 byte, 1 = zlib compressed)
+###   then the sections themselves
+###
+### Every string lives once in the 'strings' section(utf-8, back to back,
+### with their start offsets in 'offsets'), the other sections are flat arrays
+### of unsigned 32 bit ints that point into it.  A record values are stored as
+### packed IPv4 ints instead of strings.
+### The small cache sections are zlib compressed on their own and decompressed
+### when first used.  The sections an instance lookup walks(strings, offsets,
+### index and records) can be stored as they are instead: open_snapshot()
+### memory maps a file on disk, the per-instance records are found with a
+### binary search and ints and strings are unpacked in place, so looking up
+### one instance only reads the pages that search lands on, not the other
+### 49,999.  Compressed, the first lookup decompresses the whole section,
+### which is what a snapshot kept in DynamoDB(in memory anyway) does.
+### Version 1 snapshots compressed every section and had no flags.
+###
+################################################################################
+
+import mmap
+import socket
+import struct
+import zlib
+
+snapshot_magic = b'DDNS'
+snapshot_version = 2
+
+# the sections instance_records() reads, left uncompressed when in_place
+in_place_sections = ('strings', 'offsets', 'index', 'records')
+compressed_flag = 1
+
+# stands in for None(no set identifier, no weight) in the int arrays
+no_value = 0xFFFFFFFF
+
+header_format = '<4sBH'
+section_format = '<8sIIB'
+# version 1 had no flags and compressed everything
+section_format_v1 = '<8sII'
+
+# a record is (zone_id, type, name, value, ttl, set_identifier, weight)
+# the same fields the ownership TXT records carry
+record_fields = 7
+
+
+def pack_ip(ip_address):
+    return struct.unpack('!I', socket.inet_aton(ip_address))[0]
+
+
+def unpack_ip(number):
+    return socket.inet_ntoa(struct.pack('!I', number))
+
+
+def pack_ints(numbers):
+    return struct.pack('<%dI' % len(numbers), *numbers)
+
+
+class StringTable(object):
+    """Interns strings while a snapshot is being built."""
+
+    def __init__(self):
+        self.strings = []
+        self.index = {}
+
+    def add(self, value):
+        if value is None:
+            return no_value
+        if value not in self.index:
+            self.index[value] = len(self.strings)
+            self.strings.append(value)
+        return self.index[value]
+
+
+def encode_snapshot(zones, vpc_domains=None, subnet_masks=None, associations=None,
+                    loaded_associations=None, instance_records=None, in_place=False):
+    """Packs the caches into a snapshot and returns it as bytes.
+
+    zones is zone name -> zone id, vpc_domains VPC id -> domain, subnet_masks
+    subnet id -> mask, associations a set of (zone id, VPC id) pairs,
+    loaded_associations the VPC/zone ids whose associations are complete and
+    instance_records instance id -> list of record tuples(see record_fields).
+    in_place leaves the sections instance lookups read uncompressed, for
+    snapshots that get memory mapped.
+    """
+    strings = StringTable()
+    sections = []
+
+    def pairs(mapping):
+        numbers = []
+        for key, value in sorted((mapping or {}).items()):
+            numbers.append(strings.add(key))
+            numbers.append(strings.add(value))
+        return numbers
+
+    sections.append(('zones', pairs(zones)))
+    sections.append(('vpcs', pairs(vpc_domains)))
+
+    numbers = []
+    for subnet_id, mask in sorted((subnet_masks or {}).items()):
+        numbers.append(strings.add(subnet_id))
+        numbers.append(mask)
+    sections.append(('subnets', numbers))
+
+    numbers = []
+    for zone_id, vpc_id in sorted(associations or []):
+        numbers.append(strings.add(zone_id))
+        numbers.append(strings.add(vpc_id))
+    sections.append(('assoc', numbers))
+    sections.append(('loaded', [strings.add(x) for x in sorted(loaded_associations or [])]))
+
+    # instances are kept sorted by id so a lookup can binary search them
+    # the index holds (instance id, first record, record count)
+    index = []
+    records = []
+    for instance_id, instance_records_list in sorted((instance_records or {}).items()):
+        index.extend([strings.add(instance_id), len(records) // record_fields, len(instance_records_list)])
+        for zone_id, type, name, value, ttl, set_identifier, weight in instance_records_list:
+            records.extend([
+                strings.add(zone_id),
+                strings.add(type),
+                strings.add(name),
+                pack_ip(value) if type == 'A' else strings.add(value),
+                ttl,
+                strings.add(set_identifier),
+                no_value if weight is None else weight,
+            ])
+    sections.append(('index', index))
+    sections.append(('records', records))
+
+    encoded = [value.encode('utf-8') for value in strings.strings]
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    blobs = [('strings', b''.join(encoded)), ('offsets', pack_ints(offsets))]
+    blobs.extend((name, pack_ints(numbers)) for name, numbers in sections)
+    blobs = [(name, blob, 0) if in_place and name in in_place_sections else (name, zlib.compress(blob), compressed_flag)
+             for name, blob in blobs]
+
+    header_size = struct.calcsize(header_format) + len(blobs) * struct.calcsize(section_format)
+    header = [struct.pack(header_format, snapshot_magic, snapshot_version, len(blobs))]
+    offset = header_size
+    for name, blob, flags in blobs:
+        header.append(struct.pack(section_format, name.encode('ascii').ljust(8), offset, len(blob), flags))
+        offset = offset + len(blob)
+    return b''.join(header + [blob for name, blob, flags in blobs])
+
+
+def is_snapshot(data):
+    return data[:len(snapshot_magic)] == snapshot_magic
+
+
+class Snapshot(object):
+    """Read side of a snapshot, sections get decoded the first time they are used."""
+
+    def __init__(self, data):
+        magic, version, count = struct.unpack_from(header_format, data, 0)
+        if magic != snapshot_magic:
+            raise ValueError('not a DDNS snapshot')
+        if version not in (1, snapshot_version):
+            raise ValueError('unsupported DDNS snapshot version %d' % version)
+        self.data = data
+        self.sections = {}
+        position = struct.calcsize(header_format)
+        for i in range(count):
+            if version == 1:
+                name, offset, length = struct.unpack_from(section_format_v1, data, position)
+                flags = compressed_flag
+                position = position + struct.calcsize(section_format_v1)
+            else:
+                name, offset, length, flags = struct.unpack_from(section_format, data, position)
+                position = position + struct.calcsize(section_format)
+            self.sections[name.decode('ascii').strip()] = (offset, length, flags)
+        self.decoded = {}
+
+    def raw(self, name):
+        """Returns the bytes holding a section and where in them it starts,
+        uncompressed sections are read in place, straight from the mapping."""
+        offset, length, flags = self.sections[name]
+        if not flags & compressed_flag:
+            return self.data, offset
+        if name not in self.decoded:
+            self.decoded[name] = zlib.decompress(self.data[offset:offset + length])
+        return self.decoded[name], 0
+
+    def size(self, name):
+        """Uncompressed length of a section in bytes."""
+        offset, length, flags = self.sections[name]
+        if not flags & compressed_flag:
+            return length
+        return len(self.raw(name)[0])
+
+    def ints(self, name, start=0, count=None):
+        """Unpacks count ints from a section, starting at int number start."""
+        raw, base = self.raw(name)
+        if count is None:
+            count = self.size(name) // 4 - start
+        return struct.unpack_from('<%dI' % count, raw, base + start * 4)
+
+    def string(self, number):
+        if number == no_value:
+            return None
+        start, end = self.ints('offsets', number, 2)
+        raw, base = self.raw('strings')
+        return raw[base + start:base + end].decode('utf-8')
+
+    def strings(self, numbers):
+        return [self.string(number) for number in numbers]
+
+    def pairs(self, name):
+        values = self.strings(self.ints(name))
+        return dict(zip(values[0::2], values[1::2]))
+
+    def zones(self):
+        return self.pairs('zones')
+
+    def vpc_domains(self):
+        return self.pairs('vpcs')
+
+    def subnet_masks(self):
+        numbers = self.ints('subnets')
+        return dict(zip(self.strings(numbers[0::2]), numbers[1::2]))
+
+    def associations(self):
+        values = self.strings(self.ints('assoc'))
+        return set(zip(values[0::2], values[1::2]))
+
+    def loaded_associations(self):
+        return set(self.strings(self.ints('loaded')))
+
+    def instance_count(self):
+        return self.size('index') // 12
+
+    def instance_ids(self):
+        return self.strings(self.ints('index')[0::3])
+
+    def instance_records(self, instance_id):
+        """Returns the record tuples stored for an instance, None if it isn't in the snapshot."""
+        # binary search the sorted index, one string at a time
+        low, high = 0, self.instance_count()
+        while low < high:
+            middle = (low + high) // 2
+            if self.string(self.ints('index', middle * 3, 1)[0]) < instance_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.instance_count():
+            return None
+        key, first, count = self.ints('index', low * 3, 3)
+        if self.string(key) != instance_id:
+            return None
+        records = self.ints('records', first * record_fields, count * record_fields)
+        results = []
+        for i in range(0, len(records), record_fields):
+            zone_id, type, name, value, ttl, set_identifier, weight = records[i:i + record_fields]
+            type = self.string(type)
+            results.append((
+                self.string(zone_id),
+                type,
+                self.string(name),
+                unpack_ip(value) if type == 'A' else self.string(value),
+                ttl,
+                self.string(set_identifier),
+                None if weight == no_value else weight,
+            ))
+        return results
+
+
+def open_snapshot(path):
+    """Memory maps a snapshot file, only the pages we touch get read."""
+    with open(path, 'rb') as f:
+        return Snapshot(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
@@ -0,0 +1,156 @@
+################################################################################
+### Record templates for the DDNS scripts
+###
+### Instead of the naming rules hard-coded in union.py, the records an
+### instance gets can be described as a list of templates(json), e.g.
+###   [{"zone": "{default_zone}", "name": "{name}.{default_zone}",
+###     "type": "A", "value": "{private_ip}"},
+###    {"zone": "{vmzone}", "name": "{function}.{vmzone}", "type": "function",
+###     "value": "{name}.{default_zone}", "ip": "{private_ip}", "each": "function"}]
+###
+###   zone   the hosted zone the record goes in
+###   name   the full record name
+###   type   A, CNAME, PTR, TXT..., or function, which follows
+###          DDNS_FUNCTION_ROUTING(CNAME to value, or an A record on ip
+###          that's one member of a shared set)
+###   value  the record's value
+###   ip     function records only, the ip for multivalue/weighted routing
+###   each   repeat the template for every space separated value of this
+###          variable(function), with the variable set to one value at a time
+###   when   only if this variable isn't empty(e.g. public_ip), on a delete
+###          an empty one means the record gets read back and deleted as is
+###
+### Variables are name, instance_id, default_zone, vmzone, root_domain,
+### target_env, reverse_zone, reversed_ip(1.0.0.10.), private_ip, public_ip,
+### private_dns_name, public_dns_name, function, plus every tag as
+### tag_<key> with anything but letters, digits & _ turned into _
+### (tag_aws_autoscaling_groupName)
+###
+### A document is compiled once: every template string is parsed, checked
+### against the variables above and kept as a ready to call formatter, so
+### rendering thousands of instances is only the formatting itself.
+### Documents come from the json itself, s3://bucket/key or ssm:/parameter
+###
+################################################################################
+
+import json
+import re
+import string
+import threading
+import time
+
+import ddns_clients
+
+# the rules union.py has always used
+default_templates = [
+    {"zone": "{default_zone}", "name": "{name}.{default_zone}", "type": "A", "value": "{private_ip}"},
+    {"zone": "{default_zone}", "name": "{name}-public.{default_zone}", "type": "A", "value": "{public_ip}",
+     "when": "public_ip"},
+    {"zone": "{reverse_zone}", "name": "{reversed_ip}in-addr.arpa", "type": "PTR", "value": "{name}.{default_zone}"},
+    {"zone": "{vmzone}", "name": "{function}.{vmzone}", "type": "function", "value": "{name}.{default_zone}",
+     "ip": "{private_ip}", "each": "function"},
+    {"zone": "{vmzone}", "name": "{function}-public.{vmzone}", "type": "function", "value": "{public_dns_name}",
+     "ip": "{public_ip}", "each": "function", "when": "public_ip"},
+]
+
+variables = set(['name', 'instance_id', 'default_zone', 'vmzone', 'root_domain', 'target_env', 'reverse_zone',
+                 'reversed_ip', 'private_ip', 'public_ip', 'private_dns_name', 'public_dns_name', 'function'])
+
+template_fields = ['zone', 'name', 'value', 'ip']
+
+# seconds an s3/ssm document is used before we look for a new one
+document_ttl = 60
+
+documents = {}
+compiled_documents = {}
+documents_lock = threading.Lock()
+
+
+def tag_variable(key):
+    return 'tag_' + re.sub('[^A-Za-z0-9_]', '_', key)
+
+
+def compile_string(template):
+    """Checks a template string's variables and returns a formatter for it,
+    a function of the variables dict.  Variables that aren't set(a tag the
+    instance doesn't have) format as ''."""
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        if field is not None and field not in variables and not field.startswith('tag_'):
+            raise ValueError('unknown variable {%s} in template %s' % (field, template))
+        parts.append((literal, field, spec))
+
+    def formatter(values):
+        return ''.join(literal + (format(values.get(field, ''), spec) if field is not None else '')
+                       for literal, field, spec in parts)
+    return formatter
+
+
+def compile_templates(templates):
+    """Turns a list of templates into a list of compiled ones."""
+    compiled = []
+    for template in templates:
+        missing = [field for field in ('zone', 'name', 'type', 'value') if field not in template]
+        if missing:
+            raise ValueError('template %s is missing %s' % (json.dumps(template), ', '.join(missing)))
+        if template['type'] == 'function' and 'ip' not in template:
+            raise ValueError('function template %s needs an ip' % json.dumps(template))
+        for field in ('each', 'when'):
+            if field in template and template[field] not in variables and not template[field].startswith('tag_'):
+                raise ValueError('unknown variable %s in template %s' % (template[field], json.dumps(template)))
+        entry = {'type': template['type'], 'each': template.get('each'), 'when': template.get('when')}
+        for field in template_fields:
+            entry[field] = compile_string(template[field]) if field in template else None
+        compiled.append(entry)
+    return compiled
+
+
+def load_document(source):
+    """Reads a template document from json, s3://bucket/key or ssm:/parameter."""
+    if source.startswith('s3://'):
+        bucket, key = source[len('s3://'):].split('/', 1)
+        return ddns_clients.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+    if source.startswith('ssm:'):
+        return ddns_clients.client('ssm').get_parameter(Name=source[len('ssm:'):])['Parameter']['Value']
+    return source
+
+
+def get_templates(source=None):
+    """Returns the compiled templates for source(the defaults without one).
+    Documents are compiled once and s3/ssm ones re-read every document_ttl seconds."""
+    if not source:
+        source = json.dumps(default_templates)
+    with documents_lock:
+        text, loaded = documents.get(source, (None, 0))
+        if text is None or (source != text and time.time() - loaded > document_ttl):
+            text = load_document(source)
+            documents[source] = (text, time.time())
+        if text not in compiled_documents:
+            compiled_documents[text] = compile_templates(json.loads(text))
+        return compiled_documents[text]
+
+
+def instance_variables(tags, **values):
+    """The variables for one instance, values plus its tags as tag_<key>."""
+    result = dict((tag_variable(key), value) for key, value in tags.items())
+    for key, value in values.items():
+        result[key] = value or ''
+    return result
+
+
+def render(templates, values):
+    """Yields (zone, type, name, value, ip) for every record the templates describe.
+    value and ip are None for a when template whose variable is empty."""
+    for template in templates:
+        if template['each']:
+            each = [dict(values, **{template['each']: item}) for item in values.get(template['each'], '').split(' ') if item]
+        else:
+            each = [values]
+        for item_values in each:
+            zone = template['zone'](item_values)
+            name = template['name'](item_values)
+            if template['when'] and not item_values.get(template['when']):
+                yield zone, template['type'], name, None, None
+                continue
+            ip = template['ip'](item_values) if template['ip'] else None
+            yield zone, template['type'], name, template['value'](item_values), ip
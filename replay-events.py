@@ -0,0 +1,789 @@
+################################################################################
+### Replay recorded EC2 state-change events against union.lambda_handler
+###
+### Runs the real handler against a local fake of Route53, EC2, DynamoDB
+### and S3, so we can load test it without touching AWS.
+### Each worker loads its own copy of union.py, the same way each concurrent
+### lambda container has its own caches, and they all share one fake account
+### with Route53's 5 requests/second limit.
+###
+### The events file holds one event per line(or one json list) in the shape
+### the lambda gets from EventBridge
+###   {"detail": {"instance-id": "i-0abc", "state": "running"},
+###    "region": "us-east-1", "time": "2016-07-08T18:59:54Z"}
+### events are replayed on their original timeline, sped up by --speed
+###
+### Usage
+###   python replay-events.py events.json --workers 50 --speed 10
+###   python replay-events.py --generate 2000 --spread 60 --workers 200
+###       (an AZ failover, 2000 instances stop while 2000 new ones start)
+###
+### Instances the events mention are made up on the fly(one /24 subnet per
+### 256 instances), or taken from --inventory, a json object of
+###   instance id -> {"tags": {...}, "private_ip": ..., "public_ip": ...,
+###                   "subnet_id": ..., "cidr_block": ..., "vpc_id": ...,
+###                   "eip": true for a public_ip that's an Elastic IP}
+###
+### With DDNS_DEFER_TABLE set, whatever union.py deferred is drained at the
+### end by playing its scheduled rule every DDNS_DEFER_COOLDOWN seconds.
+###
+### The fake DynamoDB does the conditional writes union.py relies on(the
+### coalescer's zone locks, name slots, ip pointers), so DDNS_COALESCE_TABLE
+### can be replayed too.
+###
+################################################################################
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from io import BytesIO
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from botocore.exceptions import ClientError
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+import ddns_clients
+
+
+#################################################################
+### The fake backend                                         ####
+#################################################################
+
+class Throttle(object):
+    """Token bucket, rate requests a second."""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class Stats(object):
+    """API call counters, per event(thread local) and overall."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.calls = {}
+        self.throttles = {}
+
+    def start_event(self):
+        self.local.calls = 0
+        self.local.first_write = None
+
+    def event_calls(self):
+        return getattr(self.local, 'calls', 0)
+
+    def write(self):
+        if getattr(self.local, 'first_write', None) is None:
+            self.local.first_write = time.time()
+
+    def first_write(self):
+        """When the event's first ChangeBatch went through, None if it wrote nothing."""
+        return getattr(self.local, 'first_write', None)
+
+    def call(self, name):
+        self.local.calls = getattr(self.local, 'calls', 0) + 1
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def throttle(self, name):
+        with self.lock:
+            self.throttles[name] = self.throttles.get(name, 0) + 1
+
+
+def client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message or code}}, operation)
+
+
+def normalize_name(name):
+    name = name.lower()
+    if name[-1] != '.':
+        name = name + '.'
+    return name
+
+
+class FakeEvents(object):
+    """client.meta.events, call() does its own retries so there's nothing to hook."""
+
+    def register(self, event_name, handler):
+        pass
+
+
+class FakeMeta(object):
+
+    def __init__(self):
+        self.events = FakeEvents()
+
+
+class FakeService(object):
+    """Common bits, every API call goes through call()."""
+
+    def __init__(self, backend, service, throttle):
+        self.backend = backend
+        self.service = service
+        self.throttle = throttle
+        self.meta = FakeMeta()
+
+    def call(self, operation):
+        # botocore retries throttled calls on its own, 5 attempts with
+        # exponential backoff, so the handler only sees the ones that run out
+        name = '%s.%s' % (self.service, operation)
+        for attempt in range(5):
+            self.backend.stats.call(name)
+            if self.backend.latency:
+                time.sleep(self.backend.latency)
+            if not self.throttle or self.throttle.take():
+                return
+            self.backend.stats.throttle(name)
+            time.sleep(random.random() * (2 ** attempt) * 0.05)
+        raise client_error('Throttling', operation, 'Rate exceeded')
+
+    def get_paginator(self, operation):
+        service = self
+
+        class Paginator(object):
+            def paginate(self, **kwargs):
+                return [getattr(service, operation)(**kwargs)]
+        return Paginator()
+
+
+class FakeExceptions(object):
+    pass
+
+
+class FakeRoute53(FakeService):
+
+    def __init__(self, backend, rate):
+        FakeService.__init__(self, backend, 'route53', Throttle(rate))
+        self.exceptions = FakeExceptions()
+        for name in ('HostedZoneAlreadyExists', 'ConflictingDomainExists'):
+            setattr(self.exceptions, name, type(name, (ClientError,), {}))
+        self.zones = OrderedDict()
+        self.caller_references = {}
+        self.changes = {}
+        self.lock = threading.Lock()
+
+    def add_zone(self, name, private=True, vpc_id=None, comment=''):
+        zone_id = 'ZREPLAY%d' % (len(self.zones) + 1)
+        self.zones[zone_id] = {
+            'Id': '/hostedzone/' + zone_id,
+            'Name': normalize_name(name),
+            'Config': {'PrivateZone': private, 'Comment': comment},
+            'vpcs': set([vpc_id]) if vpc_id else set(),
+            'records': {},
+        }
+        return zone_id
+
+    def zone(self, zone_id, operation):
+        zone_id = zone_id.split('/')[-1]
+        if zone_id not in self.zones:
+            raise client_error('NoSuchHostedZone', operation)
+        return self.zones[zone_id]
+
+    def summary(self, zone):
+        return dict((k, v) for k, v in zone.items() if k in ('Id', 'Name', 'Config'))
+
+    def list_hosted_zones(self, **kwargs):
+        self.call('ListHostedZones')
+        with self.lock:
+            return {'HostedZones': [self.summary(z) for z in self.zones.values()], 'IsTruncated': False}
+
+    def list_hosted_zones_by_name(self, DNSName, MaxItems='100'):
+        self.call('ListHostedZonesByName')
+        with self.lock:
+            zones = sorted(self.zones.values(), key=lambda z: (z['Name'], z['Id']))
+            zones = [self.summary(z) for z in zones if z['Name'] >= normalize_name(DNSName)]
+        return {'HostedZones': zones[:int(MaxItems)]}
+
+    def list_hosted_zones_by_vpc(self, VPCId, VPCRegion, **kwargs):
+        self.call('ListHostedZonesByVPC')
+        with self.lock:
+            return {'HostedZoneSummaries': [{'HostedZoneId': zone_id, 'Name': z['Name']}
+                                            for zone_id, z in self.zones.items() if VPCId in z['vpcs']]}
+
+    def get_hosted_zone(self, Id):
+        self.call('GetHostedZone')
+        with self.lock:
+            zone = self.zone(Id, 'GetHostedZone')
+            return {'HostedZone': self.summary(zone), 'VPCs': [{'VPCId': v} for v in zone['vpcs']],
+                    'ResponseMetadata': {}}
+
+    def create_hosted_zone(self, Name, CallerReference, VPC=None, HostedZoneConfig=None):
+        self.call('CreateHostedZone')
+        with self.lock:
+            if CallerReference in self.caller_references:
+                raise self.exceptions.HostedZoneAlreadyExists(
+                    {'Error': {'Code': 'HostedZoneAlreadyExists', 'Message': CallerReference}}, 'CreateHostedZone')
+            zone_id = self.add_zone(Name, VPC is not None, VPC and VPC['VPCId'],
+                                    (HostedZoneConfig or {}).get('Comment', ''))
+            self.caller_references[CallerReference] = zone_id
+            return {'HostedZone': self.summary(self.zones[zone_id])}
+
+    def associate_vpc_with_hosted_zone(self, HostedZoneId, VPC, Comment=''):
+        self.call('AssociateVPCWithHostedZone')
+        with self.lock:
+            self.zone(HostedZoneId, 'AssociateVPCWithHostedZone')['vpcs'].add(VPC['VPCId'])
+        return {}
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        self.call('ChangeResourceRecordSets')
+        with self.lock:
+            zone = self.zone(HostedZoneId, 'ChangeResourceRecordSets')
+            records = dict(zone['records'])
+            # all or nothing, just like the real thing
+            for change in ChangeBatch['Changes']:
+                record_set = dict(change['ResourceRecordSet'])
+                record_set['Name'] = normalize_name(record_set['Name'])
+                key = (record_set['Name'], record_set['Type'], record_set.get('SetIdentifier'))
+                if change['Action'] == 'DELETE':
+                    if records.get(key) != record_set:
+                        raise client_error('InvalidChangeBatch', 'ChangeResourceRecordSets',
+                                           'Tried to delete resource record set %s but it was not found' % (key,))
+                    del records[key]
+                elif change['Action'] == 'CREATE' and key in records:
+                    raise client_error('InvalidChangeBatch', 'ChangeResourceRecordSets',
+                                       'Tried to create resource record set %s but it already exists' % (key,))
+                else:
+                    records[key] = record_set
+            zone['records'] = records
+            change_id = '/change/C%d' % (len(self.changes) + 1)
+            self.changes[change_id] = time.time() + self.backend.insync_delay
+        self.backend.stats.write()
+        return {'ChangeInfo': {'Id': change_id, 'Status': 'PENDING', 'SubmittedAt': datetime.utcnow()}}
+
+    def get_change(self, Id):
+        self.call('GetChange')
+        status = 'INSYNC' if time.time() >= self.changes.get(Id, 0) else 'PENDING'
+        return {'ChangeInfo': {'Id': Id, 'Status': status}}
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName=None, StartRecordType=None,
+                                  StartRecordIdentifier=None, MaxItems='100'):
+        self.call('ListResourceRecordSets')
+        with self.lock:
+            records = self.zone(HostedZoneId, 'ListResourceRecordSets')['records']
+            keys = sorted(records, key=lambda k: (k[0], k[1], k[2] or ''))
+        if StartRecordName:
+            start = (normalize_name(StartRecordName), StartRecordType or '', StartRecordIdentifier or '')
+            keys = [k for k in keys if (k[0], k[1], k[2] or '') >= start]
+        page = {'ResourceRecordSets': [records[k] for k in keys[:int(MaxItems)]], 'IsTruncated': len(keys) > int(MaxItems)}
+        if page['IsTruncated']:
+            page['NextRecordName'], page['NextRecordType'] = keys[int(MaxItems)][:2]
+            if keys[int(MaxItems)][2]:
+                page['NextRecordIdentifier'] = keys[int(MaxItems)][2]
+        return page
+
+
+class FakeInstance(object):
+
+    def __init__(self, instance_id, spec):
+        self.id = instance_id
+        self.instance_type = 'm4.large'
+        self.state = {'Name': 'running'}
+        self.tags = [{'Key': k, 'Value': v} for k, v in spec['tags'].items()]
+        self.vpc_id = spec['vpc_id']
+        self.subnet_id = spec['subnet_id']
+        self.private_ip_address = spec['private_ip']
+        self.private_dns_name = 'ip-%s.ec2.internal' % spec['private_ip'].replace('.', '-')
+        self.public_ip_address = spec.get('public_ip')
+        self.public_dns_name = ''
+        if self.public_ip_address:
+            self.public_dns_name = 'ec2-%s.compute-1.amazonaws.com' % self.public_ip_address.replace('.', '-')
+
+
+class FakeEC2(FakeService):
+    """Covers both boto3.resource('ec2') and boto3.client('ec2')."""
+
+    def __init__(self, backend, rate, inventory, domain):
+        FakeService.__init__(self, backend, 'ec2', Throttle(rate))
+        self.inventory = inventory
+        self.domain = domain
+        self.lock = threading.Lock()
+        self.instances = self
+        # Elastic IPs that aren't associated with anything
+        self.free_addresses = []
+
+    def spec(self, instance_id):
+        with self.lock:
+            if instance_id not in self.inventory:
+                number = len(self.inventory)
+                ip = '10.0.%d.%d' % ((number // 250) % 256, number % 250 + 4)
+                self.inventory[instance_id] = {
+                    'tags': {'Name': 'replay-%d' % number, 'function': 'web'},
+                    'private_ip': ip,
+                    'subnet_id': 'subnet-replay-%d' % ((number // 250) % 256),
+                    'cidr_block': '10.0.%d.0/24' % ((number // 250) % 256),
+                    'vpc_id': 'vpc-replay',
+                }
+            return self.inventory[instance_id]
+
+    def filter(self, Filters):
+        self.call('DescribeInstances')
+        ids = [v for f in Filters if f['Name'] == 'instance-id' for v in f['Values']]
+        return [FakeInstance(instance_id, self.spec(instance_id)) for instance_id in ids
+                if instance_id not in self.backend.terminated]
+
+    def Vpc(self, vpc_id):
+        self.call('DescribeVpcs')
+
+        class Vpc(object):
+            dhcp_options_id = 'dopt-replay'
+        return Vpc()
+
+    def DhcpOptions(self, dhcp_options_id):
+        self.call('DescribeDhcpOptions')
+        domain = self.domain
+
+        class DhcpOptions(object):
+            dhcp_configurations = [{'Key': 'domain-name', 'Values': [{'Value': domain}]}]
+        return DhcpOptions()
+
+    def Subnet(self, subnet_id):
+        self.call('DescribeSubnets')
+        with self.lock:
+            cidr = [s['cidr_block'] for s in self.inventory.values() if s['subnet_id'] == subnet_id]
+
+        class Subnet(object):
+            cidr_block = cidr[0] if cidr else '10.0.0.0/24'
+        return Subnet()
+
+    def describe_dhcp_options(self, **kwargs):
+        self.call('DescribeDhcpOptions')
+        return {'DhcpOptions': [{'DhcpOptionsId': 'dopt-replay', 'DhcpConfigurations': [
+            {'Key': 'domain-name', 'Values': [{'Value': self.domain}]}]}]}
+
+    def describe_vpcs(self, **kwargs):
+        self.call('DescribeVpcs')
+        return {'Vpcs': [{'VpcId': 'vpc-replay', 'DhcpOptionsId': 'dopt-replay'}]}
+
+    def describe_addresses(self, **kwargs):
+        """Elastic IPs are the --inventory instances with an "eip": true, and free_addresses."""
+        self.call('DescribeAddresses')
+        with self.lock:
+            return {'Addresses': [{'PublicIp': spec['public_ip'], 'AllocationId': 'eipalloc-%s' % instance_id,
+                                   'InstanceId': instance_id, 'AssociationId': 'eipassoc-%s' % instance_id}
+                                  for instance_id, spec in self.inventory.items() if spec.get('eip')] +
+                                 [{'PublicIp': ip, 'AllocationId': 'eipalloc-%s' % ip} for ip in self.free_addresses]}
+
+    def describe_instances(self, InstanceIds=(), **kwargs):
+        """Just the state and public ip, what union.py asks after a DisassociateAddress
+        or before draining a deferred event."""
+        self.call('DescribeInstances')
+        instances = []
+        for instance_id in InstanceIds:
+            state = 'terminated' if instance_id in self.backend.terminated else 'running'
+            instance = {'InstanceId': instance_id, 'State': {'Name': state}}
+            if self.spec(instance_id).get('public_ip'):
+                instance['PublicIpAddress'] = self.spec(instance_id)['public_ip']
+            instances.append(instance)
+        return {'Reservations': [{'Instances': instances}]}
+
+    def describe_subnets(self, **kwargs):
+        self.call('DescribeSubnets')
+        with self.lock:
+            subnets = dict((s['subnet_id'], s['cidr_block']) for s in self.inventory.values())
+        return {'Subnets': [{'SubnetId': k, 'CidrBlock': v} for k, v in subnets.items()]}
+
+
+class FakeDynamoDB(FakeService):
+    """Plain get/put/delete, hash key queries and the condition expressions
+    union.py writes with, enough for the warm cache, manifests, deferred
+    events, name slots and the coalescer."""
+
+    # the key attributes of every table union.py uses
+    key_attributes = ('cache_id', 'instance_id', 'zone_id', 'seq', 'name_key', 'queue_id')
+
+    def __init__(self, backend):
+        FakeService.__init__(self, backend, 'dynamodb', None)
+        self.exceptions = FakeExceptions()
+        self.exceptions.ConditionalCheckFailedException = type('ConditionalCheckFailedException', (ClientError,), {})
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def key(self, TableName, Key):
+        return (TableName,) + tuple(sorted((k, list(v.values())[0]) for k, v in Key.items()))
+
+    def term_holds(self, item, term, names, values):
+        """One condition: attribute_exists(a), attribute_not_exists(a) or a <op> :value."""
+        match = re.match(r'(attribute_exists|attribute_not_exists)\((\S+)\)$', term)
+        if match:
+            attribute = names.get(match.group(2), match.group(2))
+            return (attribute in item) == (match.group(1) == 'attribute_exists')
+        attribute, op, placeholder = term.split()
+        attribute = names.get(attribute, attribute)
+        if attribute not in item:
+            return False
+        (kind, left), = item[attribute].items()
+        right = list(values[placeholder].values())[0]
+        if kind == 'N':
+            left, right = float(left), float(right)
+        return {'=': left == right, '<>': left != right, '<': left < right,
+                '<=': left <= right, '>': left > right, '>=': left >= right}[op]
+
+    def condition_holds(self, item, expression, names=None, values=None):
+        """terms joined by AND, alternatives by OR, no parentheses."""
+        for alternative in expression.split(' OR '):
+            if all(self.term_holds(item or {}, term.strip(), names or {}, values or {})
+                   for term in alternative.split(' AND ')):
+                return True
+        return False
+
+    def check(self, operation, item, ConditionExpression=None, ExpressionAttributeNames=None,
+              ExpressionAttributeValues=None, **kwargs):
+        if ConditionExpression and not self.condition_holds(item, ConditionExpression,
+                                                            ExpressionAttributeNames, ExpressionAttributeValues):
+            raise self.exceptions.ConditionalCheckFailedException(
+                {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}},
+                operation)
+
+    def put_item(self, TableName, Item, ReturnValues=None, **kwargs):
+        self.call('PutItem')
+        keys = dict((k, v) for k, v in Item.items() if k in self.key_attributes)
+        with self.lock:
+            key = self.key(TableName, keys)
+            old = self.items.get(key)
+            self.check('PutItem', old, **kwargs)
+            self.items[key] = Item
+        return {'Attributes': old} if old and ReturnValues == 'ALL_OLD' else {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        self.call('GetItem')
+        with self.lock:
+            item = self.items.get(self.key(TableName, Key))
+        return {'Item': item} if item else {}
+
+    def delete_item(self, TableName, Key, ReturnValues=None, **kwargs):
+        self.call('DeleteItem')
+        with self.lock:
+            key = self.key(TableName, Key)
+            self.check('DeleteItem', self.items.get(key), **kwargs)
+            item = self.items.pop(key, None)
+        return {'Attributes': item} if item and ReturnValues == 'ALL_OLD' else {}
+
+    def batch_write_item(self, RequestItems):
+        """Deletes only, what the coalescer sends."""
+        self.call('BatchWriteItem')
+        with self.lock:
+            for table, requests in RequestItems.items():
+                for request in requests:
+                    self.items.pop(self.key(table, request['DeleteRequest']['Key']), None)
+        return {}
+
+    def scan(self, TableName, **kwargs):
+        """Every item in the table, one page."""
+        self.call('Scan')
+        with self.lock:
+            return {'Items': [item for key, item in sorted(self.items.items()) if key[0] == TableName]}
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeValues,
+              ExpressionAttributeNames=None, Limit=None, **kwargs):
+        """The items matching the key condition, in range key order."""
+        self.call('Query')
+        with self.lock:
+            items = [item for key, item in sorted(self.items.items())
+                     if key[0] == TableName and self.condition_holds(
+                         item, KeyConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)]
+        return {'Items': items[:Limit]}
+
+
+class FakeS3(FakeService):
+
+    def __init__(self, backend):
+        FakeService.__init__(self, backend, 's3', None)
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.call('PutObject')
+        self.objects[(Bucket, Key)] = (Body, datetime.utcnow())
+        return {}
+
+    def get_object(self, Bucket, Key):
+        self.call('GetObject')
+        if (Bucket, Key) not in self.objects:
+            raise client_error('NoSuchKey', 'GetObject')
+        body, modified = self.objects[(Bucket, Key)]
+        return {'Body': BytesIO(body), 'LastModified': modified}
+
+
+class FakeBackend(object):
+
+    def __init__(self, inventory, domain, latency, insync_delay, route53_rate, ec2_rate):
+        self.stats = Stats()
+        self.latency = latency
+        self.insync_delay = insync_delay
+        self.terminated = set()
+        self.route53 = FakeRoute53(self, route53_rate)
+        self.ec2 = FakeEC2(self, ec2_rate, inventory, domain)
+        self.dynamodb = FakeDynamoDB(self)
+        self.s3 = FakeS3(self)
+        self.route53.add_zone(domain, True, 'vpc-replay')
+
+    def client(self, service, *args, **kwargs):
+        return {'route53': self.route53, 'ec2': self.ec2, 'dynamodb': self.dynamodb, 's3': self.s3}[service]
+
+    def resource(self, service, *args, **kwargs):
+        return self.ec2 if service == 'ec2' else self.dynamodb
+
+    def install(self):
+        ddns_clients.client = self.client
+        ddns_clients.resource = self.resource
+
+
+#################################################################
+### Replaying                                                ####
+#################################################################
+
+def load_handler(number):
+    """Loads a fresh copy of union.py, like a cold lambda container."""
+    path = os.path.join(here, 'union.py')
+    name = 'union_replay_%d' % number
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except ImportError:
+        import imp
+        module = imp.load_source(name, path)
+    return module.lambda_handler
+
+
+def event_time(event):
+    try:
+        return time.mktime(datetime.strptime(event['time'], '%Y-%m-%dT%H:%M:%SZ').timetuple())
+    except (KeyError, ValueError):
+        return None
+
+
+def read_events(path):
+    with open(path) as f:
+        text = f.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def failover_events(count, spread):
+    """An AZ failover: count instances go away while count replacements start."""
+    start = time.time()
+    seed = []
+    storm = []
+    for number in range(count):
+        old_id = 'i-old%013x' % number
+        new_id = 'i-new%013x' % number
+        seed.append({'detail': {'instance-id': old_id, 'state': 'running'}, 'region': 'us-east-1'})
+        for instance_id, state in ((old_id, 'shutting-down'), (new_id, 'running')):
+            stamp = datetime.utcfromtimestamp(start + random.random() * spread).strftime('%Y-%m-%dT%H:%M:%SZ')
+            storm.append({'detail': {'instance-id': instance_id, 'state': state}, 'region': 'us-east-1', 'time': stamp})
+    storm.sort(key=lambda e: e['time'])
+    return seed, storm
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def replay(backend, events, workers, speed, results):
+    """Feeds events to workers on the events' own timeline, sped up by speed."""
+    queue = Queue(maxsize=workers * 2)
+    lock = threading.Lock()
+
+    def worker(number):
+        handler = None
+        while True:
+            event = queue.get()
+            if event is None:
+                return
+            backend.stats.start_event()
+            started = time.time()
+            error = None
+            try:
+                if handler is None:
+                    # a cold start, charged to the event that triggered it
+                    handler = load_handler(number)
+                    with lock:
+                        results['cold_starts'].append(time.time() - started)
+                if event['detail'].get('state') == 'running':
+                    backend.terminated.discard(event['detail']['instance-id'])
+                handler(event, None)
+            except BaseException as e:
+                error = e
+            elapsed = time.time() - started
+            if 'instance-id' not in event['detail']:
+                # a scheduled event, see drain_deferred
+                continue
+            if event['detail']['state'] != 'running':
+                backend.terminated.add(event['detail']['instance-id'])
+            with lock:
+                results['latencies'].append(elapsed)
+                results['calls'].append(backend.stats.event_calls())
+                if backend.stats.first_write() is not None:
+                    results['first_write'].setdefault(event['detail']['state'], []).append(
+                        backend.stats.first_write() - started)
+                if error is not None:
+                    results['errors'].append('%s %s: %r' % (event['detail']['instance-id'],
+                                                            event['detail']['state'], error))
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    times = [event_time(e) for e in events]
+    first = min([t for t in times if t is not None] or [0])
+    started = time.time()
+    for event, stamp in zip(events, times):
+        if speed and stamp is not None:
+            delay = started + (stamp - first) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        queue.put(event)
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    return time.time() - started
+
+
+def deferred_count(backend):
+    """Events union.py has parked in DDNS_DEFER_TABLE."""
+    with backend.dynamodb.lock:
+        return len([item for item in backend.dynamodb.items.values()
+                    if item.get('queue_id') == {'S': 'deferred'}])
+
+
+def drain_deferred(backend, interval, rounds=30):
+    """Plays the scheduled rule that drains deferred events, every interval seconds
+    until there are none left.  Returns how long that took."""
+    started = time.time()
+    scheduled = {'detail': {}, 'region': 'us-east-1', 'detail-type': 'Scheduled Event'}
+    for attempt in range(rounds):
+        if not deferred_count(backend):
+            break
+        time.sleep(interval)
+        replay(backend, [scheduled], 1, 0, new_results())
+    return time.time() - started
+
+
+def new_results():
+    return {'latencies': [], 'calls': [], 'errors': [], 'cold_starts': [], 'first_write': {}}
+
+
+################################################################
+### Running Code                                            ####
+################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay EC2 state-change events against union.lambda_handler.')
+    parser.add_argument('events', nargs='?', help='file of recorded events, json lines or a json list')
+    parser.add_argument('--generate', type=int, metavar='N',
+                        help='instead of a file, replay an AZ failover of N instances')
+    parser.add_argument('--spread', type=float, default=60,
+                        help='seconds the generated failover is spread over(default 60)')
+    parser.add_argument('--workers', type=int, default=10,
+                        help='concurrent lambda containers(default 10)')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='time compression, 10 replays 10x faster, 0 as fast as possible(default 1)')
+    parser.add_argument('--inventory', help='json file of instance id -> instance details')
+    parser.add_argument('--domain', default='aws.imednet.net',
+                        help='domain-name in the fake dhcp option set(default aws.imednet.net)')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='milliseconds every fake API call takes(default 20)')
+    parser.add_argument('--insync', type=float, default=0,
+                        help='seconds before a fake change goes INSYNC(default 0)')
+    parser.add_argument('--route53-rate', type=float, default=5,
+                        help='Route53 requests per second before throttling(default 5)')
+    parser.add_argument('--ec2-rate', type=float, default=100,
+                        help='EC2 requests per second before throttling(default 100)')
+    parser.add_argument('--verbose', action='store_true', help="show the handler's own output")
+    args = parser.parse_args()
+
+    if not args.events and not args.generate:
+        parser.error('give an events file or --generate N')
+
+    inventory = {}
+    if args.inventory:
+        with open(args.inventory) as f:
+            inventory = json.load(f)
+
+    backend = FakeBackend(inventory, args.domain, args.latency / 1000.0, args.insync,
+                          args.route53_rate, args.ec2_rate)
+    backend.install()
+
+    if args.generate:
+        seed, events = failover_events(args.generate, args.spread)
+    else:
+        seed, events = [], read_events(args.events)
+
+    real_stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        if seed:
+            # put the old instances' records in place, as fast as we can, not measured
+            replay(backend, seed, args.workers, 0, new_results())
+            backend.stats.calls.clear()
+            backend.stats.throttles.clear()
+        results = new_results()
+        elapsed = replay(backend, events, args.workers, args.speed, results)
+        deferred = deferred_count(backend)
+        if deferred:
+            drain_elapsed = drain_deferred(backend, float(os.environ.get('DDNS_DEFER_COOLDOWN', '10')))
+    finally:
+        if not args.verbose:
+            sys.stdout.close()
+        sys.stdout = real_stdout
+
+    latencies = results['latencies']
+    print('')
+    print('Replayed %d events in %.1fs with %d workers, %.1f events/s' % (
+        len(latencies), elapsed, args.workers, len(latencies) / elapsed if elapsed else 0))
+    print('Handler latency  p50 %.0fms  p95 %.0fms  p99 %.0fms  max %.0fms' % (
+        percentile(latencies, 0.50) * 1000, percentile(latencies, 0.95) * 1000,
+        percentile(latencies, 0.99) * 1000, max(latencies or [0]) * 1000))
+    # how long until an event's records start landing, by the event's state
+    for state, waits in sorted(results['first_write'].items()):
+        print('First write      p50 %.0fms  p95 %.0fms  %d %s events' % (
+            percentile(waits, 0.50) * 1000, percentile(waits, 0.95) * 1000, len(waits), state))
+    if results['cold_starts']:
+        print('Cold starts      %d, mean %.0fms' % (len(results['cold_starts']),
+              sum(results['cold_starts']) * 1000 / len(results['cold_starts'])))
+    print('API calls/event  mean %.1f  p99 %d' % (sum(results['calls']) / float(len(latencies) or 1),
+                                                  percentile(results['calls'], 0.99)))
+    for name in sorted(backend.stats.calls):
+        print('  %-40s %8d calls %6d throttled' % (name, backend.stats.calls[name],
+                                                   backend.stats.throttles.get(name, 0)))
+    print('Throttled        %d' % sum(backend.stats.throttles.values()))
+    if deferred:
+        print('Deferred         %d events, %d left after %.0fs of scheduled drains' % (
+            deferred, deferred_count(backend), drain_elapsed))
+    print('Errors           %d' % len(results['errors']))
+    for error in results['errors'][:10]:
+        print('  %s' % error)
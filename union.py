@@ -23,27 +23,43 @@
 ################################################################################
 
 import json
-import boto3
+import os
 import re
 import uuid
 import time
 import random
-# dns.resolver is from dnspython --> http://www.dnspython.org/
-# to use it with our lambda function, we need to package it up with
-# the zip file we upload to AWS
-# pip install dnspython -t /path/to/export/the/module
-# that'll put the dnspython module in /path/to/export/the/module/dns
-# we want to include the dns/ directory in our zip file
-# zip -r union.py.zip union.py dns/
-import dns.resolver
+import shutil
+import calendar
+import threading
+import zlib
+import cProfile
+import pstats
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+from collections import OrderedDict
+# the lambda gets uploaded as a zip of this script and its helper modules
+# zip -r union.py.zip union.py ddns_clients.py ddns_pipeline.py ddns_records.py ddns_snapshot.py ddns_templates.py
+from botocore.exceptions import ClientError
 from datetime import datetime
+# the shared, tuned boto3 clients, the ChangeBatch limits & batch writes the
+# sweeps use too, the record set cache, the cache snapshot format and the record
+# templates, ship ddns_clients.py, ddns_pipeline.py, ddns_records.py,
+# ddns_snapshot.py & ddns_templates.py in the zip along with union.py
+import ddns_clients
+import ddns_pipeline
+import ddns_records
+import ddns_snapshot
+import ddns_templates
 
 print('Loading function ' + datetime.now().time().isoformat())
-route53 = boto3.client('route53')
-ec2 = boto3.resource('ec2')
-compute = boto3.client('ec2')
-dynamodb_client = boto3.client('dynamodb')
-dynamodb_resource = boto3.resource('dynamodb')
+route53 = ddns_clients.client('route53')
+ec2 = ddns_clients.resource('ec2')
+compute = ddns_clients.client('ec2')
+dynamodb_client = ddns_clients.client('dynamodb')
+dynamodb_resource = ddns_clients.resource('dynamodb')
+s3 = ddns_clients.client('s3')
 
 
 #################################################################
@@ -66,14 +82,231 @@ dynamodb_resource = boto3.resource('dynamodb')
 ### Running Code                                            ####
 ################################################################
 
-# Our list of Route53 hosted domains
-hosted_zones = route53.list_hosted_zones()
+# Our index of Route53 hosted zones, zone name -> zone id
+# built once per container from every page of list_hosted_zones and kept
+# up to date as we find or create zones, so warm invocations skip the lookups
+zone_index = {}
+zone_index_lock = threading.Lock()
+
+# VPC id -> default domain from its dhcp option set
+vpc_domains = {}
+
+# subnet id -> subnet mask
+subnet_masks = {}
+
+# region -> (when we read them, public ip -> Elastic IP) from describe_addresses,
+# re-read after DDNS_ADDRESS_TTL seconds(default 300), see get_addresses
+addresses = {}
+address_ttl = float(os.environ.get('DDNS_ADDRESS_TTL', '300'))
+
+# Set DDNS_CACHE_TABLE to a DynamoDB table(hash key cache_id, a string) and
+# the scheduled prefetch_handler keeps all of the above, plus the zone/VPC
+# associations, in one item there.  New containers load it in a single read
+# instead of paying for the lookups on their first real event
+# DynamoDB items top out at 400KB, big estates should set DDNS_CACHE_BUCKET
+# instead and the snapshot goes to s3://DDNS_CACHE_BUCKET/DDNS_CACHE_ID
+cache_table = os.environ.get('DDNS_CACHE_TABLE')
+cache_bucket = os.environ.get('DDNS_CACHE_BUCKET')
+cache_id = os.environ.get('DDNS_CACHE_ID', 'warm-cache')
+
+# the last snapshot we loaded, see ddns_snapshot.py, and when it was saved
+snapshot = None
+snapshot_saved = None
+
+# S3 snapshots are downloaded here and memory mapped, only the pages we
+# touch(one instance's records, say) get read
+snapshot_dir = os.environ.get('DDNS_SNAPSHOT_DIR', '/tmp')
+
+# DynamoDB items top out at 400KB, a snapshot bigger than this is saved
+# without the per-instance records
+max_item_snapshot = 350000
+
+# Set DDNS_OWNERSHIP_TXT=true on the function to pair every create with a
+# per-instance TXT record(_ddns.<instance-id>.<default_zone>) that lists every
+# record the instance owns.  Cleanup on stop/terminate then reads that one
+# record and issues a single batched DELETE instead of reading back each record
+ownership_txt = os.environ.get('DDNS_OWNERSHIP_TXT', '').lower() in ('1', 'true', 'yes')
+
+# known zone/VPC associations, see zone_associated
+zone_associations = set()
+loaded_associations = set()
+
+# only one reverse zone gets created at a time, see create_reverse_lookup_zone
+reverse_zone_lock = threading.Lock()
+
+# Set DDNS_COALESCE_TABLE to a DynamoDB table(hash key zone_id, range key
+# seq, both strings) to have concurrent invocations merge their writes to a
+# zone into shared ChangeBatches, see coalesce_changes
+coalesce_table = os.environ.get('DDNS_COALESCE_TABLE')
+# seconds to let a burst build up before flushing
+coalesce_window = float(os.environ.get('DDNS_COALESCE_WINDOW', '0.5'))
+# seconds a flusher's lock lasts if it dies without letting go
+coalesce_lease = 30
+# longest we wait on someone else's flush before leaving our changes queued
+# for the scheduled prefetch, always longer than the lease so a waiter
+# outlives a flusher that died and sends the queue itself
+coalesce_timeout = max(float(os.environ.get('DDNS_COALESCE_TIMEOUT', '45')), coalesce_lease + 5)
+coalesce_owner = str(uuid.uuid4())
+
+# Set DDNS_MANIFEST_TABLE to a DynamoDB table(hash key instance_id, a string)
+# and every create writes down the records the instance owns.  Stop and
+# terminate events then delete from that manifest without any EC2 calls,
+# which still works once EC2 has forgotten a terminated instance
+manifest_table = os.environ.get('DDNS_MANIFEST_TABLE')
+
+# Tags that go into an instance's records, editing one of these on a running
+# instance(a tag change event) re-works its records and, with a manifest,
+# sends only what differs.  With DDNS_TEMPLATES any tag can matter
+record_tags = set(['Name', 'function', 'imednet-env', 'override_zone', 'override_name',
+                   'root_domain', 'cname', 'ddns_ttl', 'ddns_weight'])
+
+# Set DDNS_NAME_TABLE to a DynamoDB table(hash key name_key, a string) and
+# instances sharing a Name tag(auto scaling groups, or anything tagged
+# override_name=use_slot) get numbered names, web-1, web-2..., instead of
+# each new one overwriting its siblings' A record.  An instance keeps its
+# number while it runs, stopping frees it for the next one, see claim_name_slot
+name_table = os.environ.get('DDNS_NAME_TABLE')
+
+# Set DDNS_TEMPLATES to build an instance's records from templates instead of
+# the rules written out in lambda_handler, see ddns_templates.py.  Either the
+# json document itself, s3://bucket/key or ssm:/parameter/name
+templates_source = os.environ.get('DDNS_TEMPLATES')
+
+# Set DDNS_SKIP_UNCHANGED to leave out UPSERTs of records that already hold
+# what we'd write, so reboots and duplicate events cost no Route53 writes
+#   off     write everything(default)
+#   ledger  compare with what we know without asking Route53: the instance's
+#           records in a fresh warm cache snapshot(or else a fresh manifest) and
+#           our own recent writes
+#   zone    same, and read the record sets the ledger doesn't cover straight
+#           out of the zone
+# see drop_unchanged
+skip_unchanged = os.environ.get('DDNS_SKIP_UNCHANGED', 'off').lower()
+# seconds we trust what we wrote ourselves before we'd rather look again
+current_values_ttl = float(os.environ.get('DDNS_CURRENT_VALUES_TTL', '300'))
+# (zone_id, name, type, set identifier) -> (values, when we learned them)
+current_values = {}
+
+# Record sets we've read out of Route53, a name at a time, see ddns_records.py
+# DDNS_RECORD_CACHE_SIZE names are kept(default 1024), for
+# DDNS_RECORD_CACHE_TTL seconds(default 60), and our own writes drop theirs
+record_cache = ddns_records.RecordCache(route53,
+    int(os.environ.get('DDNS_RECORD_CACHE_SIZE', '1024')),
+    float(os.environ.get('DDNS_RECORD_CACHE_TTL', '60')))
+
+# Set DDNS_PROFILE=true to run every invocation under cProfile and log the
+# top DDNS_PROFILE_TOP functions(default 25) plus how long each phase of the
+# handler took.  Set DDNS_PROFILE_DIR(e.g. /tmp) to write the reports there
+# instead, along with the raw .prof files
+profile_enabled = os.environ.get('DDNS_PROFILE', '').lower() in ('1', 'true', 'yes')
+profile_top = int(os.environ.get('DDNS_PROFILE_TOP', '25'))
+profile_dir = os.environ.get('DDNS_PROFILE_DIR')
+profiled_invocations = 0
+phase_times = {}
+phase_mark = time.time()
+
+# throttles and PriorRequestNotComplete are retried by botocore(see
+# ddns_clients.py), this only bounds our own conditional write loops
+max_attempts = 6
+
+# Set DDNS_DEFER_TABLE to a DynamoDB table(hash key queue_id, range key seq,
+# both strings, TTL attribute expires) to give running events first call on
+# the Route53 budget.  While any container is being throttled, stop and
+# terminate events are parked in the table instead of handled, and every
+# invocation drains a few of them once the throttling has stopped, the
+# scheduled prefetch drains the rest, see defer_event
+defer_table = os.environ.get('DDNS_DEFER_TABLE')
+# seconds after the last throttle that we're still under pressure
+defer_cooldown = float(os.environ.get('DDNS_DEFER_COOLDOWN', '10'))
+# deferred events an invocation handles after its own
+defer_drain = int(os.environ.get('DDNS_DEFER_DRAIN', '5'))
+# deferred events the scheduled prefetch handles
+defer_drain_scheduled = 1000
+# milliseconds of an invocation we keep back when draining
+defer_reserve_ms = 5000
+# errors that mean Route53 is out of budget, as opposed to busy with a zone
+throttle_codes = ['Throttling', 'ThrottlingException']
+# when the pressure we know of ends, and when we last read the shared marker
+throttled_until = 0
+pressure_until = 0
+pressure_read = 0
+
+# INSYNC tracker state, see track_change
+current_event = None
+pending_changes = {}
+pending_events = {}
+insync_lock = threading.Condition()
+insync_thread = None
+
+# TXT value that marks a record as ours, ddns-drift-scan.py looks for it too
+heritage_marker = 'heritage=lambda-ddns'
+
+# TTL for the records we write, an instance can override it with a ddns_ttl tag
+record_ttl = int(os.environ.get('DDNS_TTL', '60'))
+
+# How function records get built
+#   cname       function.vmzone CNAME name.default_zone, last instance wins
+#   multivalue  function.vmzone A, one multivalue answer per instance
+#   weighted    function.vmzone A, one weighted answer per instance
+# with multivalue/weighted, scale events only add or remove their own member
+# NOTE: a name can't hold a CNAME and A records at the same time, so clear out
+# the old CNAMEs when switching an existing environment over
+function_routing = os.environ.get('DDNS_FUNCTION_ROUTING', 'cname').lower()
+
+# default weight for weighted function records, override with a ddns_weight tag
+function_weight = int(os.environ.get('DDNS_FUNCTION_WEIGHT', '1'))
+
+# Track when our changes actually go live(INSYNC) in Route53
+#   off    don't track(default)
+#   track  poll get_change in a background thread and log time-to-INSYNC per event
+#   block  same, but the handler waits for its changes before returning
+# the latency gets logged as a json line so a metric filter can pick it up
+insync_mode = os.environ.get('DDNS_WAIT_INSYNC', 'off').lower()
+
+# longest the handler will block waiting on INSYNC, keep it under the function timeout
+insync_timeout = float(os.environ.get('DDNS_INSYNC_TIMEOUT', '20'))
+
+# the poller gives up on a change after this many get_change errors in a row,
+# or this many seconds after it was submitted
+insync_max_errors = int(os.environ.get('DDNS_INSYNC_MAX_ERRORS', '5'))
+insync_max_age = float(os.environ.get('DDNS_INSYNC_MAX_AGE', '900'))
 
 
 def lambda_handler(event, context):
     # This the magic
     # it is the function that receives the notification from AWS
     
+    # Elastic IPs moving, from CloudTrail, only touch the public records
+    if event.get('detail', {}).get('eventName') in ('AssociateAddress', 'DisassociateAddress'):
+        return address_handler(event, context)
+
+    # tags edited on an instance, from the tag service or CloudTrail
+    if event.get('detail-type') == 'Tag Change on Resource' or \
+            event.get('detail', {}).get('eventName') in ('CreateTags', 'DeleteTags'):
+        return tag_handler(event, context)
+
+    # scheduled events(no instance) refresh the warm cache
+    # and pick up whatever cleanup got put off
+    if 'instance-id' not in event.get('detail', {}):
+        prefetch_handler(event, context)
+        if defer_table:
+            drain_deferred(context, defer_drain_scheduled)
+        return
+
+    # cleanup waits while Route53 is throttling us, new instances come first
+    if defer_table and event['detail']['state'] != 'running' and under_pressure():
+        defer_event(event)
+        return
+
+    handle_event(event, context)
+    if defer_table:
+        drain_deferred(context, defer_drain)
+
+
+def handle_event(event, context, retag=False):
+    """Adds or removes the records for the instance in one state-change event.
+    With retag(its tags changed) only what differs from its manifest is sent."""
+
     # get the instance id from the event message
     instance_id = event['detail']['instance-id']
 
@@ -82,12 +315,47 @@ def lambda_handler(event, context):
 
     # get the state from the event
     state = event['detail']['state']
+
+    # label our Route53 changes with the event for INSYNC tracking
+    global current_event
+    current_event = '%s %s' % (instance_id, state)
     
 
+    start_phases()
+
+    # compiled once, then used for every instance in the event
+    templates = None
+    if templates_source:
+        try:
+            templates = ddns_templates.get_templates(templates_source)
+        except BaseException as e:
+            print('Failed to load templates from DDNS_TEMPLATES, using the built in rules')
+            print(e)
+
+    # what the instance's records held last time, so unchanged ones can be skipped
+    if skip_unchanged != 'off' and state == 'running':
+        load_current_values(instance_id)
+
+    # going away, so if we wrote down what the instance owns we can clean up
+    # from that alone, without asking EC2 about an instance that may be gone
+    if state != 'running' and manifest_table and delete_from_manifest(instance_id):
+        if name_table:
+            try:
+                release_name_slot(instance_id)
+            except BaseException as e:
+                print(e)
+        end_phase('record writes')
+        if insync_mode == 'block':
+            wait_for_insync(insync_timeout)
+        return
+
     # now we grab info on that instance
-    instances = ec2.instances.filter(
+    instances = list(ec2.instances.filter(
         #Filters=[{'Name': 'instance-state-name', 'Values': ['stopped', 'running']}])
-        Filters=[{'Name': 'instance-id', 'Values': [instance_id]}])
+        Filters=[{'Name': 'instance-id', 'Values': [instance_id]}]))
+    end_phase('instance describe')
+    if not instances:
+        print('EC2 no longer knows about %s and there is no manifest for it, its records are left as they are' % instance_id)
     
     
     for instance in instances:
@@ -96,6 +364,11 @@ def lambda_handler(event, context):
         print('#########     instance id %s                 ###########' % instance.id)
         print('#########     instance state is %s           ###########' % state)
         print('################################################################')
+
+        if retag and instance.state.get('Name') != 'running':
+            # its records come back with the next running event anyway
+            print('%s is %s, leaving its records for the next running event' % (instance.id, instance.state.get('Name')))
+            continue
         
         # init name just in case the instance doesn't have a Name
         # Yes, case matters.  Name != name
@@ -105,6 +378,7 @@ def lambda_handler(event, context):
 
         # we'll use override_name to work-around Auto-Scaling group naming
         override_name = []
+        asg_name = []
         
         # init some more variables
         target_env = []
@@ -117,6 +391,10 @@ def lambda_handler(event, context):
         # Dynamically generate the root_domain
         root_domain = []
 
+        # per-instance record settings, see record_ttl & function_weight
+        ttl = record_ttl
+        weight = function_weight
+
         # uncomment the next line to configure a default root_domain
         # or optionally you set root_domain tag on an instance
         root_domain = "imednet.com"
@@ -151,8 +429,23 @@ def lambda_handler(event, context):
                 print('CName is %s ' % cname)
             if 'root_domain' in tag.get('Key',{}):
                 root_domain = tag.get('Value').lstrip().lower()
+            if 'ddns_ttl' in tag.get('Key',{}):
+                try:
+                    ttl = int(tag.get('Value').strip())
+                    print('ddns_ttl tag found with value %s' % ttl)
+                except ValueError:
+                    print('ddns_ttl tag %r is not a number, using %d' % (tag.get('Value'), ttl))
+            if 'ddns_weight' in tag.get('Key',{}):
+                try:
+                    weight = int(tag.get('Value').strip())
+                    print('ddns_weight tag found with value %s' % weight)
+                except ValueError:
+                    print('ddns_weight tag %r is not a number, using %d' % (tag.get('Value'), weight))
+            if tag.get('Key') == 'aws:autoscaling:groupName':
+                asg_name = tag.get('Value')
     
         # we have finished looping thru the tags
+        end_phase('tag parse')
         
         if override_zone:
             # we were given an override_zone, so we'll use that
@@ -162,19 +455,9 @@ def lambda_handler(event, context):
             
         if not default_zone:
             # No default_zone, so try to get the default domain from dhcp option set
-            vpc_id = instance.vpc_id
-            vpc = ec2.Vpc(vpc_id)
-            dhcp_options_id = vpc.dhcp_options_id
-            dhcp_options = ec2.DhcpOptions(dhcp_options_id)
-            dhcp_configurations = dhcp_options.dhcp_configurations
-        
-            # Now we try to pull out the default zone from the dhcp options
-            for opts in dhcp_configurations:
-                if 'domain-name' == opts['Key']:
-                    zone_names.append(map(lambda x: x['Value'] , opts['Values']))
-        
             # Now try to set our default_zone to match whatever we think we found in the dhcp options set        
-            default_zone = zone_names[0][0]
+            default_zone = get_vpc_domain(instance.vpc_id)
+        end_phase('dhcp lookup')
         
         
         if default_zone:
@@ -229,6 +512,7 @@ def lambda_handler(event, context):
             print('Failed to retrieve zone ids.\n')
             print(e)
             exit()
+        end_phase('zone resolution')
     
         # if the instance has no function(tag), then default to empty list
         # the empty list will prevent attempting to create a CNAME for each function
@@ -277,9 +561,8 @@ def lambda_handler(event, context):
         # Get the subnet mask of the instance
         #subnet_id = instance['Reservations'][0]['Instances'][0]['SubnetId']
         # this might break if the instance has multiple subnets
-        subnet = ec2.Subnet(instance.subnet_id)
-        cidr_block = subnet.cidr_block
-        subnet_mask = int(cidr_block.split('/')[-1])
+        subnet_mask = get_subnet_mask(instance.subnet_id)
+        end_phase('subnet lookup')
     
         reversed_ip_address = reverse_list(instance.private_ip_address)
         reversed_domain_prefix = get_reversed_domain_prefix(subnet_mask, instance.private_ip_address)
@@ -293,11 +576,10 @@ def lambda_handler(event, context):
         vpc_id = instance.vpc_id
     
         # Now we make sure the reverse lookup zone exists and is associated
-        if filter(lambda record: record['Name'] == reversed_lookup_zone, hosted_zones['HostedZones']):
+        reverse_lookup_zone_id = get_zone_id(reversed_lookup_zone)
+        if reverse_lookup_zone_id:
             print 'Reverse lookup zone found:', reversed_lookup_zone
-            reverse_lookup_zone_id = get_zone_id(reversed_lookup_zone)
-            reverse_hosted_zone_properties = get_hosted_zone_properties(reverse_lookup_zone_id)
-            if vpc_id in map(lambda x: x['VPCId'], reverse_hosted_zone_properties['VPCs']):
+            if zone_associated(reverse_lookup_zone_id, vpc_id, region):
                 print 'Reverse lookup zone %s is associated with VPC %s' % (reverse_lookup_zone_id, vpc_id)
             else:
                 print 'Associating zone %s with VPC %s' % (reverse_lookup_zone_id, vpc_id)
@@ -309,8 +591,8 @@ def lambda_handler(event, context):
             print('No matching reverse lookup zone')
             # create private hosted zone for reverse lookups
             if state == 'running':
-                create_reverse_lookup_zone(instance, reversed_domain_prefix, region, vpc_id)
-                reverse_lookup_zone_id = get_zone_id(reversed_lookup_zone)
+                reverse_lookup_zone_id = create_reverse_lookup_zone(instance, reversed_domain_prefix, region, vpc_id)
+        end_phase('reverse zone')
     
     
         print('')
@@ -321,84 +603,103 @@ def lambda_handler(event, context):
             # use the instance id
             name = instance.id
             print("Reset name to use instance.id of %s" % instance.id)
+        elif name_table and (asg_name or override_name == 'use_slot'):
+            # siblings share the Name tag, so each one gets its own number
+            try:
+                if mod_action == 'create':
+                    name = claim_name_slot(instance.id, name, default_zone)
+                else:
+                    name = release_name_slot(instance.id) or name
+                print("Name slot for %s is %s" % (instance.id, name))
+            except BaseException as e:
+                print(e)
+                name = instance.id
+                print("No name slot, reset name to use instance.id of %s" % instance.id)
+            fullname = "%s.%s" % (name, default_zone)
 
         # A record name
         a_name = "%s.%s" % (name, default_zone)
-        
-        if not instance.public_ip_address:
-            # host is not externally accessible aka no public name or ip address
-            print('No public ip address found')
-            #print("Attempting to remove A record for  {}.{} A {}".format(name, default_zone, instance.private_ip_address))
+
+        # every record the instance gets, private and public, is queued up per
+        # zone and sent in one go, one ChangeBatch per zone(see submit_changes),
+        # which also lets the ownership TXT record land in the same batch
+        changes = {}
+        owner_record_name = ownership_record_name(instance.id, default_zone)
+        if ownership_txt and mod_action == 'delete':
+            if delete_owned_records(default_zone_id, owner_record_name):
+                print('Removed records listed in %s' % owner_record_name)
+                print('##################################################################################')
+                print('')
+                continue
+            print('No ownership record %s, falling back to reading the records back' % owner_record_name)
+
+        # the public side, an Elastic IP EC2 isn't showing us yet comes from
+        # the region's cached describe_addresses, see get_addresses
+        public_ip = instance.public_ip_address
+        if not public_ip:
             try:
-                modify_resource_record(default_zone_id, name, default_zone, 'A', instance.private_ip_address, mod_action)
-                modify_resource_record(reverse_lookup_zone_id, reversed_ip_address, 'in-addr.arpa', 'PTR', fullname, mod_action)
+                public_ip = instance_address(instance.id, region)
             except BaseException as e:
-                print e
-           
-            for fun in funlist:
-                #print("Attempting to remove CNAME record for  {}.{} CNAME {}.{}".format(fun, vmzone, name, default_zone))
-                try:
-                    modify_resource_record(zone_id, fun, vmzone, 'CNAME', a_name, mod_action)
-                except BaseException as e:
-                    print e
+                print(e)
+        public_name = instance.public_dns_name
+        if public_ip and (not public_name or public_ip != instance.public_ip_address):
+            public_name = public_dns_name(public_ip, region)
 
-            # and because when we stop an instance, the instance loses its Public IP
-            # we need to query dns to finding lingering records pointing to name-public
-            if mod_action == 'delete':
-                name_public = name + '-public'
-                name_private = "%s.%s" % (name, default_zone)
-                public_fqdn = name_public + '.' + default_zone
-
-                # try to find a public ip address
-                # using dnspython for the dns lookup --> http://www.dnspython.org
-                dns_answers = dns.resolver.query(public_fqdn, 'A')
-                for rdata in dns_answers:
-                    try:
-                        modify_resource_record(default_zone_id, name_public, default_zone, 'A', str(rdata), mod_action)
-                    except BaseException as e:
-                        print e
-
-                for fun in funlist:
-                    #
-                    fun_public = fun + '-public'
-                    fun_fqdn = fun_public + '.' + vmzone
-
-                    # using dnspython, we do a dns dig looking for the CNAME record
-                    # dnspython --> http://www.dnspython.org/examples.html
-                    public_cname = dns.resolver.query(fun_fqdn, 'CNAME')
-                    for rdata in public_cname:
-                        try:
-                            # make sure rdata is a string
-                            modify_resource_record(zone_id, fun_public, vmzone, 'CNAME', str(rdata), mod_action)
-                        except BaseException as e:
-                            print e
-                    
+        if templates:
+            variables = ddns_templates.instance_variables(
+                dict((tag['Key'], tag['Value']) for tag in instance.tags),
+                name=name, instance_id=instance.id, default_zone=default_zone, vmzone=vmzone,
+                root_domain=root_domain, target_env=target_env, reverse_zone=reversed_lookup_zone,
+                reversed_ip=reversed_ip_address, private_ip=instance.private_ip_address,
+                public_ip=public_ip, private_dns_name=instance.private_dns_name,
+                public_dns_name=public_name, function=' '.join(funlist))
+            modify_templated_records(templates, variables, instance.id, mod_action, changes, ttl, weight)
 
         else:
-            # host is externally accessible aka has public name and ip address
-            print('Found public ip address of %s' % instance.public_ip_address)
-            #print("Attempting to remove A record for {}.{} A {}".format(name, default_zone, instance.public_ip_address))
+            name_public = name + '-public'
+            name_private = "%s.%s" % (name, default_zone)
             try:
-                # map public ip to name-public
-                name_public = name + '-public'
-                name_private = "%s.%s" % (name, default_zone)
-                modify_resource_record(default_zone_id, name, default_zone, 'A', instance.private_ip_address, mod_action)
-                modify_resource_record(default_zone_id, name_public, default_zone, 'A', instance.public_ip_address, mod_action)
-                modify_resource_record(reverse_lookup_zone_id, reversed_ip_address, 'in-addr.arpa', 'PTR', fullname, mod_action)
+                modify_resource_record(default_zone_id, name, default_zone, 'A', instance.private_ip_address, mod_action, changes, ttl)
+                modify_resource_record(reverse_lookup_zone_id, reversed_ip_address, 'in-addr.arpa', 'PTR', fullname, mod_action, changes, ttl)
             except BaseException as e:
                 print e
-    
+
             for fun in funlist:
-                #print("Attempting to remove CNAME record for {}.{} CNAME {}".format(fun, vmzone, instance.public_dns_name))
                 try:
-                    # map public functions to fun-public
-                    fun_public = fun + '-public'
-                    modify_resource_record(zone_id, fun, vmzone, 'CNAME', name_private, mod_action)
-                    modify_resource_record(zone_id, fun_public, vmzone, 'CNAME', instance.public_dns_name, mod_action)
+                    modify_function_record(zone_id, fun, vmzone, name_private, instance.private_ip_address, instance.id, mod_action, changes, ttl, weight)
                 except BaseException as e:
                     print e
-    
-    
+
+            if public_ip:
+                # host is externally accessible aka has public name and ip address
+                print('Found public ip address of %s' % public_ip)
+                modify_public_records(default_zone_id, zone_id, name_public, default_zone, vmzone, funlist,
+                                      public_ip, public_name, instance.id, mod_action, changes, ttl, weight)
+
+            elif mod_action == 'delete':
+                # and because when we stop an instance, the instance loses its Public IP
+                # we need to read back any lingering records for name-public
+                print('No public ip address found')
+                delete_public_records(default_zone_id, zone_id, name_public, default_zone, vmzone, funlist,
+                                      instance.id, changes)
+            else:
+                # host is not externally accessible aka no public name or ip address
+                print('No public ip address found')
+
+        if changes:
+            if ownership_txt and mod_action == 'create':
+                # write out the ownership record along with the default zone's records
+                owner_change = build_ownership_change(instance.id, owner_record_name, changes)
+                changes.setdefault(default_zone_id, []).append(owner_change)
+            records = changes_to_records(changes)
+            if retag and manifest_table:
+                changes = retag_changes(instance.id, changes)
+            submit_changes(changes)
+            if manifest_table and mod_action == 'create':
+                save_manifest(instance.id, records,
+                              (default_zone_id, owner_record_name) if ownership_txt else None, public_ip)
+        end_phase('record writes')
+
         ### Now we deal with reverse lookup stuff
        
         print('' )
@@ -409,6 +710,207 @@ def lambda_handler(event, context):
         print('##################################################################################')
         print('')
 
+    if insync_mode == 'block':
+        wait_for_insync(insync_timeout)
+
+
+def prefetch_handler(event, context):
+    # Triggered by a scheduled rule, this refreshes every cache the handler
+    # uses and saves them to DDNS_CACHE_TABLE for new containers to load
+    region = event.get('region') or os.environ.get('AWS_REGION')
+    print('Refreshing warm cache for %s' % region)
+
+    try:
+        refresh_zone_index()
+        complete = True
+    except BaseException as e:
+        # don't save a warm cache missing zones
+        print(e)
+        complete = False
+
+    dhcp_domains = {}
+    for page in compute.get_paginator('describe_dhcp_options').paginate():
+        for opts in page['DhcpOptions']:
+            for conf in opts['DhcpConfigurations']:
+                if conf['Key'] == 'domain-name' and conf['Values']:
+                    dhcp_domains[opts['DhcpOptionsId']] = conf['Values'][0]['Value']
+
+    vpc_ids = []
+    for page in compute.get_paginator('describe_vpcs').paginate():
+        for vpc in page['Vpcs']:
+            vpc_ids.append(vpc['VpcId'])
+            if vpc.get('DhcpOptionsId') in dhcp_domains:
+                vpc_domains[vpc['VpcId']] = dhcp_domains[vpc['DhcpOptionsId']]
+
+    for page in compute.get_paginator('describe_subnets').paginate():
+        for subnet in page['Subnets']:
+            subnet_masks[subnet['SubnetId']] = int(subnet['CidrBlock'].split('/')[-1])
+
+    for vpc_id in vpc_ids:
+        try:
+            load_vpc_associations(vpc_id, region)
+        except BaseException as e:
+            print(e)
+
+    try:
+        get_addresses(region, refresh=True)
+    except BaseException as e:
+        print(e)
+
+    print('Cached %d zones, %d VPC domains, %d subnets, %d associations' % (
+        len(zone_index), len(vpc_domains), len(subnet_masks), len(zone_associations)))
+    if (cache_table or cache_bucket) and complete:
+        save_warm_cache()
+
+    # changes left queued by a waiter that gave up
+    if coalesce_table:
+        try:
+            flush_all_queues()
+        except BaseException as e:
+            print(e)
+
+
+def address_handler(event, context):
+    # Triggered by CloudTrail(via EventBridge) when an Elastic IP is associated
+    # with or disassociated from an instance.  Only public records(name-public,
+    # fun-public) change, so we rewrite just those, found in the manifests, in
+    # one batch instead of re-registering everything.  Whoever held the
+    # address before(it can be moved straight from one instance to another)
+    # is found through its ip's pointer in DDNS_MANIFEST_TABLE, see save_manifest
+    detail = event['detail']
+    if detail.get('errorCode'):
+        print('%s failed(%s), nothing to do' % (detail['eventName'], detail['errorCode']))
+        return
+    region = event.get('region') or os.environ.get('AWS_REGION')
+    params = detail.get('requestParameters') or {}
+
+    global current_event
+    current_event = detail['eventName']
+    start_phases()
+    # the association is gone from describe_addresses by now, a disassociate
+    # goes by what we had cached before it, if anything
+    before = dict(addresses.get(region, (0, None))[1] or {})
+    after = get_addresses(region, refresh=True)
+    end_phase('address lookup')
+
+    # instance id -> its public ip now, None to look it up
+    readdress = OrderedDict()
+    if detail['eventName'] == 'AssociateAddress':
+        address = find_address(after, params) or {}
+        instance_id = params.get('instanceId') or address.get('InstanceId')
+        public_ip = params.get('publicIp') or address.get('PublicIp')
+        if instance_id and not public_ip:
+            public_ip = describe_public_ips([instance_id], region).get(instance_id)
+        if public_ip and manifest_table:
+            holder = ip_holder(public_ip)
+            if holder and holder != instance_id:
+                print('%s moved from %s' % (public_ip, holder))
+                readdress[holder] = None
+            end_phase('address owners')
+        if instance_id:
+            readdress[instance_id] = public_ip
+    else:
+        address = find_address(before, params)
+        if address and address.get('InstanceId'):
+            readdress[address['InstanceId']] = None
+        elif manifest_table:
+            # a container that never saw the association, any Elastic IP that's
+            # now unattached but still in somebody's records is the one
+            if params.get('publicIp'):
+                candidates = [params['publicIp']]
+            else:
+                candidates = [a['PublicIp'] for a in after.values() if not a.get('AssociationId')]
+            for public_ip in candidates:
+                holder = ip_holder(public_ip)
+                if holder:
+                    readdress[holder] = None
+        end_phase('address owners')
+    if not readdress:
+        print('Could not tell which instance %s was for: %s' % (detail['eventName'], json.dumps(params)))
+        return
+
+    # the instances that lost an address may have got an automatic one back, only EC2 knows
+    lookup = [instance_id for instance_id, public_ip in readdress.items() if public_ip is None]
+    if lookup:
+        readdress.update(describe_public_ips(lookup, region))
+
+    for instance_id, public_ip in readdress.items():
+        current_event = '%s %s' % (instance_id, detail['eventName'])
+        print('%s: %s now has public ip %s' % (detail['eventName'], instance_id, public_ip))
+        readdress_instance(instance_id, public_ip, region, context)
+    end_phase('record writes')
+    if insync_mode == 'block':
+        wait_for_insync(insync_timeout)
+
+
+def describe_public_ips(instance_ids, region):
+    """Returns instance id -> public ip, for those of instance_ids that have one."""
+    public_ips = {}
+    reservations = ddns_clients.client('ec2', region).describe_instances(InstanceIds=instance_ids)['Reservations']
+    for reservation in reservations:
+        for instance in reservation['Instances']:
+            if instance.get('PublicIpAddress'):
+                public_ips[instance['InstanceId']] = instance['PublicIpAddress']
+    end_phase('instance describe')
+    return public_ips
+
+
+def readdress_instance(instance_id, public_ip, region, context):
+    """Points an instance's public records at public_ip(None to delete them),
+    going by its manifest, or re-registers it when that won't do."""
+    records = None
+    if manifest_table:
+        try:
+            records = load_manifest(instance_id)
+        except BaseException as e:
+            print(e)
+    if records is None or ownership_txt or (public_ip and not any(is_public_record(r) for r in records)):
+        # we don't know what it owns, its ownership record needs redoing too or
+        # it's getting its first public records, so do it the long way
+        print('Re-registering all of the records of %s' % instance_id)
+        return handle_event({'detail': {'instance-id': instance_id, 'state': 'running'}, 'region': region}, context)
+
+    changes, records = public_record_changes(records, public_ip, region)
+    if changes:
+        submit_changes(changes)
+        save_manifest(instance_id, records, public_ip=public_ip)
+    else:
+        print('%s has no public records to update' % instance_id)
+
+
+def tag_handler(event, context):
+    # Triggered when tags are edited on instances, either by the tag service's
+    # "Tag Change on Resource" events or CloudTrail's CreateTags/DeleteTags.
+    # A running instance's records are worked out again from its new tags and,
+    # with DDNS_MANIFEST_TABLE, only the difference is sent(see retag_changes):
+    # a new function is one CNAME created and one deleted
+    region = event.get('region') or os.environ.get('AWS_REGION')
+    detail = event.get('detail', {})
+    if detail.get('errorCode'):
+        print('%s failed(%s), nothing to do' % (detail['eventName'], detail['errorCode']))
+        return
+
+    if 'eventName' in detail:
+        params = detail.get('requestParameters') or {}
+        instance_ids = [item['resourceId'] for item in params.get('resourcesSet', {}).get('items', [])]
+        keys = set(item['key'] for item in params.get('tagSet', {}).get('items', []))
+    else:
+        if detail.get('service') != 'ec2' or detail.get('resource-type') != 'instance':
+            return
+        instance_ids = [arn.split('/')[-1] for arn in event.get('resources', [])]
+        keys = set(detail.get('changed-tag-keys', []))
+
+    # tags on volumes, AMIs & co come through here too
+    instance_ids = [i for i in instance_ids if i.startswith('i-')]
+    if not templates_source and not keys & record_tags:
+        print('Tags %s on %s do not change any records' % (', '.join(sorted(keys)), ', '.join(instance_ids)))
+        return
+
+    for instance_id in instance_ids:
+        print('Tags %s changed on %s' % (', '.join(sorted(keys)), instance_id))
+        handle_event({'detail': {'instance-id': instance_id, 'state': 'running'}, 'region': region},
+                     context, retag=True)
+
 
 ###############################################################################
 ### Defining our functions                                   
@@ -420,11 +922,19 @@ def get_zone_id(zone_name):
     """This function returns the zone id for the zone name that's passed into the function."""
     if zone_name[-1] != '.':
         zone_name = zone_name + '.'
+    if zone_name in zone_index:
+        return zone_index[zone_name]
+    # not in the index, maybe someone made it since we started up
     # https://github.com/boto/botocore/issues/532
-    myzone = route53.list_hosted_zones_by_name(DNSName=zone_name)['HostedZones'][0]
+    myzones = route53.list_hosted_zones_by_name(DNSName=zone_name, MaxItems='1')['HostedZones']
     try:
-        zone_id = myzone['Id'].split('/')[2]
+        # list_hosted_zones_by_name starts at zone_name, so make sure it's really our zone
+        if myzones[0]['Name'] != zone_name:
+            raise LookupError(zone_name)
+        zone_id = myzones[0]['Id'].split('/')[2]
         print('Found zone_id %s for zone %s ' % (zone_id, zone_name))
+        with zone_index_lock:
+            zone_index[zone_name] = zone_id
         return zone_id
     except:
         print('Failed to find zone id for %s' % zone_name)
@@ -433,7 +943,11 @@ def get_zone_id(zone_name):
 
 ## One function to delete or create
 ## just tell the function what action(create or delete) we want
-def modify_resource_record(zone_id, host_name, hosted_zone_name, type, value, action):
+## pass in a changes dict to queue the change up instead of sending it,
+## then hand the dict to submit_changes
+## set_identifier turns the record into one member of a multivalue set,
+## or of a weighted set if a weight is given too
+def modify_resource_record(zone_id, host_name, hosted_zone_name, type, value, action, changes=None, ttl=None, set_identifier=None, weight=None):
     """This function creates or deletes resource records in the hosted zone passed by the calling function."""
     if action == 'create':
         print('Updating %s record %s in zone %s ' % (type, host_name, hosted_zone_name))
@@ -446,27 +960,1144 @@ def modify_resource_record(zone_id, host_name, hosted_zone_name, type, value, ac
         return
     if host_name[-1] != '.':
         host_name = host_name + '.'
-    route53.change_resource_record_sets(
-                HostedZoneId=zone_id,
-                ChangeBatch={
-                    "Comment": "Updated by Lambda DDNS",
-                    "Changes": [
-                        {
-                            "Action": action,
-                            "ResourceRecordSet": {
-                                "Name": host_name + hosted_zone_name,
-                                "Type": type,
-                                "TTL": 60,
-                                "ResourceRecords": [
-                                    {   
-                                        "Value": value
-                                    },
-                                ]
-                            }
-                        },
-                    ]
-                }
-            )
+    if ttl is None:
+        ttl = record_ttl
+    change = {
+        "Action": action,
+        "ResourceRecordSet": {
+            "Name": host_name + hosted_zone_name,
+            "Type": type,
+            "TTL": ttl,
+            "ResourceRecords": [
+                {
+                    "Value": value
+                },
+            ]
+        }
+    }
+    if set_identifier:
+        change['ResourceRecordSet']['SetIdentifier'] = set_identifier
+        if weight is not None:
+            change['ResourceRecordSet']['Weight'] = weight
+        else:
+            change['ResourceRecordSet']['MultiValueAnswer'] = True
+    if changes is not None:
+        changes.setdefault(zone_id, []).append(change)
+        return
+    change_record_sets(zone_id, [change])
+
+
+def modify_function_record(zone_id, fun, vmzone, cname_target, ip_address, instance_id, action, changes=None, ttl=None, weight=None):
+    """Creates or deletes a function record, see function_routing for the flavours."""
+    if function_routing == 'cname':
+        modify_resource_record(zone_id, fun, vmzone, 'CNAME', cname_target, action, changes, ttl)
+    elif function_routing == 'weighted':
+        modify_resource_record(zone_id, fun, vmzone, 'A', ip_address, action, changes, ttl, instance_id, weight)
+    else:
+        modify_resource_record(zone_id, fun, vmzone, 'A', ip_address, action, changes, ttl, instance_id)
+
+
+def modify_templated_records(templates, variables, instance_id, action, changes=None, ttl=None, weight=None):
+    """Creates or deletes every record the templates give an instance, see ddns_templates.py."""
+    for zone_name, type, record_name, value, ip_address in ddns_templates.render(templates, variables):
+        if not zone_name.strip('.') or not record_name.strip('.'):
+            # a template whose variables came out empty for this instance
+            print('Skipping %s record %r in zone %r, the template rendered an empty name' % (type, record_name, zone_name))
+            continue
+        try:
+            zone_id = get_zone_id(zone_name)
+            if not zone_id:
+                print('No zone %s for %s record %s' % (zone_name, type, record_name))
+                continue
+            # modify_resource_record wants the name relative to its zone
+            zone_name = zone_name.rstrip('.')
+            host_name = record_name.rstrip('.')
+            if host_name.endswith('.' + zone_name):
+                host_name = host_name[:-len(zone_name) - 1]
+            else:
+                zone_name = ''
+            if value is None:
+                # what it pointed at went away with the instance(e.g. its public ip),
+                # so read the record back to delete it
+                if action != 'delete':
+                    continue
+                if type != 'function':
+                    delete_record_set(zone_id, record_name, type, None, changes)
+                elif function_routing == 'cname':
+                    delete_record_set(zone_id, record_name, 'CNAME', None, changes)
+                else:
+                    delete_record_set(zone_id, record_name, 'A', instance_id, changes)
+            elif type == 'function':
+                modify_function_record(zone_id, host_name, zone_name, value, ip_address, instance_id, action, changes, ttl, weight)
+            else:
+                modify_resource_record(zone_id, host_name, zone_name, type, value, action, changes, ttl)
+        except BaseException as e:
+            print(e)
+
+
+def modify_public_records(default_zone_id, zone_id, name_public, default_zone, vmzone, funlist,
+                          public_ip, public_name, instance_id, action, changes=None, ttl=None, weight=None):
+    """Creates or deletes an instance's public side, name-public & every fun-public."""
+    try:
+        # map public ip to name-public
+        modify_resource_record(default_zone_id, name_public, default_zone, 'A', public_ip, action, changes, ttl)
+    except BaseException as e:
+        print(e)
+    for fun in funlist:
+        try:
+            # map public functions to fun-public
+            modify_function_record(zone_id, fun + '-public', vmzone, public_name, public_ip, instance_id, action, changes, ttl, weight)
+        except BaseException as e:
+            print(e)
+
+
+def delete_public_records(default_zone_id, zone_id, name_public, default_zone, vmzone, funlist, instance_id, changes=None):
+    """Deletes an instance's public side when we no longer know its public ip,
+    each record is read back(one range read, see record_cache)."""
+    try:
+        delete_record_set(default_zone_id, name_public + '.' + default_zone, 'A', None, changes)
+    except BaseException as e:
+        print(e)
+    for fun in funlist:
+        fun_fqdn = fun + '-public.' + vmzone
+        try:
+            if function_routing != 'cname':
+                # our member of the shared set is keyed by instance id
+                delete_record_set(zone_id, fun_fqdn, 'A', instance_id, changes)
+            else:
+                delete_record_set(zone_id, fun_fqdn, 'CNAME', None, changes)
+        except BaseException as e:
+            print(e)
+
+
+def get_record_set(zone_id, record_name, type, set_identifier=None):
+    """Reads a single record set out of Route53(through record_cache), returns None if it isn't there."""
+    return record_cache.get(zone_id, record_name, type, set_identifier)
+
+
+def delete_record_set(zone_id, record_name, type, set_identifier=None, changes=None):
+    """Deletes a record set exactly as Route53 has it, handy when we no longer know its values."""
+    record_set = get_record_set(zone_id, record_name, type, set_identifier)
+    if not record_set:
+        print('No %s record %s to delete' % (type, record_name))
+        return
+    print('Deleting %s record %s in zone %s' % (type, record_name, zone_id))
+    change = {"Action": "DELETE", "ResourceRecordSet": record_set}
+    if changes is not None:
+        changes.setdefault(zone_id, []).append(change)
+        return
+    submit_changes({zone_id: [change]})
+
+
+def change_record_sets(zone_id, changes):
+    """Sends one ChangeBatch to Route53 and hands the change id to the INSYNC tracker.
+    Returns None if there was nothing left to send, see drop_unchanged."""
+    if skip_unchanged != 'off':
+        changes = drop_unchanged(zone_id, changes)
+        if not changes:
+            return None
+    try:
+        # botocore already retried throttles and PriorRequestNotComplete
+        response = route53.change_resource_record_sets(
+            HostedZoneId=zone_id,
+            ChangeBatch={
+                "Comment": "Updated by Lambda DDNS",
+                "Changes": changes
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] in throttle_codes:
+            note_throttle()
+        forget_current_values(zone_id, changes)
+        record_cache.invalidate(zone_id, changes)
+        raise
+    record_cache.invalidate(zone_id, changes)
+    remember_changes(zone_id, changes)
+    track_change(response['ChangeInfo']['Id'], current_event, response['ChangeInfo'].get('SubmittedAt'))
+    return response
+
+
+def submit_changes(changes):
+    """Sends the queued changes, one ChangeBatch per zone, or hands them to the write coalescer."""
+    if skip_unchanged != 'off':
+        # before they're queued, so a duplicate event doesn't even reach the coalescer
+        changes = dict((zone_id, drop_unchanged(zone_id, zone_changes)) for zone_id, zone_changes in changes.items())
+        changes = dict((zone_id, zone_changes) for zone_id, zone_changes in changes.items() if zone_changes)
+    if coalesce_table:
+        for zone_id, zone_changes in changes.items():
+            coalesce_changes(zone_id, zone_changes)
+        return
+    write_changes(changes)
+
+
+def write_changes(changes):
+    """Sends changes straight to Route53, in batches of up to max_batch_changes per zone."""
+    for zone_id, zone_changes in changes.items():
+        for start in range(0, len(zone_changes), ddns_pipeline.max_batch_changes):
+            chunk = zone_changes[start:start + ddns_pipeline.max_batch_changes]
+            print('Submitting %d changes to zone %s' % (len(chunk), zone_id))
+            ddns_pipeline.send_batch(change_record_sets, zone_id, chunk)
+
+
+# event scheduler functions
+# every throttle(seen by botocore's retries or by us) pushes throttled_until
+# out by defer_cooldown and, at most every half cooldown, copies it to a
+# marker item in DDNS_DEFER_TABLE so the other containers know too.
+# Deferred events are items in the 'deferred' queue, oldest first, claimed
+# with a delete that returns the old item, so each one is handled once
+defer_queue = 'deferred'
+pressure_key = {'queue_id': {'S': '~pressure'}, 'seq': {'S': '~pressure'}}
+
+def note_throttle():
+    global throttled_until
+    now = time.time()
+    published = throttled_until
+    throttled_until = now + defer_cooldown
+    if not defer_table or now < published - defer_cooldown / 2:
+        return
+    try:
+        dynamodb_client.put_item(TableName=defer_table,
+            Item=dict(pressure_key, until={'N': str(throttled_until)},
+                      expires={'N': str(int(throttled_until) + 86400)}))
+    except BaseException as e:
+        print(e)
+
+def throttle_hook(response=None, **kwargs):
+    """botocore needs-retry hook, sees the throttles its retries hide from us."""
+    if response and response[1].get('Error', {}).get('Code') in throttle_codes:
+        note_throttle()
+
+def under_pressure():
+    """True while we, or any other container, got throttled in the last defer_cooldown seconds."""
+    global pressure_until, pressure_read
+    now = time.time()
+    if now < throttled_until:
+        return True
+    if defer_table and now - pressure_read > 1:
+        try:
+            item = dynamodb_client.get_item(TableName=defer_table, Key=pressure_key).get('Item')
+            pressure_until = float(item['until']['N']) if item else 0
+            pressure_read = now
+        except BaseException as e:
+            print(e)
+    return now < pressure_until
+
+def defer_event(event):
+    """Parks an event in DDNS_DEFER_TABLE for drain_deferred."""
+    seq = '%017.6f-%s' % (time.time(), uuid.uuid4())
+    dynamodb_client.put_item(
+        TableName=defer_table,
+        Item={
+            'queue_id': {'S': defer_queue},
+            'seq': {'S': seq},
+            'event': {'S': json.dumps(event)},
+            'expires': {'N': str(int(time.time()) + 86400)},
+        })
+    print('Route53 is throttling, deferred %s %s as %s' % (
+        event['detail']['instance-id'], event['detail']['state'], seq))
+
+def time_left(context):
+    """Milliseconds this invocation has left, plenty when there's no lambda context."""
+    if context is None:
+        return defer_reserve_ms * 10
+    return context.get_remaining_time_in_millis()
+
+def instance_came_back(event):
+    """True if a deferred event's instance is pending or running now, its
+    records are a later running event's and mustn't be cleaned up."""
+    try:
+        reservations = ddns_clients.client('ec2', event['region']).describe_instances(
+            InstanceIds=[event['detail']['instance-id']])['Reservations']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
+            return False
+        raise
+    return any(instance['State']['Name'] in ('pending', 'running')
+               for reservation in reservations for instance in reservation['Instances'])
+
+def drain_deferred(context, limit):
+    """Handles up to limit deferred events, oldest first, while there's no pressure and time left.
+    Returns how many it handled."""
+    drained = 0
+    while drained < limit and not under_pressure():
+        items = dynamodb_client.query(
+            TableName=defer_table,
+            ConsistentRead=True,
+            KeyConditionExpression='queue_id = :queue',
+            ExpressionAttributeValues={':queue': {'S': defer_queue}},
+            Limit=min(25, limit - drained))['Items']
+        if not items:
+            break
+        for item in items:
+            if under_pressure() or time_left(context) < defer_reserve_ms:
+                return drained
+            claimed = dynamodb_client.delete_item(TableName=defer_table, ReturnValues='ALL_OLD',
+                Key={'queue_id': item['queue_id'], 'seq': item['seq']}).get('Attributes')
+            if not claimed:
+                # somebody else is draining too
+                continue
+            event = json.loads(claimed['event']['S'])
+            print('Draining deferred event %s' % claimed['seq']['S'])
+            try:
+                if instance_came_back(event):
+                    print('Dropping deferred %s %s, the instance is running again' % (
+                        event['detail']['instance-id'], event['detail']['state']))
+                else:
+                    handle_event(event, context)
+            except BaseException as e:
+                print(e)
+                defer_event(event)
+            drained = drained + 1
+    if drained:
+        print('Drained %d deferred events' % drained)
+    return drained
+
+
+# unchanged record functions
+# a record set's current value is (ttl, sorted values, weight), None for one
+# that isn't there, keyed by current_value_key
+def current_value_key(zone_id, record_set):
+    return (zone_id, record_set['Name'].rstrip('.').lower() + '.', record_set['Type'], record_set.get('SetIdentifier'))
+
+def record_set_value(record_set):
+    return (record_set['TTL'], tuple(sorted(r['Value'] for r in record_set['ResourceRecords'])), record_set.get('Weight'))
+
+def load_current_values(instance_id):
+    """Fills current_values with the instance's records from the warm cache
+    snapshot or its manifest, either one only while it's younger than current_values_ttl."""
+    records = None
+    learned = time.time()
+    try:
+        # the snapshot's records are as old as the snapshot and expire with it
+        if snapshot is not None and snapshot_saved and learned - snapshot_saved < current_values_ttl:
+            records = snapshot.instance_records(instance_id)
+            if records is not None:
+                learned = snapshot_saved
+        # and the manifest's are as old as its last write, one that doesn't
+        # say when that was isn't trusted at all
+        if records is None and manifest_table:
+            item = read_manifest(instance_id)
+            if item and 'updated' in item:
+                records = [tuple(record) for record in json.loads(item['records']['S'])]
+                learned = int(item['updated']['N'])
+    except BaseException as e:
+        print(e)
+        return
+    for zone_id, zone_changes in records_to_changes(records or [], 'UPSERT').items():
+        for change in zone_changes:
+            record_set = change['ResourceRecordSet']
+            current_values[current_value_key(zone_id, record_set)] = (record_set_value(record_set), learned)
+
+def get_current_value(zone_id, record_set):
+    """What the record set holds now, as far as the ledger knows, or as Route53
+    says with DDNS_SKIP_UNCHANGED=zone.  Returns False when we don't know."""
+    key = current_value_key(zone_id, record_set)
+    if key in current_values:
+        value, learned = current_values[key]
+        if time.time() - learned < current_values_ttl:
+            return value
+    if skip_unchanged != 'zone':
+        return False
+    current = get_record_set(zone_id, key[1], key[2], key[3])
+    value = record_set_value(current) if current and 'ResourceRecords' in current else None
+    current_values[key] = (value, time.time())
+    return value
+
+def drop_unchanged(zone_id, changes):
+    """Leaves out the UPSERTs that would write what the record set already holds."""
+    kept = []
+    for change in changes:
+        record_set = change['ResourceRecordSet']
+        if change['Action'] == 'UPSERT':
+            try:
+                unchanged = get_current_value(zone_id, record_set) == record_set_value(record_set)
+            except BaseException as e:
+                print(e)
+                unchanged = False
+            if unchanged:
+                print('%s record %s is unchanged, skipping it' % (record_set['Type'], record_set['Name']))
+                continue
+        kept.append(change)
+    return kept
+
+def remember_changes(zone_id, changes):
+    """Records what a successful ChangeBatch left in the zone."""
+    if skip_unchanged == 'off':
+        return
+    now = time.time()
+    for change in changes:
+        record_set = change['ResourceRecordSet']
+        if change['Action'] == 'DELETE':
+            current_values[current_value_key(zone_id, record_set)] = (None, now)
+        else:
+            current_values[current_value_key(zone_id, record_set)] = (record_set_value(record_set), now)
+
+def forget_current_values(zone_id, changes):
+    """After a failed ChangeBatch we can't be sure of anything it touched."""
+    for change in changes:
+        current_values.pop(current_value_key(zone_id, change['ResourceRecordSet']), None)
+
+
+# write coalescer functions
+# every invocation drops its changes into a per-zone queue in DDNS_COALESCE_TABLE
+# (hash key zone_id, range key seq, both strings).  Whoever holds the zone's
+# lock item drains the queue, merging everything waiting into batches of up to
+# max_batch_changes, so a burst turns into a few big ChangeBatches instead of
+# lots of little ones fighting over PriorRequestNotComplete
+coalesce_lock_key = '~lock'
+
+def coalesce_changes(zone_id, changes):
+    """Queues a zone's changes, then flushes the queue if nobody else is."""
+    seq = '%017.6f-%s' % (time.time(), uuid.uuid4())
+    dynamodb_client.put_item(
+        TableName=coalesce_table,
+        Item={
+            'zone_id': {'S': zone_id},
+            'seq': {'S': seq},
+            'changes': {'S': json.dumps(changes)},
+            # lets DynamoDB TTL clean up anything that's somehow never flushed
+            'expires': {'N': str(int(time.time()) + 86400)},
+        })
+    print('Queued %d changes for zone %s as %s' % (len(changes), zone_id, seq))
+
+    deadline = time.time() + coalesce_timeout
+    while True:
+        if acquire_zone_lock(zone_id):
+            try:
+                flush_zone_queue(zone_id)
+            finally:
+                release_zone_lock(zone_id)
+            # anything queued while we were letting go goes round again
+            if not queued_entries(zone_id, 1):
+                return
+            continue
+        # somebody else is flushing, they'll pick up our changes
+        time.sleep(coalesce_window)
+        if not dynamodb_client.get_item(TableName=coalesce_table, ConsistentRead=True,
+                Key={'zone_id': {'S': zone_id}, 'seq': {'S': seq}}).get('Item'):
+            return
+        if time.time() > deadline:
+            print('Gave up waiting on zone %s, the scheduled prefetch will send %s' % (zone_id, seq))
+            return
+
+def flush_all_queues():
+    """Flushes every zone with something queued that nobody is flushing,
+    the scheduled prefetch's sweep for changes a waiter gave up on."""
+    zone_ids = set()
+    kwargs = {'TableName': coalesce_table, 'ProjectionExpression': 'zone_id, seq'}
+    while True:
+        page = dynamodb_client.scan(**kwargs)
+        for item in page['Items']:
+            if item['seq']['S'] != coalesce_lock_key:
+                zone_ids.add(item['zone_id']['S'])
+        if not page.get('LastEvaluatedKey'):
+            break
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+    for zone_id in sorted(zone_ids):
+        if not acquire_zone_lock(zone_id):
+            continue
+        try:
+            flush_zone_queue(zone_id)
+        except BaseException as e:
+            print(e)
+        finally:
+            release_zone_lock(zone_id)
+
+def acquire_zone_lock(zone_id):
+    """Takes the zone's lock item, or returns False if somebody else holds a live one."""
+    now = int(time.time())
+    try:
+        dynamodb_client.put_item(
+            TableName=coalesce_table,
+            Item={
+                'zone_id': {'S': zone_id},
+                'seq': {'S': coalesce_lock_key},
+                'owner': {'S': coalesce_owner},
+                'expires': {'N': str(now + coalesce_lease)},
+            },
+            ConditionExpression='attribute_not_exists(zone_id) OR expires < :now',
+            ExpressionAttributeValues={':now': {'N': str(now)}})
+        return True
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        return False
+
+def release_zone_lock(zone_id):
+    try:
+        dynamodb_client.delete_item(
+            TableName=coalesce_table,
+            Key={'zone_id': {'S': zone_id}, 'seq': {'S': coalesce_lock_key}},
+            ConditionExpression='#owner = :owner',
+            ExpressionAttributeNames={'#owner': 'owner'},
+            ExpressionAttributeValues={':owner': {'S': coalesce_owner}})
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        # our lease ran out and somebody else has it now
+        pass
+
+def queued_entries(zone_id, limit):
+    """Oldest entries in a zone's queue."""
+    return dynamodb_client.query(
+        TableName=coalesce_table,
+        ConsistentRead=True,
+        KeyConditionExpression='zone_id = :zone AND seq < :lock',
+        ExpressionAttributeValues={':zone': {'S': zone_id}, ':lock': {'S': coalesce_lock_key}},
+        Limit=limit)['Items']
+
+def flush_zone_queue(zone_id):
+    """Drains a zone's queue into merged ChangeBatches.  Call with the zone lock held."""
+    # give the rest of the burst a moment to land in the queue
+    time.sleep(coalesce_window)
+    while True:
+        entries = queued_entries(zone_id, ddns_pipeline.max_batch_changes)
+        if not entries:
+            return
+        # later changes to the same record set replace earlier ones,
+        # otherwise everything keeps the order it was queued in
+        merged = OrderedDict()
+        for entry in entries:
+            for change in json.loads(entry['changes']['S']):
+                record_set = change['ResourceRecordSet']
+                key = (record_set['Name'], record_set['Type'], record_set.get('SetIdentifier'))
+                merged.pop(key, None)
+                merged[key] = change
+        print('Flushing %d queued entries as %d changes to zone %s' % (len(entries), len(merged), zone_id))
+        write_changes({zone_id: list(merged.values())})
+
+        keys = [{'DeleteRequest': {'Key': {'zone_id': entry['zone_id'], 'seq': entry['seq']}}} for entry in entries]
+        for start in range(0, len(keys), 25):
+            request = {coalesce_table: keys[start:start + 25]}
+            while request:
+                request = dynamodb_client.batch_write_item(RequestItems=request).get('UnprocessedItems')
+
+
+# ownership record functions
+def ownership_record_name(instance_id, zone_name):
+    """Name of the TXT record listing everything an instance owns."""
+    return '_ddns.%s.%s.' % (instance_id, zone_name.rstrip('.'))
+
+def build_ownership_change(instance_id, record_name, changes):
+    """Builds the UPSERT for an instance's ownership TXT record from its queued changes."""
+    # one value is the marker, the rest are
+    # "zone_id type name value ttl set_identifier weight" with - for not set
+    values = ['"%s,instance=%s"' % (heritage_marker, instance_id)]
+    for zone_id, zone_changes in sorted(changes.items()):
+        for change in zone_changes:
+            record_set = change['ResourceRecordSet']
+            for record in record_set['ResourceRecords']:
+                values.append('"%s %s %s %s %s %s %s"' % (zone_id, record_set['Type'], record_set['Name'], record['Value'],
+                    record_set['TTL'], record_set.get('SetIdentifier', '-'), record_set.get('Weight', '-')))
+    return {
+        "Action": "UPSERT",
+        "ResourceRecordSet": {
+            "Name": record_name,
+            "Type": "TXT",
+            "TTL": record_ttl,
+            "ResourceRecords": [{"Value": value} for value in values]
+        }
+    }
+
+def get_ownership_record(zone_id, record_name):
+    """Reads an instance's ownership TXT record, returns None if there isn't one."""
+    return get_record_set(zone_id, record_name, 'TXT')
+
+def delete_owned_records(zone_id, record_name):
+    """Deletes everything listed in an ownership TXT record, plus the record itself.
+    Returns False if there was no ownership record to work from."""
+    try:
+        owner_record = get_ownership_record(zone_id, record_name)
+    except BaseException as e:
+        print(e)
+        return False
+    if not owner_record:
+        return False
+
+    records = []
+    for record in owner_record['ResourceRecords']:
+        if record['Value'].strip('"').startswith(heritage_marker):
+            continue
+        # older records only carry "zone_id type name value"
+        fields = record['Value'].strip('"').split(' ') + ['60', '-', '-']
+        owned_zone_id, type, name, value, ttl, set_identifier, weight = fields[:7]
+        records.append((owned_zone_id, type, name, value, int(ttl),
+                        None if set_identifier == '-' else set_identifier,
+                        None if weight == '-' else int(weight)))
+
+    changes = records_to_changes(records, 'DELETE')
+    changes.setdefault(zone_id, []).append({"Action": "DELETE", "ResourceRecordSet": owner_record})
+    submit_changes(changes)
+    return True
+
+
+# record manifest functions
+# a record is (zone_id, type, name, value, ttl, set_identifier, weight),
+# the same tuples ddns_snapshot.py stores
+def changes_to_records(changes):
+    """Flattens queued UPSERTs into record tuples."""
+    records = []
+    for zone_id, zone_changes in sorted(changes.items()):
+        for change in zone_changes:
+            record_set = change['ResourceRecordSet']
+            if change['Action'] != 'UPSERT' or record_set['Type'] == 'TXT':
+                continue
+            for record in record_set['ResourceRecords']:
+                records.append((zone_id, record_set['Type'], record_set['Name'], record['Value'], record_set['TTL'],
+                                record_set.get('SetIdentifier'), record_set.get('Weight')))
+    return records
+
+def records_to_changes(records, action):
+    """Groups record tuples back into record sets, returns zone_id -> list of changes."""
+    record_sets = OrderedDict()
+    for zone_id, type, name, value, ttl, set_identifier, weight in records:
+        key = (zone_id, name, type, ttl, set_identifier, weight)
+        record_sets.setdefault(key, []).append(value)
+
+    changes = {}
+    for (zone_id, name, type, ttl, set_identifier, weight), values in record_sets.items():
+        if action == 'DELETE':
+            print('Deleting %s record %s in zone %s' % (type, name, zone_id))
+        record_set = {
+            "Name": name,
+            "Type": type,
+            "TTL": ttl,
+            "ResourceRecords": [{"Value": value} for value in values]
+        }
+        if set_identifier:
+            record_set['SetIdentifier'] = set_identifier
+            if weight is not None:
+                record_set['Weight'] = weight
+            else:
+                record_set['MultiValueAnswer'] = True
+        changes.setdefault(zone_id, []).append({"Action": action, "ResourceRecordSet": record_set})
+    return changes
+
+def is_public_record(record):
+    """name-public and fun-public records, by the -public on their first label."""
+    return record[2].split('.')[0].endswith('-public')
+
+def public_record_changes(records, public_ip, region):
+    """Points an instance's public records at a new public ip, or deletes them
+    when it has none.  Returns the changes and the records it's left with."""
+    old_records = [record for record in records if is_public_record(record)]
+    kept = [record for record in records if not is_public_record(record)]
+    new_records = []
+    if public_ip:
+        for zone_id, type, name, value, ttl, set_identifier, weight in old_records:
+            if type == 'CNAME':
+                value = public_dns_name(public_ip, region)
+            elif type == 'A':
+                value = public_ip
+            new_records.append((zone_id, type, name, value, ttl, set_identifier, weight))
+    if sorted(new_records) == sorted(old_records):
+        return {}, records
+    changes = {}
+    if public_ip:
+        # UPSERT replaces the whole record set, so the old values go with it
+        changes = records_to_changes(new_records, 'UPSERT')
+    else:
+        changes = records_to_changes(old_records, 'DELETE')
+    return changes, kept + new_records
+
+def retag_changes(instance_id, changes):
+    """Cuts an instance's queued UPSERTs down to what differs from its manifest:
+    record sets it no longer has are deleted, new or changed ones UPSERTed and
+    the rest left alone.  Without a manifest everything goes out as it is."""
+    try:
+        old_records = load_manifest(instance_id)
+    except BaseException as e:
+        print(e)
+        old_records = None
+    if old_records is None:
+        print('No manifest for %s, records its old tags made are left behind' % instance_id)
+        return changes
+
+    def record_sets(records):
+        sets = {}
+        for zone_id, type, name, value, ttl, set_identifier, weight in records:
+            key = (zone_id, type, name, set_identifier)
+            sets.setdefault(key, (ttl, weight, []))[2].append(value)
+        return dict((key, (ttl, weight, sorted(values))) for key, (ttl, weight, values) in sets.items())
+
+    old_sets = record_sets(old_records)
+    new_sets = record_sets(changes_to_records(changes))
+
+    # deletes go first in each zone's batch, a rename is a delete and a create
+    diff = records_to_changes([r for r in old_records if (r[0], r[1], r[2], r[5]) not in new_sets], 'DELETE')
+    for zone_id, zone_changes in sorted(changes.items()):
+        for change in zone_changes:
+            record_set = change['ResourceRecordSet']
+            key = (zone_id, record_set['Type'], record_set['Name'], record_set.get('SetIdentifier'))
+            if record_set['Type'] == 'TXT' or old_sets.get(key) != new_sets.get(key):
+                diff.setdefault(zone_id, []).append(change)
+
+    # the ownership record alone is no change at all
+    if all(change['ResourceRecordSet']['Type'] == 'TXT' for zone_changes in diff.values() for change in zone_changes):
+        diff = {}
+    print('Tag change for %s comes to %d changes' % (instance_id, sum(len(c) for c in diff.values())))
+    return diff
+
+# next to the manifests, an item per public ip, '~ip <ip>', names the instance
+# whose records use it, so an Elastic IP moving can be traced to its old
+# holder without any cache of ours
+ip_pointer_prefix = '~ip '
+
+def save_manifest(instance_id, records, owner=None, public_ip=None):
+    """Writes down what an instance owns in DDNS_MANIFEST_TABLE, owner is the
+    (zone_id, name) of its ownership TXT record, if it has one."""
+    item = {
+        'instance_id': {'S': instance_id},
+        'records': {'S': json.dumps(records)},
+        'updated': {'N': str(int(time.time()))},
+    }
+    if owner:
+        item['owner'] = {'S': json.dumps(owner)}
+    if public_ip:
+        item['public_ip'] = {'S': public_ip}
+    old = dynamodb_client.put_item(TableName=manifest_table, Item=item, ReturnValues='ALL_OLD').get('Attributes', {})
+    old_ip = old.get('public_ip', {}).get('S')
+    if old_ip and old_ip != public_ip:
+        drop_ip_pointer(old_ip, instance_id)
+    if public_ip and public_ip != old_ip:
+        dynamodb_client.put_item(TableName=manifest_table, Item={
+            'instance_id': {'S': ip_pointer_prefix + public_ip}, 'holder': {'S': instance_id}})
+
+def drop_ip_pointer(public_ip, instance_id):
+    """Deletes the pointer for public_ip, unless another instance has it by now."""
+    try:
+        dynamodb_client.delete_item(TableName=manifest_table,
+            Key={'instance_id': {'S': ip_pointer_prefix + public_ip}},
+            ConditionExpression='holder = :holder',
+            ExpressionAttributeValues={':holder': {'S': instance_id}})
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        pass
+
+def ip_holder(public_ip):
+    """The instance whose records use public_ip, going by the manifests, None if nobody's do."""
+    item = dynamodb_client.get_item(TableName=manifest_table, ConsistentRead=True,
+                                    Key={'instance_id': {'S': ip_pointer_prefix + public_ip}}).get('Item')
+    return item['holder']['S'] if item else None
+
+def read_manifest(instance_id):
+    return dynamodb_client.get_item(TableName=manifest_table, ConsistentRead=True,
+                                    Key={'instance_id': {'S': instance_id}}).get('Item')
+
+def load_manifest(instance_id):
+    """Returns the record tuples stored for an instance, None if we have none."""
+    item = read_manifest(instance_id)
+    if not item:
+        return None
+    return [tuple(record) for record in json.loads(item['records']['S'])]
+
+def delete_from_manifest(instance_id):
+    """Deletes everything in an instance's manifest, and the manifest.
+    Returns False if there was no manifest to work from."""
+    try:
+        item = read_manifest(instance_id)
+    except BaseException as e:
+        print(e)
+        return False
+    if not item:
+        return False
+    records = [tuple(record) for record in json.loads(item['records']['S'])]
+    print('Cleaning up %d records for %s from its manifest' % (len(records), instance_id))
+    changes = records_to_changes(records, 'DELETE')
+
+    # the ownership TXT record isn't in the manifest, it goes in the same batch
+    if 'owner' in item:
+        owner_zone_id, owner_record_name = json.loads(item['owner']['S'])
+        try:
+            owner_record = get_ownership_record(owner_zone_id, owner_record_name)
+        except BaseException as e:
+            print(e)
+            owner_record = None
+        if owner_record:
+            changes.setdefault(owner_zone_id, []).append({"Action": "DELETE", "ResourceRecordSet": owner_record})
+    submit_changes(changes)
+    dynamodb_client.delete_item(TableName=manifest_table, Key={'instance_id': {'S': instance_id}})
+    if 'public_ip' in item:
+        drop_ip_pointer(item['public_ip']['S'], instance_id)
+    return True
+
+
+# name slot functions
+# DDNS_NAME_TABLE holds an item per name.zone with the slot each instance
+# owns(as json, plus a version for optimistic locking) and an item per
+# instance, '~instance <id>', pointing back at it.  Either way in is one read
+name_instance_prefix = '~instance '
+
+def read_name_item(name_key):
+    item = dynamodb_client.get_item(TableName=name_table, ConsistentRead=True,
+                                    Key={'name_key': {'S': name_key}}).get('Item', {})
+    owners = json.loads(item['owners']['S']) if item else {}
+    version = int(item['version']['N']) if item else 0
+    return owners, version
+
+def write_name_item(name_key, owners, version):
+    """Saves a name's owners, fails with ConditionalCheckFailedException if somebody beat us to it."""
+    dynamodb_client.put_item(
+        TableName=name_table,
+        Item={
+            'name_key': {'S': name_key},
+            'owners': {'S': json.dumps(owners)},
+            'version': {'N': str(version + 1)},
+        },
+        ConditionExpression='attribute_not_exists(version) OR version = :version',
+        ExpressionAttributeValues={':version': {'N': str(version)}})
+
+def claim_name_slot(instance_id, name, zone_name):
+    """Returns name-<n> for an instance, n being the lowest slot free for name in the zone,
+    or the slot it already holds."""
+    name_key = '%s.%s' % (name, zone_name)
+    # renamed(a retag), so the number it had under its old name goes back first
+    pointer = dynamodb_client.get_item(TableName=name_table, ConsistentRead=True,
+                                       Key={'name_key': {'S': name_instance_prefix + instance_id}}).get('Item')
+    if pointer and pointer['owner_key']['S'] != name_key:
+        print('%s was %s, giving that back' % (instance_id, pointer['slot_name']['S']))
+        release_name_slot(instance_id)
+    delay = 0.05
+    for attempt in range(max_attempts):
+        owners, version = read_name_item(name_key)
+        if instance_id in owners:
+            return '%s-%d' % (name, owners[instance_id])
+        taken = set(owners.values())
+        slot = 1
+        while slot in taken:
+            slot = slot + 1
+        owners[instance_id] = slot
+        try:
+            write_name_item(name_key, owners, version)
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            # a sibling claimed a slot at the same time, look again
+            time.sleep(delay + random.random() * delay)
+            delay = delay * 2
+            continue
+        slot_name = '%s-%d' % (name, slot)
+        dynamodb_client.put_item(
+            TableName=name_table,
+            Item={
+                'name_key': {'S': name_instance_prefix + instance_id},
+                'owner_key': {'S': name_key},
+                'slot_name': {'S': slot_name},
+            })
+        return slot_name
+    raise Exception('Could not claim a name slot for %s after %d attempts' % (instance_id, max_attempts))
+
+def release_name_slot(instance_id):
+    """Frees an instance's slot, returns the name it had, None if it had none."""
+    instance_key = {'name_key': {'S': name_instance_prefix + instance_id}}
+    item = dynamodb_client.get_item(TableName=name_table, ConsistentRead=True, Key=instance_key).get('Item')
+    if not item:
+        return None
+    name_key = item['owner_key']['S']
+    for attempt in range(max_attempts):
+        owners, version = read_name_item(name_key)
+        if owners.pop(instance_id, None) is None:
+            break
+        try:
+            write_name_item(name_key, owners, version)
+            break
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            time.sleep(random.random() * 0.1)
+    dynamodb_client.delete_item(TableName=name_table, Key=instance_key)
+    return item['slot_name']['S']
+
+
+# INSYNC tracking functions
+# one background thread polls every change we've submitted, it lives across
+# warm invocations and goes away once nothing is pending.  Latency is timed
+# from Route53's SubmittedAt, and only reported if the poller was watching
+# the whole time: between invocations the container is frozen, and a change
+# seen INSYNC after a thaw went INSYNC at some unknown point before it
+def track_change(change_id, event_label, submitted_at=None):
+    """Remembers a submitted change so the poller can time it to INSYNC."""
+    global insync_thread
+    if insync_mode not in ('track', 'block'):
+        return
+    now = time.time()
+    submitted = now
+    if submitted_at:
+        submitted = calendar.timegm(submitted_at.utctimetuple()) + submitted_at.microsecond / 1e6
+    with insync_lock:
+        pending_changes[change_id] = {'event': event_label, 'submitted': submitted, 'errors': 0}
+        if event_label not in pending_events:
+            pending_events[event_label] = {'started': submitted, 'pending': 0, 'timed': True}
+        pending_events[event_label]['pending'] += 1
+        if insync_thread is None or not insync_thread.is_alive():
+            insync_thread = threading.Thread(target=insync_poller)
+            insync_thread.daemon = True
+            insync_thread.start()
+
+def insync_poller():
+    """Polls get_change with backoff until every pending change is INSYNC or given up on."""
+    delay = 1.0
+    while True:
+        with insync_lock:
+            change_ids = list(pending_changes)
+        if not change_ids:
+            return
+        for change_id in change_ids:
+            change = pending_changes[change_id]
+            try:
+                status = route53.get_change(Id=change_id)['ChangeInfo']['Status']
+                change['errors'] = 0
+            except BaseException as e:
+                print(e)
+                change['errors'] += 1
+                status = None
+            if status == 'INSYNC':
+                insync_done(change_id)
+                delay = 1.0
+            elif change['errors'] >= insync_max_errors or time.time() - change['submitted'] > insync_max_age:
+                print('Giving up on change %s of %s after %d errors, %d seconds' % (
+                    change_id, change['event'], change['errors'], time.time() - change['submitted']))
+                insync_done(change_id, False)
+        slept = time.time()
+        time.sleep(delay)
+        if time.time() - slept > delay + 1.0:
+            # we were frozen, whatever is pending now can't be timed
+            with insync_lock:
+                for event in pending_events.values():
+                    event['timed'] = False
+        delay = min(delay * 2, 10.0)
+
+def insync_done(change_id, insync=True):
+    """Marks a change INSYNC(or given up on), and logs the event's latency once its last change lands."""
+    with insync_lock:
+        change = pending_changes.pop(change_id, None)
+        event = pending_events.get(change['event']) if change else None
+        if event is None:
+            return
+        event['pending'] -= 1
+        event['timed'] = event['timed'] and insync
+        if event['pending'] > 0:
+            return
+        del pending_events[change['event']]
+        insync_lock.notify_all()
+    if event['timed']:
+        print(json.dumps({'metric': 'ddns_insync_seconds', 'event': change['event'],
+                          'seconds': round(time.time() - event['started'], 3)}))
+    else:
+        print('Not timing %s, it was given up on or went INSYNC while we were frozen' % change['event'])
+
+def wait_for_insync(timeout):
+    """Blocks until all pending changes are INSYNC or timeout seconds pass."""
+    deadline = time.time() + timeout
+    with insync_lock:
+        while pending_changes and time.time() < deadline:
+            insync_lock.wait(deadline - time.time())
+        if pending_changes:
+            print('Gave up waiting on %d changes to go INSYNC' % len(pending_changes))
+
+
+# profiling functions
+# phases are timed back to back, end_phase(name) charges everything since
+# the last mark to name, so there's no re-indenting the handler to time it
+def start_phases():
+    global phase_mark
+    phase_times.clear()
+    phase_mark = time.time()
+
+def end_phase(name):
+    global phase_mark
+    if not profile_enabled:
+        return
+    now = time.time()
+    phase_times[name] = phase_times.get(name, 0) + now - phase_mark
+    phase_mark = now
+
+def profiled(handler):
+    """Wraps a handler in cProfile, logging a top-N report plus the phase timings."""
+    def profiled_handler(event, context):
+        global profiled_invocations
+        profiled_invocations += 1
+        profiler = cProfile.Profile()
+        started = time.time()
+        try:
+            return profiler.runcall(handler, event, context)
+        finally:
+            elapsed = time.time() - started
+            report = StringIO()
+            stats = pstats.Stats(profiler, stream=report)
+            stats.sort_stats('cumulative').print_stats(profile_top)
+            print(json.dumps({'metric': 'ddns_phase_seconds',
+                              'event': current_event,
+                              'cold': profiled_invocations == 1,
+                              'total': round(elapsed, 4),
+                              'phases': dict((k, round(v, 4)) for k, v in phase_times.items())}))
+            if profile_dir:
+                path = os.path.join(profile_dir, 'ddns-%d-%d' % (os.getpid(), profiled_invocations))
+                stats.dump_stats(path + '.prof')
+                with open(path + '.txt', 'w') as f:
+                    f.write(report.getvalue())
+                print('Profile written to %s.prof' % path)
+            else:
+                print(report.getvalue())
+    return profiled_handler
+
+
+# cache functions
+def refresh_zone_index():
+    """(Re)builds zone_index from every page of list_hosted_zones.  If a page
+    fails(throttling) the zones read so far are added and the error raised,
+    get_zone_id looks up the rest as they come up."""
+    zones = {}
+    try:
+        for page in route53.get_paginator('list_hosted_zones').paginate():
+            for zone in page['HostedZones']:
+                zone_id = zone['Id'].split('/')[2]
+                # same rule as list_hosted_zones_by_name, lowest id wins on duplicate names
+                if zone['Name'] not in zones or zone_id < zones[zone['Name']]:
+                    zones[zone['Name']] = zone_id
+    except BaseException:
+        with zone_index_lock:
+            zone_index.update(zones)
+        raise
+    with zone_index_lock:
+        zone_index.clear()
+        zone_index.update(zones)
+
+def get_vpc_domain(vpc_id):
+    """Returns the domain-name from the VPC's dhcp option set, None if it has none."""
+    if vpc_id not in vpc_domains:
+        vpc = ec2.Vpc(vpc_id)
+        dhcp_options = ec2.DhcpOptions(vpc.dhcp_options_id)
+        vpc_domains[vpc_id] = None
+        for opts in dhcp_options.dhcp_configurations:
+            if 'domain-name' == opts['Key'] and opts['Values']:
+                vpc_domains[vpc_id] = opts['Values'][0]['Value']
+    return vpc_domains[vpc_id]
+
+def get_addresses(region, refresh=False):
+    """The region's Elastic IPs, public ip -> address, one describe_addresses per address_ttl."""
+    loaded, by_ip = addresses.get(region, (0, None))
+    if refresh or by_ip is None or time.time() - loaded > address_ttl:
+        response = ddns_clients.client('ec2', region).describe_addresses()
+        by_ip = dict((address['PublicIp'], address) for address in response['Addresses'])
+        addresses[region] = (time.time(), by_ip)
+    return by_ip
+
+def find_address(by_ip, params):
+    """The Elastic IP an Associate/DisassociateAddress call was about."""
+    for address in by_ip.values():
+        for key, param in (('AllocationId', 'allocationId'), ('AssociationId', 'associationId'),
+                           ('PublicIp', 'publicIp')):
+            if params.get(param) and address.get(key) == params[param]:
+                return address
+    return None
+
+def instance_address(instance_id, region):
+    """The Elastic IP associated with an instance, None if it has none."""
+    for address in get_addresses(region).values():
+        if address.get('InstanceId') == instance_id:
+            return address['PublicIp']
+    return None
+
+def public_dns_name(public_ip, region):
+    """EC2's public hostname for an ip, for when the instance has none(no dns
+    hostnames in its VPC) or an Elastic IP it isn't showing yet."""
+    if region == 'us-east-1':
+        return 'ec2-%s.compute-1.amazonaws.com' % public_ip.replace('.', '-')
+    return 'ec2-%s.%s.compute.amazonaws.com' % (public_ip.replace('.', '-'), region)
+
+def get_subnet_mask(subnet_id):
+    """Returns the subnet's mask, e.g. 24 for a /24."""
+    if subnet_id not in subnet_masks:
+        subnet_masks[subnet_id] = int(ec2.Subnet(subnet_id).cidr_block.split('/')[-1])
+    return subnet_masks[subnet_id]
+
+def load_all_manifests():
+    """Every instance's record tuples, instance id -> records, in one scan of DDNS_MANIFEST_TABLE."""
+    manifests = {}
+    kwargs = {'TableName': manifest_table, 'ProjectionExpression': 'instance_id, records'}
+    while True:
+        page = dynamodb_client.scan(**kwargs)
+        for item in page['Items']:
+            if 'records' in item:
+                manifests[item['instance_id']['S']] = [tuple(record) for record in json.loads(item['records']['S'])]
+        if not page.get('LastEvaluatedKey'):
+            return manifests
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+def save_warm_cache():
+    """Writes our caches out as a snapshot, to S3 or DynamoDB, along with
+    every instance's records when there's a DDNS_MANIFEST_TABLE."""
+    instance_records = None
+    if manifest_table:
+        try:
+            instance_records = load_all_manifests()
+        except BaseException as e:
+            print(e)
+    # S3 snapshots get memory mapped, so the instance lookups stay uncompressed
+    data = ddns_snapshot.encode_snapshot(zone_index, vpc_domains, subnet_masks,
+                                         zone_associations, loaded_associations, instance_records,
+                                         in_place=bool(cache_bucket))
+    if not cache_bucket and instance_records and len(data) > max_item_snapshot:
+        print('%d byte snapshot is too big for DynamoDB, leaving out the %d instances(set DDNS_CACHE_BUCKET)' % (
+            len(data), len(instance_records)))
+        data = ddns_snapshot.encode_snapshot(zone_index, vpc_domains, subnet_masks,
+                                             zone_associations, loaded_associations)
+    print('Saving %d byte snapshot' % len(data))
+    if cache_bucket:
+        s3.put_object(Bucket=cache_bucket, Key=cache_id, Body=data)
+        return
+    dynamodb_client.put_item(
+        TableName=cache_table,
+        Item={
+            'cache_id': {'S': cache_id},
+            'updated': {'N': str(int(time.time()))},
+            'data': {'B': data},
+        })
+
+def load_warm_cache():
+    """Fills our caches from the saved snapshot, returns False if there was nothing usable."""
+    global snapshot, snapshot_saved
+    try:
+        if cache_bucket:
+            # straight to disk, so a big snapshot never sits in memory whole
+            response = s3.get_object(Bucket=cache_bucket, Key=cache_id)
+            path = os.path.join(snapshot_dir, 'ddns-%s.snapshot' % cache_id.replace('/', '-'))
+            with open(path + '.part', 'wb') as f:
+                shutil.copyfileobj(response['Body'], f)
+            # a snapshot we mapped before keeps its own copy of the file
+            os.rename(path + '.part', path)
+            with open(path, 'rb') as f:
+                data = f.read(len(ddns_snapshot.snapshot_magic))
+            if ddns_snapshot.is_snapshot(data):
+                data = None
+            else:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            saved = response.get('LastModified')
+            saved = calendar.timegm(saved.utctimetuple()) if saved else None
+        else:
+            item = dynamodb_client.get_item(TableName=cache_table, Key={'cache_id': {'S': cache_id}}).get('Item')
+            if not item:
+                return False
+            data = item['data']['B']
+            saved = int(item['updated']['N']) if 'updated' in item else None
+        if data is not None and not ddns_snapshot.is_snapshot(data):
+            # written by an older version as compressed json, the next prefetch replaces it
+            cache = json.loads(zlib.decompress(data).decode('utf-8'))
+            zone_index.update(cache['zones'])
+            vpc_domains.update(cache['vpc_domains'])
+            subnet_masks.update(cache['subnet_masks'])
+            zone_associations.update(tuple(pair) for pair in cache['associations'])
+            loaded_associations.update(cache['loaded_associations'])
+            return True
+        if data is None:
+            snapshot = ddns_snapshot.open_snapshot(path)
+        else:
+            snapshot = ddns_snapshot.Snapshot(data)
+        snapshot_saved = saved
+        zone_index.update(snapshot.zones())
+        vpc_domains.update(snapshot.vpc_domains())
+        subnet_masks.update(snapshot.subnet_masks())
+        zone_associations.update(snapshot.associations())
+        loaded_associations.update(snapshot.loaded_associations())
+    except BaseException as e:
+        print('Failed to load warm cache: %s' % e)
+        return False
+    print('Loaded warm cache, %d zones, %d subnets, %d instances' % (
+        len(zone_index), len(subnet_masks), snapshot.instance_count()))
+    return True
 
 
 # reverse lookup functions
@@ -497,19 +2128,52 @@ def get_reversed_domain_prefix(subnet_mask, private_ip):
         return first_octet.group(0)
 
 def create_reverse_lookup_zone(instance, reversed_domain_prefix, region, vpc_id):
-    """Creates the reverse lookup zone."""
-    print('Creating reverse lookup zone %s' % reversed_domain_prefix + 'in.addr.arpa.')
-    route53.create_hosted_zone(
-        Name = reversed_domain_prefix + 'in-addr.arpa.',
-        VPC = {
-            'VPCRegion':region,
-            'VPCId':vpc_id
-        },
-        CallerReference=str(uuid.uuid1()),
-        HostedZoneConfig={
-            'Comment': 'Updated by Lambda DDNS',
-        },
-    )
+    """Creates the reverse lookup zone, unless somebody beat us to it.  Returns the zone id."""
+    zone_name = reversed_domain_prefix + 'in-addr.arpa.'
+    # the lock stops threads in this container racing each other, the fixed
+    # CallerReference stops other containers making a second copy of the zone
+    with reverse_zone_lock:
+        zone_id = get_zone_id(zone_name)
+        if zone_id:
+            return zone_id
+        print('Creating reverse lookup zone %s' % zone_name)
+        caller_reference = 'lambda-ddns-%s-%s' % (zone_name, vpc_id)
+        try:
+            response = route53.create_hosted_zone(
+                Name = zone_name,
+                VPC = {
+                    'VPCRegion':region,
+                    'VPCId':vpc_id
+                },
+                CallerReference=caller_reference,
+                HostedZoneConfig={
+                    'Comment': 'Updated by Lambda DDNS',
+                },
+            )
+        except route53.exceptions.HostedZoneAlreadyExists:
+            # another container created it with our CallerReference
+            zone_id = get_zone_id(zone_name)
+            if zone_id:
+                return zone_id
+            # the zone that used that CallerReference was deleted since,
+            # CallerReferences can't be reused so fall back to a fresh one
+            response = route53.create_hosted_zone(
+                Name = zone_name,
+                VPC = {
+                    'VPCRegion':region,
+                    'VPCId':vpc_id
+                },
+                CallerReference=str(uuid.uuid1()),
+                HostedZoneConfig={
+                    'Comment': 'Updated by Lambda DDNS',
+                },
+            )
+        zone_id = response['HostedZone']['Id'].split('/')[2]
+        with zone_index_lock:
+            zone_index[zone_name] = zone_id
+        # the zone was created inside the VPC, so no association check needed
+        zone_associations.add((zone_id, vpc_id))
+        return zone_id
 
 def get_hosted_zone_properties(zone_id):
     hosted_zone_properties = route53.get_hosted_zone(Id=zone_id)
@@ -517,6 +2181,73 @@ def get_hosted_zone_properties(zone_id):
     return hosted_zone_properties
 
 
+# zone/VPC association functions
+# zone_associations holds (zone id, VPC id) pairs we know are associated,
+# it's filled a whole VPC at a time and lives across warm invocations
+def load_vpc_associations(vpc_id, region):
+    """Pulls every private zone associated with a VPC into zone_associations."""
+    kwargs = {'VPCId': vpc_id, 'VPCRegion': region}
+    while True:
+        response = route53.list_hosted_zones_by_vpc(**kwargs)
+        for summary in response['HostedZoneSummaries']:
+            zone_associations.add((summary['HostedZoneId'].split('/')[-1], vpc_id))
+        if not response.get('NextToken'):
+            break
+        kwargs['NextToken'] = response['NextToken']
+    loaded_associations.add(vpc_id)
+
+def zone_associated(zone_id, vpc_id, region):
+    """True if the private zone is associated with the VPC."""
+    if (zone_id, vpc_id) in zone_associations:
+        return True
+    if vpc_id not in loaded_associations:
+        try:
+            load_vpc_associations(vpc_id, region)
+        except (AttributeError, ClientError) as e:
+            # older boto3 doesn't have list_hosted_zones_by_vpc, read the zone itself,
+            # anything else(throttling included) is the caller's problem
+            if isinstance(e, ClientError) and e.response['Error']['Code'] not in ('UnknownOperationException', 'InvalidAction'):
+                raise
+            print(e)
+            if zone_id not in loaded_associations:
+                for vpc in get_hosted_zone_properties(zone_id).get('VPCs', []):
+                    zone_associations.add((zone_id, vpc['VPCId']))
+                loaded_associations.add(zone_id)
+    return (zone_id, vpc_id) in zone_associations
+
+def associate_zone(zone_id, region, vpc_id):
+    """Associates a private zone with a VPC."""
+    try:
+        route53.associate_vpc_with_hosted_zone(
+            HostedZoneId=zone_id,
+            VPC={
+                'VPCRegion': region,
+                'VPCId': vpc_id
+            },
+            Comment='Updated by Lambda DDNS'
+        )
+    except route53.exceptions.ConflictingDomainExists as e:
+        # already associated(or a clash we can't fix), either way don't ask again
+        print(e)
+    zone_associations.add((zone_id, vpc_id))
+
+
+# Now fill the caches, from the warm cache if we have one
+if not ((cache_table or cache_bucket) and load_warm_cache()):
+    try:
+        refresh_zone_index()
+    except BaseException as e:
+        # a throttled cold start still comes up, get_zone_id fills in the gaps
+        print('Could not read every hosted zone, looking them up as they come up: %s' % e)
+
+# let botocore's retries tell us about throttles, see note_throttle
+if defer_table:
+    route53.meta.events.register('needs-retry.route53', throttle_hook)
+
+if profile_enabled:
+    lambda_handler = profiled(lambda_handler)
+
+
 print('')
 print('Completed function ' + datetime.now().time().isoformat())
 print('##################################################################################')